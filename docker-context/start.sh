@@ -4,6 +4,7 @@
 conda activate higlass-server
 
 mkdir -p /data/log
+mkdir -p /data/nginx-cache
 
 echo "Mounting httpfs"
 mkdir -p $HTTPFS_HTTP_DIR
@@ -0,0 +1,177 @@
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import threading
+
+logger = logging.getLogger(__name__)
+
+STORE_EXT = '.loops.npy'
+INDEX_EXT = '.loops.json'
+
+LOOP_COLUMNS = ['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2']
+
+
+def loop_dtype(chrom_length):
+    '''
+    Get the dtype of loops with chromosome names of up to `chrom_length`
+    characters.
+    '''
+    return [
+        (name, 'U{}'.format(chrom_length) if name.startswith('chrom') else 'i8')
+        for name in LOOP_COLUMNS
+    ]
+
+
+class LoopList:
+    '''
+    Preparsed loop list. The loops are sorted by `chrom1` and `index` maps
+    every chromosome to its `[start, end)` rows.
+    '''
+    def __init__(self, loops, index, mtime):
+        self.loops = loops
+        self.index = index
+        self.mtime = mtime
+
+    def intra_chr(self, chrom=None):
+        '''
+        Get the intra-chromosomal loops of `chrom` or all loops if no
+        chromosome is given.
+        '''
+        if not chrom:
+            return self.loops
+
+        chrom = str(chrom)
+
+        if chrom not in self.index:
+            return self.loops[:0]
+
+        start, end = self.index[chrom]
+        loops = self.loops[start:end]
+
+        return loops[loops['chrom2'] == chrom]
+
+
+def is_loop_list(filepath):
+    '''
+    Check whether a file looks like a tab-separated loop list with a
+    header and `chrom1, start1, end1, chrom2, start2, end2` columns.
+    '''
+    try:
+        with open(filepath, 'r') as f:
+            f.readline()
+            row = f.readline().rstrip('\n').split('\t')
+        [int(row[i]) for i in [1, 2, 4, 5]]
+    except (IndexError, ValueError, UnicodeDecodeError, OSError):
+        return False
+
+    return True
+
+
+def parse_loop_list(filepath):
+    df = pd.read_csv(filepath, sep='\t', header=0, index_col=False)
+
+    chroms = [df.iloc[:, 0].astype(str), df.iloc[:, 3].astype(str)]
+    # Wide enough for the longest chromosome name
+    chrom_length = max([1] + [int(c.str.len().max()) for c in chroms if len(c)])
+
+    loops = np.empty(df.shape[0], dtype=loop_dtype(chrom_length))
+    for i, name in enumerate(LOOP_COLUMNS):
+        col = df.iloc[:, i]
+        loops[name] = col.astype(str) if name.startswith('chrom') else col
+
+    # Stable so that loops keep their order within a chromosome
+    return loops[np.argsort(loops['chrom1'], kind='mergesort')]
+
+
+def write_atomic(path, write, mode):
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def index_loop_list(filepath):
+    '''
+    Parse a loop list and write the store and its index next to it.
+
+    Return:
+
+    (LoopList): The preparsed loop list
+    '''
+    mtime = os.path.getmtime(filepath)
+    loops = parse_loop_list(filepath)
+
+    chroms, starts = np.unique(loops['chrom1'], return_index=True)
+    ends = np.append(starts[1:], len(loops))
+    index = {
+        chrom: [int(start), int(end)]
+        for chrom, start, end in zip(chroms.tolist(), starts, ends)
+    }
+
+    try:
+        # Other processes might be reading the store, so it is replaced
+        # atomically and before the index that points to it
+        write_atomic(filepath + STORE_EXT, lambda f: np.save(f, loops), 'wb')
+        write_atomic(
+            filepath + INDEX_EXT,
+            lambda f: json.dump({'mtime': mtime, 'chroms': index}, f),
+            'w'
+        )
+    except OSError as e:
+        # The loop list can still be served from memory
+        logger.warning('Could not store loop list %s: %s', filepath, e)
+
+    return LoopList(loops, index, mtime)
+
+
+def load_loop_list(filepath):
+    '''
+    Load the store of a loop list memory-mapped if it is up to date,
+    otherwise (re)index the loop list.
+    '''
+    mtime = os.path.getmtime(filepath)
+
+    try:
+        with open(filepath + INDEX_EXT, 'r') as f:
+            index = json.load(f)
+
+        if index['mtime'] == mtime:
+            return LoopList(
+                np.load(filepath + STORE_EXT, mmap_mode='r'),
+                index['chroms'],
+                mtime
+            )
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return index_loop_list(filepath)
+
+
+_loop_lists = {}
+_loop_lists_lock = threading.Lock()
+
+
+def get_loop_list(filepath):
+    '''
+    Get a loop list, loading it lazily and only once until it changes.
+    '''
+    mtime = os.path.getmtime(filepath)
+
+    with _loop_lists_lock:
+        loop_list = _loop_lists.get(filepath)
+
+        if loop_list is None or loop_list.mtime != mtime:
+            loop_list = load_loop_list(filepath)
+            _loop_lists[filepath] = loop_list
+
+    return loop_list
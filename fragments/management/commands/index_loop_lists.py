@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from fragments.loop_lists import (
+    INDEX_EXT, STORE_EXT, index_loop_list, is_loop_list
+)
+import os
+
+
+class Command(BaseCommand):
+    help = 'Preparse and index every loop list in the data directory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-dir', type=str, default='data')
+
+    def handle(self, *args, **options):
+        data_dir = options['data_dir']
+
+        for dirpath, _, filenames in os.walk(data_dir):
+            for filename in sorted(filenames):
+                if filename.endswith(STORE_EXT) or filename.endswith(INDEX_EXT):
+                    continue
+
+                filepath = os.path.join(dirpath, filename)
+
+                if not is_loop_list(filepath):
+                    continue
+
+                loop_list = index_loop_list(filepath)
+
+                print('indexed:', filepath, len(loop_list.loops), 'loops')
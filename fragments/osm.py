@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import os
+import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from random import choice
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import higlass_server.settings as hss
+
+logger = logging.getLogger(__name__)
+
+SUBDOMAINS = ['a', 'b', 'c']
+
+
+class TileStore:
+    '''
+    Persistent on-disk store of raster tiles laid out as `<root>/z/x/y`.
+
+    Every hit touches the tile's mtime so that the least recently used
+    tiles are evicted first once the store grows beyond `max_bytes`. The
+    store is rescanned on first use, so it survives restarts.
+    '''
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, z, x, y):
+        return os.path.join(self.root, str(z), str(x), str(y))
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith('.tmp'):
+                    yield os.path.join(dirpath, filename)
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(
+                    os.path.getsize(path) for path in self._files()
+                )
+            return self._size
+
+    def get(self, z, x, y):
+        path = self._path(z, x, y)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted in the meantime
+            pass
+
+        return data
+
+    def set(self, z, x, y, data):
+        path = self._path(z, x, y)
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+
+        # Scan the store before adding to it so that the new tile is
+        # counted exactly once
+        self.size()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+
+        # Atomic so that concurrent readers never see a partial tile
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._size += len(data) - replaced
+            full = self._size > self.max_bytes
+
+        if full:
+            self.evict()
+
+    def evict(self, target=0.9):
+        '''
+        Remove the least recently used tiles until the store is below
+        `target` times `max_bytes`.
+        '''
+        with self._lock:
+            tiles = []
+            for path in self._files():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, path))
+
+            tiles.sort()
+
+            size = sum(tile[1] for tile in tiles)
+            limit = self.max_bytes * target
+
+            for _, tile_size, path in tiles:
+                if size <= limit:
+                    break
+                try:
+                    os.remove(path)
+                    size -= tile_size
+                except OSError:
+                    pass
+
+            self._size = size
+
+
+class TileFetcher:
+    '''
+    Connection-pooled, concurrent fetcher of z/x/y raster tiles backed by
+    a `TileStore`.
+
+    Args:
+
+    url (str): Upstream URL template with `{z}`, `{x}`, `{y}` and an
+        optional `{s}` subdomain placeholder
+    store (TileStore): Local tile store or `None` to disable it
+    threads (int): Max number of concurrent downloads
+    timeout (float): Timeout per request in seconds
+    '''
+    def __init__(self, url, store=None, threads=8, timeout=10):
+        self.url = url
+        self.store = store
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'higlass-server'
+        adapter = HTTPAdapter(
+            pool_connections=len(SUBDOMAINS),
+            pool_maxsize=threads,
+            max_retries=Retry(
+                total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]
+            )
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def fetch(self, z, x, y):
+        if self.store is not None:
+            data = self.store.get(z, x, y)
+            if data is not None:
+                return data
+
+        src = self.url.format(s=choice(SUBDOMAINS), z=z, x=x, y=y)
+
+        try:
+            r = self.session.get(src, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning('Failed to fetch tile %s: %s', src, e)
+            return None
+
+        if r.status_code != 200:
+            return None
+
+        if self.store is not None:
+            self.store.set(z, x, y, r.content)
+
+        return r.content
+
+    def fetch_many(self, z, xys):
+        '''
+        Fetch several tiles of one zoom level concurrently.
+
+        Args:
+
+        z (int): Zoom level
+        xys (list): List of `(x, y)` tile positions
+
+        Return:
+
+        (list): Tile bytes or `None` for every missing tile in the order
+            of `xys`
+        '''
+        return list(self.executor.map(lambda xy: self.fetch(z, *xy), xys))
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_tile_fetcher():
+    global _fetcher
+
+    with _fetcher_lock:
+        if _fetcher is None:
+            url = hss.SNIPPET_OSM_TILE_URL
+
+            store = None
+            if hss.SNIPPET_OSM_TILE_STORE_SIZE > 0:
+                # Namespace the store by upstream so that switching to a
+                # different tile server never serves stale tiles
+                store = TileStore(
+                    os.path.join(
+                        hss.SNIPPET_OSM_TILE_STORE_DIR,
+                        hashlib.md5(url.encode()).hexdigest()[:8]
+                    ),
+                    hss.SNIPPET_OSM_TILE_STORE_SIZE
+                )
+
+            _fetcher = TileFetcher(
+                url,
+                store=store,
+                threads=hss.SNIPPET_OSM_THREADS,
+                timeout=hss.SNIPPET_OSM_TIMEOUT
+            )
+
+        return _fetcher
@@ -0,0 +1,141 @@
+import numpy as np
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def resample_weights(in_size, out_size):
+    '''
+    Weight matrix mapping a 1D signal of length `in_size` onto `out_size`
+    values.
+
+    When downsampling every output value is the area-weighted average of
+    the input values it covers. When upsampling the input is linearly
+    interpolated with the first and last values aligned to the corners,
+    just like `scipy.ndimage.zoom(..., order=1)`.
+
+    Args:
+
+    in_size (int): Input length
+    out_size (int): Output length
+
+    Return:
+
+    (np.array): `out_size` x `in_size` float32 matrix. Do not modify it,
+        since it is cached.
+    '''
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+
+    if out_size <= in_size:
+        scale = in_size / out_size
+
+        for i in range(out_size):
+            start = i * scale
+            end = (i + 1) * scale
+
+            first = int(np.floor(start))
+            last = min(int(np.ceil(end)), in_size)
+
+            for j in range(first, last):
+                weights[i, j] = min(end, j + 1) - max(start, j)
+
+        weights /= scale
+    elif in_size == 1:
+        weights[:, 0] = 1
+    else:
+        pos = np.arange(out_size) * (in_size - 1) / (out_size - 1)
+        left = np.minimum(np.floor(pos).astype(int), in_size - 2)
+        frac = (pos - left).astype(np.float32)
+
+        weights[np.arange(out_size), left] = 1 - frac
+        weights[np.arange(out_size), left + 1] = frac
+
+    weights.flags.writeable = False
+
+    return weights
+
+
+def block_mean(stack, shape):
+    '''
+    Downsample a stack of matrices or images by averaging blocks. Every
+    output dimension must divide the input dimension evenly.
+    '''
+    n, h, w = stack.shape[:3]
+    out_h, out_w = shape
+
+    return stack.reshape(
+        (n, out_h, h // out_h, out_w, w // out_w) + stack.shape[3:]
+    ).mean(axis=(2, 4), dtype=np.float32)
+
+
+def resample(arr, shape):
+    '''
+    Resample the first two dimensions of a matrix or an image (with the
+    channels last) to `shape`.
+
+    Evenly divisible downsampling is an exact block mean. Anything else is
+    done with separable area averaging (see `resample_weights`). NaN
+    values are ignored and only output values that are made up of NaN
+    values alone are NaN.
+
+    Args:
+
+    arr (np.array): 2D or 3D array
+    shape (tuple): Output height and width
+
+    Return:
+
+    (np.array): Resampled float32 array
+    '''
+    return resample_stack(np.asarray(arr)[np.newaxis], shape)[0]
+
+
+def _resample_stack(stack, shape):
+    h, w = stack.shape[1:3]
+    out_h, out_w = shape
+
+    if out_h <= h and out_w <= w and h % out_h == 0 and w % out_w == 0:
+        return block_mean(stack, shape)
+
+    weights_h = resample_weights(h, out_h)
+    weights_w = resample_weights(w, out_w)
+
+    if stack.ndim == 3:
+        return np.matmul(np.matmul(weights_h, stack), weights_w.T)
+
+    return np.einsum('oi,nijc,pj->nopc', weights_h, stack, weights_w)
+
+
+def resample_stack(stack, shape):
+    '''
+    Resample a stack of equally sized matrices or images (with the
+    channels last) to `shape` in one go. NaN values are ignored like in
+    `resample`.
+
+    Args:
+
+    stack (np.array): 3D or 4D array where the first dimension indexes the
+        fragments
+    shape (tuple): Output height and width
+
+    Return:
+
+    (np.array): Resampled float32 stack
+    '''
+    stack = np.asarray(stack, dtype=np.float32)
+
+    if stack.shape[1:3] == tuple(shape):
+        return stack.copy()
+
+    nan = np.isnan(stack)
+
+    if not nan.any():
+        return _resample_stack(stack, shape)
+
+    # Resample the values with NaN set to 0 and the share of valid values
+    # with the same weights and normalize by the latter
+    total = _resample_stack(np.where(nan, 0, stack), shape)
+    valid = _resample_stack((~nan).astype(np.float32), shape)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid > 0, total / valid, np.nan).astype(np.float32)
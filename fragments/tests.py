@@ -1,12 +1,39 @@
+import base64
 import django.core.files.uploadedfile as dcfu
 import django.test as dt
 import django.contrib.auth.models as dcam
 import tilesets.models as tm
+import http.server
 import json
 import numpy as np
-
+import os
+import socketserver
+import tempfile
+import threading
+
+from io import BytesIO
+from zipfile import ZipFile
+from PIL import Image
 from urllib.parse import urlencode
 
+from fragments.loop_lists import INDEX_EXT, STORE_EXT, get_loop_list
+from fragments.osm import TileFetcher, TileStore
+from fragments.resample import resample, resample_stack, resample_weights
+from fragments.utils import (
+    FragmentAggregator,
+    arrays_to_multipart,
+    encode_image,
+    get_chroms,
+    get_intra_chr_loops_from_looplist,
+    grey_to_rgb,
+    np_to_dense,
+    np_to_png,
+    parse_bool,
+    rel_loci_2_cols,
+    rel_loci_2_obj,
+    stream_zip
+)
+
 
 class FragmentsTest(dt.TestCase):
     def setUp(self):
@@ -344,3 +371,362 @@ class FragmentsTest(dt.TestCase):
                 np.rint(max1 * 10000000) / 10000000,
                 np.rint(percentile * 10000000) / 10000000
             )
+
+
+class FragmentAggregatorTest(dt.TestCase):
+    def test_streaming_aggregation(self):
+        frags = [np.random.rand(8, 8) for _ in range(20)]
+        frags[3][2, 2] = np.nan
+
+        for method, func in [
+            ('mean', np.nanmean),
+            ('median', np.nanmedian),
+            ('std', np.nanstd),
+            ('var', np.nanvar),
+        ]:
+            aggregator = FragmentAggregator(method)
+
+            for frag in frags:
+                aggregator.add(frag)
+
+            self.assertEqual(aggregator.num_frags, 20)
+            self.assertTrue(np.allclose(
+                aggregator.result(), func(np.array(frags), axis=0)
+            ))
+
+    def test_target_shape(self):
+        frags = [np.random.rand(16, 16), np.random.rand(8, 8)]
+        results = []
+
+        # The order of the fragments doesn't matter
+        for ordered in [frags, frags[::-1]]:
+            aggregator = FragmentAggregator('mean', shape=(8, 8))
+
+            for frag in ordered:
+                aggregator.add(frag)
+
+            results.append(aggregator.result())
+
+        self.assertEqual(results[0].shape, (8, 8))
+        self.assertTrue(np.allclose(results[0], results[1]))
+
+        # Without fragments the aggregate is empty
+        empty = FragmentAggregator('median', shape=(8, 8)).result()
+        self.assertEqual(empty.shape, (8, 8))
+        self.assertTrue(np.isnan(empty).all())
+
+
+class LociTest(dt.TestCase):
+    def test_get_chroms(self):
+        chr_info = (['chr1', 'chr2'], {}, np.array([0, 100, 250]), {})
+
+        chroms = get_chroms(np.array([0, 99, 100, 249, 250]), chr_info)
+
+        self.assertEqual(chroms[:, 0].tolist(), [
+            'chr1', 'chr1', 'chr2', 'chr2', None
+        ])
+        self.assertEqual(chroms[:, 0].tolist(), chroms[:, 1].tolist())
+
+    def test_rel_loci_2_cols(self):
+        loci = np.array([
+            ['chr1', 10, 20, 'chr1', 30, 40],
+            ['chr2', 50, 5, 'chr2', 60, 70],
+        ], dtype=object)
+
+        cols = rel_loci_2_cols(loci)
+
+        self.assertEqual(cols['start1'], [10, 50])
+        self.assertEqual(cols['strand1'], ['coding', 'noncoding'])
+        self.assertEqual(rel_loci_2_obj(loci)[1], {
+            'chrom1': 'chr2',
+            'start1': 50,
+            'end1': 5,
+            'strand1': 'noncoding',
+            'chrom2': 'chr2',
+            'start2': 60,
+            'end2': 70,
+            'strand2': 'noncoding'
+        })
+
+    def test_parse_bool(self):
+        for value in ['1', 'true', 'True', 'yes', True]:
+            self.assertTrue(parse_bool(value))
+
+        for value in ['0', 'false', 'False', 'no', 'off', '', False, None]:
+            self.assertFalse(parse_bool(value))
+
+
+class LoopListTest(dt.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.tmp.name, 'loops.txt')
+
+        with open(self.filepath, 'w') as f:
+            f.write(
+                'chr1\tx1\tx2\tchr2\ty1\ty2\n'
+                '2\t10\t20\t2\t30\t40\n'
+                '1\t1\t2\t1\t3\t4\n'
+                '2\t50\t60\t3\t70\t80\n'
+            )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_intra_chr_loops(self):
+        loci, chroms = get_intra_chr_loops_from_looplist(self.filepath, '2')
+
+        self.assertEqual(loci.tolist(), [[10, 20, 30, 40]])
+        self.assertEqual(chroms.tolist(), [['2', '2']])
+
+        loci, chroms = get_intra_chr_loops_from_looplist(self.filepath)
+
+        self.assertEqual(loci.shape, (3, 4))
+
+        # The loop list is stored next to the source and memory-mapped
+        self.assertTrue(os.path.exists(self.filepath + STORE_EXT))
+        self.assertIsInstance(
+            get_loop_list(self.filepath).loops, (np.ndarray, np.memmap)
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.tmp.name)),
+            ['loops.txt', 'loops.txt' + INDEX_EXT, 'loops.txt' + STORE_EXT]
+        )
+
+    def test_long_chrom_names(self):
+        chrom = 'HLA-DRB1*10:01:01_contig_{}'.format('x' * 40)
+
+        with open(self.filepath, 'w') as f:
+            f.write(
+                'chr1\tx1\tx2\tchr2\ty1\ty2\n'
+                '{0}\t10\t20\t{0}\t30\t40\n'.format(chrom)
+            )
+
+        loci, chroms = get_intra_chr_loops_from_looplist(self.filepath, chrom)
+
+        self.assertEqual(loci.tolist(), [[10, 20, 30, 40]])
+        self.assertEqual(chroms.tolist(), [[chrom, chrom]])
+
+
+class ResampleTest(dt.TestCase):
+    def test_resample(self):
+        mat = np.random.rand(100, 60)
+
+        # Evenly divisible is an exact block mean
+        self.assertTrue(np.allclose(
+            resample(mat, (25, 20)), mat.reshape(25, 4, 20, 3).mean((1, 3))
+        ))
+
+        # Area averaging preserves the mean
+        self.assertTrue(np.isclose(resample(mat, (30, 17)).mean(), mat.mean()))
+
+        # Upsampling interpolates between the corners
+        up = resample(mat[:3, :3], (5, 5))
+        self.assertTrue(np.allclose(up[::2, ::2], mat[:3, :3]))
+
+        for in_size, out_size in [(7, 3), (3, 7), (1, 4), (5, 5)]:
+            self.assertTrue(np.allclose(
+                resample_weights(in_size, out_size).sum(axis=1), 1
+            ))
+
+    def test_resample_stack(self):
+        ims = np.random.rand(4, 40, 30, 3)
+        scaled = resample_stack(ims, (13, 11))
+
+        self.assertEqual(scaled.shape, (4, 13, 11, 3))
+        self.assertEqual(scaled.dtype, np.float32)
+        self.assertTrue(np.allclose(
+            scaled[1, :, :, 2], resample(ims[1, :, :, 2], (13, 11)),
+            atol=1e-6
+        ))
+
+    def test_resample_nan(self):
+        mat = np.random.rand(100, 60)
+        mat[10] = np.nan
+        mat[40:48, 20:24] = np.nan
+
+        for shape in [(25, 20), (30, 17), (150, 90)]:
+            scaled = resample(mat, shape)
+
+            # NaN values are ignored instead of spreading
+            self.assertTrue(np.isfinite(scaled).any(axis=1).all())
+            self.assertTrue(
+                np.nanmin(scaled) >= np.nanmin(mat) - 1e-6 and
+                np.nanmax(scaled) <= np.nanmax(mat) + 1e-6
+            )
+
+        # Blocks of NaN values alone stay NaN
+        blocks = resample(mat, (25, 15))
+        self.assertTrue(np.isnan(blocks[10:12, 5]).all())
+        self.assertEqual(np.isnan(blocks).sum(), 2)
+        self.assertTrue(np.isclose(
+            blocks[2, 0], np.nanmean(mat[8:12, 0:4])
+        ))
+
+
+class ImageEncodingTest(dt.TestCase):
+    def test_encode_image(self):
+        mat = np.random.rand(12, 7)
+        rgba = grey_to_rgb(mat, to_rgba=True)
+
+        self.assertEqual(rgba.dtype, np.uint8)
+
+        for comp in [0, 9]:
+            im = Image.open(BytesIO(np_to_png(rgba, comp)))
+            self.assertEqual(im.format, 'PNG')
+            self.assertTrue(np.array_equal(np.array(im), rgba))
+
+        for image_format in ['webp', 'jpeg']:
+            im = Image.open(BytesIO(
+                encode_image(rgba, image_format, no_cache=True)
+            ))
+            self.assertEqual(im.format, image_format.upper())
+            self.assertEqual(im.size, (7, 12))
+
+    def test_stream_zip(self):
+        mats = [np.random.rand(5, 5) for _ in range(6)]
+
+        chunks = list(stream_zip(
+            [('{}.png'.format(i), mat) for i, mat in enumerate(mats)],
+            lambda mat: np_to_png(grey_to_rgb(mat, to_rgba=True)),
+            max_workers=3
+        ))
+
+        zf = ZipFile(BytesIO(b''.join(chunks)))
+
+        self.assertIsNone(zf.testzip())
+
+        for i, mat in enumerate(mats):
+            im = Image.open(BytesIO(zf.read('{}.png'.format(i))))
+            self.assertTrue(np.array_equal(
+                np.array(im), grey_to_rgb(mat, to_rgba=True)
+            ))
+
+    def test_stream_zip_window(self):
+        encoded = []
+
+        def encode(obj):
+            encoded.append(obj)
+            return bytes(16)
+
+        chunks = stream_zip(
+            (('{}.bin'.format(i), i) for i in range(100)), encode,
+            max_workers=2
+        )
+        next(chunks)
+
+        # Only a few blobs are encoded ahead of the client
+        self.assertLessEqual(len(encoded), 4)
+
+        # and the rest is dropped when it goes away
+        chunks.close()
+        self.assertLess(len(encoded), 10)
+
+    def test_np_to_dense(self):
+        mat = np.random.rand(6, 4)
+        dense = np_to_dense(mat)
+
+        self.assertEqual(dense['dtype'], 'float16')
+        self.assertEqual(dense['shape'], [6, 4])
+
+        decoded = np.frombuffer(
+            base64.b64decode(dense['dense']), dtype=dense['dtype']
+        ).reshape(dense['shape'])
+
+        self.assertTrue(np.allclose(decoded, mat, atol=1e-3))
+
+        # NaNs and values beyond float16's range fall back to float32
+        mat[0, 0] = np.nan
+        mat[1, 1] = 1e6
+        dense = np_to_dense(mat)
+
+        self.assertEqual(dense['dtype'], 'float32')
+
+        decoded = np.frombuffer(
+            base64.b64decode(dense['dense']), dtype=dense['dtype']
+        ).reshape(dense['shape'])
+
+        self.assertTrue(np.allclose(decoded, mat, equal_nan=True))
+
+    def test_arrays_to_multipart(self):
+        arrays = [
+            np.arange(6, dtype=np.float16).reshape((2, 3)),
+            np.arange(4, dtype=np.float32),
+        ]
+        response = arrays_to_multipart({'indices': [0, 1]}, arrays)
+
+        content_type = response['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/mixed'))
+
+        boundary = content_type.split('boundary=')[1].encode('ascii')
+        parts = response.content.split(b'--' + boundary)
+
+        # Preamble, the header, one part per array and the closing delimiter
+        self.assertEqual(len(parts), 5)
+        self.assertEqual(parts[-1], b'--\r\n')
+
+        header = parts[1].split(b'\r\n\r\n', 1)[1][:-2]
+        self.assertEqual(json.loads(header.decode('utf-8')), {'indices': [0, 1]})
+
+        for part, arr in zip(parts[2:4], arrays):
+            body = part.split(b'\r\n\r\n', 1)[1][:-2]
+            self.assertEqual(body, arr.tobytes())
+
+
+class OSMTileHandler(http.server.BaseHTTPRequestHandler):
+    # Local stand-in for the OSM tile server serving `/z/x/y.png`
+    def do_GET(self):
+        z, x, y = self.path[1:-len('.png')].split('/')
+
+        if int(x) > 2 or int(y) > 2:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(bytes([int(x), int(y)]) * 50)
+
+    def log_message(self, *args):
+        pass
+
+
+class OSMTileFetcherTest(dt.TestCase):
+    def setUp(self):
+        self.store = tempfile.TemporaryDirectory()
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), OSMTileHandler
+        )
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.cleanup()
+
+    def test_fetch_and_store(self):
+        fetcher = TileFetcher(
+            'http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png'
+            .format(self.server.server_address[1]),
+            store=TileStore(self.store.name, 1000),
+            threads=4,
+            timeout=5
+        )
+
+        xys = [(x, y) for y in range(3) for x in range(3)]
+        tiles = fetcher.fetch_many(2, xys + [(5, 5)])
+
+        for (x, y), tile in zip(xys, tiles):
+            self.assertEqual(tile, bytes([x, y]) * 50)
+
+        self.assertIsNone(tiles[-1])
+
+        # 9 tiles of 100 bytes are within the budget
+        self.assertEqual(fetcher.store.size(), 900)
+
+        # Stored tiles are served without the upstream
+        self.server.shutdown()
+        self.assertEqual(fetcher.fetch(2, 1, 2), bytes([1, 2]) * 50)
+
+        # Exceeding the budget evicts the least recently used tiles
+        fetcher.store.set(2, 9, 9, bytes(300))
+        self.assertLessEqual(fetcher.store.size(), 900)
+        self.assertIsNotNone(fetcher.store.get(2, 9, 9))
@@ -4,22 +4,23 @@ from __future__ import (
 
 import cooler
 import h5py
+import hashlib
+import json
 import logging
 import numpy as np
 import pandas as pd
-import sqlite3
-import requests
+import pybase64
 import math
+import slugid
 
-from random import random
 from io import BytesIO, StringIO
 from PIL import Image
 from sklearn.cluster import KMeans
-from scipy.ndimage.interpolation import zoom
-from cachecontrol import CacheControl
-from zipfile import ZipFile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from zipfile import ZipFile, ZIP_STORED
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 from clodius.tiles.geo import get_tile_pos_from_lng_lat
 
@@ -27,6 +28,10 @@ import higlass_server.settings as hss
 
 from higlass_server.utils import getRdb
 from fragments.exceptions import SnippetTooLarge
+from fragments.loop_lists import get_loop_list
+from fragments.osm import get_tile_fetcher
+from fragments.resample import resample, resample_stack
+from tilesets import cooler_cache, imtiles
 
 import zlib
 import struct
@@ -38,20 +43,93 @@ logger = logging.getLogger(__name__)
 
 # Methods
 
+IMAGE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+
 def grey_to_rgb(arr, to_rgba=False):
+    grey = np.nan_to_num(np.asarray(arr, dtype=np.float32))
+    grey = np.clip(255 - grey * 255, 0, 255).astype(np.uint8)
+
+    rgb = np.empty(grey.shape + ((4,) if to_rgba else (3,)), dtype=np.uint8)
+    rgb[:, :, 0:3] = grey[:, :, np.newaxis]
+
     if to_rgba:
-        rgb = np.zeros(arr.shape + (4,))
         rgb[:, :, 3] = 255
-    else:
-        rgb = np.zeros(arr.shape + (3,))
-
-    rgb[:, :, 0] = 255 - arr * 255
-    rgb[:, :, 1] = rgb[:,:,0]
-    rgb[:, :, 2] = rgb[:,:,0]
 
     return rgb
 
 
+def to_dense_dtype(arr):
+    '''
+    Cast an array to float16 if it can be represented without NaNs or
+    infinities in float16's range and to float32 otherwise, the same as
+    the `dense` data of tiles.
+    '''
+    arr = np.asarray(arr)
+
+    if (
+        arr.size and
+        np.all(np.isfinite(arr)) and
+        np.abs(arr).max() < np.finfo('float16').max
+    ):
+        return np.ascontiguousarray(arr, dtype=np.float16)
+
+    return np.ascontiguousarray(arr, dtype=np.float32)
+
+
+def np_to_dense(arr):
+    '''
+    Encode an array as base64 of its float16 or float32 bytes with its
+    shape and dtype, i.e., like the `dense` data of tiles.
+    '''
+    arr = to_dense_dtype(arr)
+
+    return {
+        'dense': pybase64.b64encode(
+            arr.reshape(-1).view(np.uint8)
+        ).decode('ascii'),
+        'dtype': str(arr.dtype),
+        'shape': list(arr.shape),
+    }
+
+
+def arrays_to_multipart(header, arrays):
+    '''
+    Create a `multipart/mixed` response whose first part is `header` as
+    JSON followed by the raw bytes of every array as
+    `application/octet-stream`.
+    '''
+    boundary = slugid.nice()
+    delimiter = '--{}\r\n'.format(boundary).encode('ascii')
+
+    parts = [
+        delimiter,
+        b'Content-Type: application/json\r\n\r\n',
+        json.dumps(header).encode('utf-8'),
+        b'\r\n',
+    ]
+
+    for arr in arrays:
+        parts += [
+            delimiter,
+            b'Content-Type: application/octet-stream\r\n',
+            'Content-Length: {}\r\n\r\n'.format(arr.nbytes).encode('ascii'),
+            arr.tobytes(),
+            b'\r\n',
+        ]
+
+    parts.append('--{}--\r\n'.format(boundary).encode('ascii'))
+
+    return HttpResponse(
+        b''.join(parts),
+        content_type='multipart/mixed; boundary={}'.format(boundary)
+    )
+
+
 def blob_to_zip(blobs, to_resp=False):
     b = BytesIO()
 
@@ -71,23 +149,120 @@ def blob_to_zip(blobs, to_resp=False):
     return b.getvalue()
 
 
-def np_to_png(arr, comp=5):
-    sz = arr.shape
+class ZipStream:
+    '''
+    Write-only file object for `ZipFile` that hands out whatever has been
+    written so far. Since it cannot seek, `ZipFile` writes every entry
+    with a trailing data descriptor and never has to go back.
+    '''
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(blobs, encode, max_workers=None):
+    '''
+    Encode blobs on a thread pool and yield a ZIP archive of the encoded
+    bytes chunk by chunk. Entries are written in the order in which their
+    encoding finishes. Only twice as many blobs as there are threads are
+    encoded ahead of the client and closing the generator (e.g., because
+    the client disconnected) cancels the pending ones.
+
+    Args:
+
+    blobs (iterable): `(name, obj)` tuples
+    encode (function): Function turning `obj` into bytes. zlib and Pillow
+        release the GIL while encoding so this runs concurrently.
+    max_workers (int): Number of threads. Defaults to
+        `SNIPPET_ENCODING_THREADS`.
+
+    Return:
+
+    (generator): Chunks of the ZIP archive
+    '''
+    if max_workers is None:
+        max_workers = hss.SNIPPET_ENCODING_THREADS
+
+    blobs = iter(blobs)
+    window = 2 * max_workers
+    stream = ZipStream()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+
+    try:
+        # The entries are compressed images already
+        with ZipFile(stream, 'w', ZIP_STORED) as zf:
+            while True:
+                for name, obj in islice(blobs, window - len(futures)):
+                    futures[executor.submit(encode, obj)] = name
+
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    zf.writestr(futures.pop(future), future.result())
+                    yield stream.pop()
+
+        # Closing the archive writes the central directory
+        yield stream.pop()
+    finally:
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown(wait=False)
+
+
+def blob_to_zip_stream(blobs, encode):
+    resp = StreamingHttpResponse(
+        stream_zip(blobs, encode), content_type='application/zip'
+    )
+    resp['Content-Disposition'] = 'attachment; filename=snippets.zip'
+
+    return resp
+
+
+def to_rgba(arr):
+    '''
+    Convert an RGB(A) image array into a contiguous uint8 RGBA array.
+    '''
+    if arr.shape[2] == 4 and arr.dtype == np.uint8:
+        return np.ascontiguousarray(arr)
+
+    out = np.empty(arr.shape[0:2] + (4,), dtype=np.uint8)
+    out[:, :, 0:arr.shape[2]] = arr
 
     # Add alpha values
     if arr.shape[2] == 3:
-        out = np.ones(
-            (sz[0], sz[1], sz[2] + 1)
-        )
         out[:, :, 3] = 255
-        out[:, :, 0:3] = arr
-    else:
-        out = arr
 
-    return write_png(
-        np.flipud(out).astype('uint8').flatten('C').tobytes(),
-        sz[1],
-        sz[0],
+    return out
+
+
+def np_to_png(arr, comp=None):
+    rgba = to_rgba(arr)
+
+    return pack_png(
+        rgba.reshape((rgba.shape[0], -1)),
+        rgba.shape[1],
+        rgba.shape[0],
         comp
     )
 
@@ -99,25 +274,110 @@ def png_pack(png_tag, data):
             struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head)))
 
 
-def write_png(buf, width, height, comp=9):
-    """ buf: must be bytes or a bytearray in Python3.x,
-        a regular string in Python2.x.
-    """
+def pack_png(rows, width, height, comp=None):
+    '''
+    Pack RGBA scanlines into a PNG.
 
-    # reverse the vertical line order and add null bytes at the start
-    width_byte_4 = width * 4
-    raw_data = b''.join(
-        b'\x00' + buf[span:span + width_byte_4]
-        for span in np.arange((height - 1) * width_byte_4, -1, - width_byte_4)
-    )
+    Args:
+
+    rows (np.array): uint8 array of shape (height, width * 4)
+    width (int): Image width in pixels
+    height (int): Image height in pixels
+    comp (int): zlib compression level. `0` disables compression, which is
+        the fastest option. Defaults to `SNIPPET_PNG_COMPRESSION`.
+
+    Return:
+
+    (bytes): The encoded PNG
+    '''
+    if comp is None:
+        comp = hss.SNIPPET_PNG_COMPRESSION
+
+    # Every scanline starts with a filter type byte (0 = None). Write the
+    # pixels into a view that skips the first byte of every line.
+    raw_data = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw_data[:, 1:] = rows
 
     return b''.join([
         b'\x89PNG\r\n\x1a\n',
         png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
-        png_pack(b'IDAT', zlib.compress(raw_data, comp)),
+        png_pack(b'IDAT', zlib.compress(raw_data.data, comp)),
         png_pack(b'IEND', b'')])
 
 
+def write_png(buf, width, height, comp=9):
+    """ buf: must be bytes or a bytearray in Python3.x,
+        a regular string in Python2.x.
+    """
+
+    # reverse the vertical line order
+    rows = np.frombuffer(buf, dtype=np.uint8).reshape((height, width * 4))
+
+    return pack_png(rows[::-1], width, height, comp)
+
+
+def encode_image(arr, image_format='png', comp=None, quality=None,
+                 no_cache=False):
+    '''
+    Encode an RGB(A) image array as PNG, WebP, or JPEG. Encoded images are
+    cached by the hash of their content and encoding options.
+
+    Args:
+
+    arr (np.array): Image array of shape (height, width, 3 or 4)
+    image_format (str): One of `png`, `webp`, or `jpeg`
+    comp (int): zlib compression level for PNGs
+    quality (int): Quality for lossy formats. Defaults to
+        `SNIPPET_IMG_QUALITY`.
+    no_cache (bool): If `True` the encoded image is not cached
+
+    Return:
+
+    (bytes): The encoded image
+    '''
+    if quality is None:
+        quality = hss.SNIPPET_IMG_QUALITY
+
+    rgba = to_rgba(arr)
+
+    key = None
+    if not no_cache:
+        h = hashlib.md5(rgba.data)
+        h.update('{}.{}.{}.{}'.format(
+            rgba.shape, image_format, comp, quality
+        ).encode('utf-8'))
+        key = 'im_enc_%s' % h.hexdigest()
+
+        try:
+            encoded = rdb.get(key)
+            if encoded is not None:
+                return encoded
+        except Exception as ex:
+            logger.warn(ex)
+
+    if image_format == 'png':
+        encoded = np_to_png(rgba, comp)
+    else:
+        im = Image.fromarray(rgba, 'RGBA')
+
+        if image_format == 'jpeg':
+            im = im.convert('RGB')
+
+        with BytesIO() as b:
+            im.save(b, format=image_format.upper(), quality=quality)
+            encoded = b.getvalue()
+
+    if key is not None:
+        try:
+            rdb.set(key, encoded, 60 * 30)
+        except Exception as ex:
+            # error caching an image
+            # log the error and carry forward, this isn't critical
+            logger.warn(ex)
+
+    return encoded
+
+
 def get_params(request, param_def):
     """Get query params of a request
 
@@ -156,6 +416,22 @@ def get_params(request, param_def):
     return p
 
 
+def parse_bool(value):
+    """Parse a boolean query param
+
+    Arguments:
+        value {str} -- Param value. `0`, `false`, `no`, `off` and empty
+            strings are false.
+
+    Returns:
+        bool -- The parsed value
+    """
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+    return bool(value)
+
+
 def get_chrom_names_cumul_len(c):
     '''
     Get the chromosome names and cumulative lengths:
@@ -190,19 +466,19 @@ def get_chrom_names_cumul_len(c):
 
 
 def get_intra_chr_loops_from_looplist(loop_list, chr=0):
-    loops = pd.DataFrame.from_csv(loop_list, sep='\t', header=0)
-
-    s_chr = str(chr)
-
-    if chr > 0:
-        loops = loops[loops['chr2'] == s_chr].loc[s_chr]
+    loops = get_loop_list(loop_list).intra_chr(chr)
 
     chrs = np.zeros((loops.shape[0], 2), dtype=object)
 
-    chrs[:, 0] = loops['chr2']
-    chrs[:, 1] = loops['chr2']
+    chrs[:, 0] = loops['chrom2']
+    chrs[:, 1] = loops['chrom2']
 
-    return (loops.as_matrix()[:, [0, 1, 3, 4]], chrs)
+    return (
+        np.column_stack((
+            loops['start1'], loops['end1'], loops['start2'], loops['end2']
+        )),
+        chrs
+    )
 
 
 def rel_2_abs_loci(loci, chr_info):
@@ -232,51 +508,19 @@ def rel_2_abs_loci(loci, chr_info):
 
 
 def get_cooler(f, zoomout_level=None):
-    c = None
-
-    try:
-        # Cooler v2
-        # In this case `zoomout_level` is the resolution
-        # See fragments/views.py line 431
-
-        resolutions = [int(x) for x in f['resolutions'].keys()]
-        resolution = min(resolutions) if zoomout_level is None else zoomout_level
-
-        # Get the closest zoomlevel
-        resolution = resolutions[np.argsort([abs(r - resolution) for r in resolutions])[0]]
-
-        return cooler.Cooler(f['resolutions/{}'.format(resolution)])
-    except:
-        # We're not logging this exception as the user might just try to open
-        # a cooler v1 file
-        pass
-
-
+    '''
+    Get the cooler of an open cooler file closest to `zoomout_level`, which
+    is the resolution for multi-resolution (v2) files and the number of
+    zoom levels below the max zoom for legacy (v1) files.
+    '''
     try:
-        # v1
-        zoomout_level = 0 if zoomout_level is None else zoomout_level
-        zoom_levels = np.array(list(f.keys()), dtype=int)
-
-        max_zoom = np.max(zoom_levels)
-        min_zoom = np.min(zoom_levels)
-
-        zoom_level = max_zoom - max(zoomout_level, 0)
+        group = cooler_cache.get_layout(f.filename).group(zoomout_level)
 
-        if (zoom_level >= min_zoom and zoom_level <= max_zoom):
-            c = cooler.Cooler(f[str(zoom_level)])
-        else:
-            c = cooler.Cooler(f['0'])
-
-        return c
-    except Exception as e:
-        logger.exception(e)
-
-    try:
-        c = cooler.Cooler(f)
+        return cooler.Cooler(f[group])
     except Exception as e:
         logger.exception(e)
 
-    return c
+    return None
 
 
 def get_frag_by_loc_from_cool(
@@ -290,27 +534,28 @@ def get_frag_by_loc_from_cool(
     ignore_diags=0,
     no_normalize=False,
     aggregate=False,
+    aggregator=None,
 ):
-    with h5py.File(cooler_file, 'r') as f:
-        c = get_cooler(f, zoomout_level)
+    # The offsets and weights are only read once per cooler
+    meta = cooler_cache.get_meta(cooler_file, zoomout_level)
 
-        # Calculate the offsets once
-        resolution = c.info['bin-size']
-        chromsizes = np.ceil(c.chromsizes / resolution).astype(int)
-        offsets = np.cumsum(chromsizes) - chromsizes
+    with h5py.File(cooler_file, 'r') as f:
+        c = cooler.Cooler(f[meta.group])
 
         fragments = collect_frags(
             c,
             loci,
             dim,
-            resolution,
-            offsets,
+            meta.resolution,
+            meta.offsets,
             padding=padding,
             balanced=balanced,
             percentile=percentile,
             ignore_diags=ignore_diags,
             no_normalize=no_normalize,
-            aggregate=aggregate
+            aggregate=aggregate,
+            aggregator=aggregator,
+            weights=meta.weights
         )
 
     return fragments
@@ -367,6 +612,9 @@ def get_scale_frags_to_same_size(frags, loci_ids, out_size=-1, no_cache=False):
     else:
         out = np.zeros([len(frags), dim_x, dim_y])
 
+    # Fragments of the same shape are resampled together
+    by_shape = {}
+
     for i, frag in enumerate(frags):
         id = loci_ids[i] + '.' + '.'.join(map(str, out.shape[1:]))
 
@@ -380,31 +628,22 @@ def get_scale_frags_to_same_size(frags, loci_ids, out_size=-1, no_cache=False):
             except:
                 pass
 
-        if is_image:
-            f_dim_y, f_dim_x, _ = frag.shape  # from PIL.Image
-            scaledFrag = np.zeros((dim_y, dim_x, 3), float)
-        else:
-            f_dim_x, f_dim_y = frag.shape
-            scaledFrag = np.zeros((dim_x, dim_y), float)
-
-        # Downsample
-        # if f_dim_x > dim_x or f_dim_y > dim_y:
+        by_shape.setdefault(frag.shape, []).append(i)
 
-        # stupid zoom doesn't accept the final shape. Carefully crafting
-        # the multipliers to make sure that it will work.
-        zoomMultipliers = np.array(scaledFrag.shape) / np.array(frag.shape)
-        frag = zoom(frag, zoomMultipliers, order=1)
+    for idx in by_shape.values():
+        scaled = resample_stack(
+            [frags[i][..., :3] if is_image else frags[i] for i in idx],
+            out.shape[1:3]
+        )
 
-        # frag = scaledFrag + zoomArray(frag,
-        #     frag, scaledFrag.shape, order=1
-        # )
+        for i, frag in zip(idx, scaled):
+            if not no_cache:
+                id = loci_ids[i] + '.' + '.'.join(map(str, out.shape[1:]))
+                with BytesIO() as b:
+                    np.save(b, frag)
+                    rdb.set('im_snip_ds_%s' % id, b.getvalue(), 60 * 30)
 
-        if not no_cache:
-            with BytesIO() as b:
-                np.save(b, frag)
-                rdb.set('im_snip_ds_%s' % id, b.getvalue(), 60 * 30)
-
-        out[i] = frag
+            out[i] = frag
 
     return out, largest_frag_idx, smallest_frag_idx
 
@@ -522,6 +761,8 @@ def aggregate_frags(
     """
     out, _, _ = get_scale_frags_to_same_size(frags, loci_ids, -1, True)
 
+    previews = None
+
     if max_previews > 0:
         if len(frags) > max_previews:
             clusters = KMeans(n_clusters=max_previews, random_state=0).fit(
@@ -543,7 +784,7 @@ def aggregate_frags(
                 )[0]
         else:
             previews = np.nanmedian(out, axis=1)
-        return aggregate, previews
+        return aggregate, previews, previews_2d
 
     elif method == 'std':
         aggregate = np.nanstd(out, axis=0)
@@ -554,7 +795,7 @@ def aggregate_frags(
                 )[0]
         else:
             previews = np.nanmedian(out, axis=1)
-        return aggregate, previews
+        return aggregate, previews, previews_2d
 
     elif method == 'var':
         aggregate = np.nanvar(out, axis=0)
@@ -565,7 +806,7 @@ def aggregate_frags(
                 )[0]
         else:
             previews = np.nanmedian(out, axis=1)
-        return aggregate, previews
+        return aggregate, previews, previews_2d
 
     elif method != 'mean':
         print('Unknown aggregation method: {}'.format(method))
@@ -591,6 +832,130 @@ def aggregate_frags(
     return aggregate, previews, previews_2d
 
 
+class FragmentAggregator:
+    """Streaming aggregation of fragments
+
+    Fragments are folded in one at a time so that the memory footprint stays
+    constant in the number of fragments. Mean, standard deviation and
+    variance are computed exactly using Welford's running sums while the
+    median is approximated from a fixed-size reservoir sample, which is exact
+    as long as no more than `reservoir_size` fragments have been added. NaN
+    values are ignored, i.e., the results equal `np.nanmean`, `np.nanstd`,
+    `np.nanvar`, and `np.nanmedian`.
+
+    Arguments:
+        method {str} -- Aggregation method. Available methods are
+            {'mean', 'median', 'std', 'var'}. (default: {'mean'})
+        shape {tuple} -- Shape of the aggregate. Fragments of a different
+            shape are rescaled. Pass the smallest shape of the fragments to
+            aggregate them like `aggregate_frags`. If `None` the shape of
+            the first fragment is used. (default: {None})
+        reservoir_size {int} -- Number of fragments to keep for the
+            approximate median. (default: {64})
+    """
+    METHODS = ('mean', 'median', 'std', 'var')
+
+    def __init__(self, method='mean', shape=None, reservoir_size=64):
+        if method not in self.METHODS:
+            logger.warn('Unknown aggregation method: {}'.format(method))
+            method = 'mean'
+
+        self.method = method
+        self.shape = tuple(shape) if shape is not None else None
+        self.reservoir_size = reservoir_size
+        self.num_frags = 0
+
+        self._count = None
+        self._mean = None
+        self._m2 = None
+        self._reservoir = None
+        self._random = np.random.RandomState(0)
+
+    def _init(self, shape):
+        self.shape = tuple(shape)
+
+        if self.method == 'median':
+            self._reservoir = np.zeros(
+                (self.reservoir_size,) + self.shape, dtype=np.float32
+            )
+        else:
+            self._count = np.zeros(self.shape, dtype=np.int64)
+            self._mean = np.zeros(self.shape)
+            self._m2 = np.zeros(self.shape)
+
+    def add(self, frag):
+        """Fold a single fragment into the aggregate
+
+        Arguments:
+            frag {np.array} -- Fragment to be added. `None` is ignored.
+        """
+        if frag is None:
+            return
+
+        frag = np.asarray(frag, dtype=np.float64)
+
+        if self.shape is None:
+            self._init(frag.shape)
+        elif self._mean is None and self._reservoir is None:
+            self._init(self.shape)
+
+        if frag.shape != self.shape:
+            frag = resample(frag, self.shape[:2]).astype(np.float64)
+
+        self.num_frags += 1
+
+        if self.method == 'median':
+            if self.num_frags <= self.reservoir_size:
+                self._reservoir[self.num_frags - 1] = frag
+            else:
+                i = self._random.randint(0, self.num_frags)
+                if i < self.reservoir_size:
+                    self._reservoir[i] = frag
+            return
+
+        valid = ~np.isnan(frag)
+        self._count += valid
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(valid, frag - self._mean, 0)
+            self._mean += np.where(valid, delta / self._count, 0)
+            self._m2 += np.where(valid, delta * (frag - self._mean), 0)
+
+    def result(self):
+        """Get the aggregate of all fragments added so far
+
+        Returns:
+            np.array -- The aggregated fragment, which is all NaN if no
+                fragments have been added, or `None` if neither fragments
+                nor a shape were given.
+        """
+        if self.num_frags == 0:
+            if self.shape is None:
+                return None
+
+            return np.full(self.shape, np.nan)
+
+        if self.method == 'median':
+            num = min(self.num_frags, self.reservoir_size)
+            return np.nanmedian(
+                self._reservoir[:num].astype(np.float64), axis=0
+            )
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            empty = self._count == 0
+
+            if self.method == 'mean':
+                out = self._mean.copy()
+            else:
+                out = self._m2 / self._count
+                if self.method == 'std':
+                    out = np.sqrt(out)
+
+        out[empty] = np.nan
+
+        return out
+
+
 def get_frag_from_image_tiles(
     tiles,
     tile_size,
@@ -617,7 +982,9 @@ def get_frag_from_image_tiles(
         i = 0
         for y in range(len(tiles_y_range)):
             for x in range(len(tiles_x_range)):
-                im.paste(tiles[i], (x * tile_size, y * tile_size))
+                # Missing tiles stay blank
+                if tiles[i] is not None:
+                    im.paste(tiles[i], (x * tile_size, y * tile_size))
                 i += 1
 
     # Convert starts and ends to local tile ids
@@ -638,15 +1005,13 @@ def get_frag_by_loc_from_imtiles(
     tile_size=256,
     no_cache=False
 ):
-    db = None
+    cache = None
     div = 1
     width = 0
     height = 0
 
     ims = []
 
-    got_info = False
-
     for locus in loci:
         id = locus[-1]
 
@@ -660,20 +1025,18 @@ def get_frag_by_loc_from_imtiles(
             except:
                 pass
 
-        if not got_info:
-            db = sqlite3.connect(imtiles_file)
-            info = db.execute('SELECT * FROM tileset_info').fetchone()
+        if cache is None:
+            # Overlapping snippets read and decode every tile only once
+            cache = imtiles.TileCache(imtiles_file)
 
-            max_zoom = info[6]
-            max_width = info[8]
-            max_height = info[9]
+            max_zoom = cache.info[6]
+            max_width = cache.info[8]
+            max_height = cache.info[9]
 
             div = 2 ** (max_zoom - zoom_level)
             width = max_width / div
             height = max_height / div
 
-            got_info = True
-
         start1 = round(locus[0] / div)
         end1 = round(locus[1] / div)
         start2 = round(locus[2] / div)
@@ -699,13 +1062,12 @@ def get_frag_by_loc_from_imtiles(
             raise SnippetTooLarge()
 
         # Extract image tiles
-        tiles = []
-        for y in tiles_y_range:
-            for x in tiles_x_range:
-                tiles.append(Image.open(BytesIO(db.execute(
-                    'SELECT image FROM tiles WHERE z=? AND y=? AND x=?',
-                    (zoom_level, y, x)
-                ).fetchone()[0])))
+        cache.load(zoom_level, tiles_x_range, tiles_y_range)
+        tiles = [
+            cache.image(zoom_level, x, y)
+            for y in tiles_y_range
+            for x in tiles_x_range
+        ]
 
         im_snip = get_frag_from_image_tiles(
             tiles,
@@ -728,9 +1090,6 @@ def get_frag_by_loc_from_imtiles(
 
         ims.append(im_snip)
 
-    if db:
-        db.close()
-
     return ims
 
 
@@ -747,11 +1106,7 @@ def get_frag_by_loc_from_osm(
 
     ims = []
 
-    prefixes = ['a', 'b', 'c']
-    prefix_idx = math.floor(random() * len(prefixes))
-    osm_src = 'http://{}.tile.openstreetmap.org'.format(prefixes[prefix_idx])
-
-    s = CacheControl(requests.Session())
+    fetcher = get_tile_fetcher()
 
     for locus in loci:
         id = locus[-1]
@@ -818,22 +1173,13 @@ def get_frag_by_loc_from_osm(
             raise SnippetTooLarge()
 
         # Extract image tiles
-        tiles = []
-        for y in tiles_y_range:
-            for x in tiles_x_range:
-                src = (
-                    '{}/{}/{}/{}.png'
-                    .format(osm_src, zoom_level, x, y)
-                )
-
-                r = s.get(src)
-
-                if r.status_code == 200:
-                    tiles.append(Image.open(
-                        BytesIO(r.content)
-                    ).convert('RGB'))
-                else:
-                    tiles.append(None)
+        tiles = [
+            Image.open(BytesIO(tile)).convert('RGB') if tile else None
+            for tile in fetcher.fetch_many(
+                zoom_level,
+                [(x, y) for y in tiles_y_range for x in tiles_x_range]
+            )
+        ]
 
         osm_snip = get_frag_from_image_tiles(
             tiles,
@@ -952,13 +1298,19 @@ def collect_frags(
     percentile=100.0,
     ignore_diags=0,
     no_normalize=False,
-    aggregate=False
+    aggregate=False,
+    aggregator=None,
+    weights=None
 ):
+    '''
+    Extract the fragments of all loci. If an `aggregator` is given the
+    fragments are folded into it one by one and an empty list is returned.
+    '''
     fragments = []
 
     for locus in loci:
         last_loc = len(locus) - 2
-        fragments.append(get_frag(
+        frag = get_frag(
             c,
             resolution,
             offsets,
@@ -968,8 +1320,14 @@ def collect_frags(
             balanced=balanced,
             percentile=percentile,
             ignore_diags=ignore_diags,
-            no_normalize=no_normalize
-        ))
+            no_normalize=no_normalize,
+            weights=weights
+        )
+
+        if aggregator is not None:
+            aggregator.add(frag)
+        else:
+            fragments.append(frag)
 
     return fragments
 
@@ -981,54 +1339,99 @@ def get_chrom(abs_pos, chr_info=None, c=None):
         except:
             return None
 
-    try:
-        chr_id = np.flatnonzero(chr_info[2] > abs_pos)[0] - 1
-    except IndexError:
+    chr_id = np.searchsorted(chr_info[2], abs_pos, side='right') - 1
+
+    if chr_id < 0 or chr_id >= len(chr_info[0]):
         return None
 
     return chr_info[0][chr_id]
 
 
 def get_chroms(abs_pos, chr_info=None, cooler_file=None, zoomout_level=-1):
-    chroms = np.zeros((abs_pos.shape[0], 2), dtype=object)
+    '''
+    Get the chromosome names of absolute positions.
 
+    Args:
+
+    abs_pos (np.array): Either a vector of positions or an n x 2 array of
+        position pairs
+    chr_info (tuple): Output of `get_chrom_names_cumul_len`
+
+    Return:
+
+    (np.array): n x 2 object array of chromosome names. For a vector of
+        positions both columns are the same. Positions outside of the
+        genome get `None`.
+    '''
     if chr_info is None:
         with h5py.File(cooler_file, 'r') as f:
             c = get_cooler(f, zoomout_level)
             chr_info = get_chrom_names_cumul_len(c)
 
-    i = 0
-    for pos in abs_pos:
-        chroms[i] = get_chrom(pos, chr_info)
-        i += 1
+    # The trailing `None` is picked for positions outside of the genome
+    names = np.array(list(chr_info[0]) + [None], dtype=object)
+
+    chr_ids = np.searchsorted(
+        chr_info[2], np.asarray(abs_pos), side='right'
+    ) - 1
+    chr_ids[(chr_ids < 0) | (chr_ids >= len(chr_info[0]))] = -1
+
+    chroms = names[chr_ids]
+
+    if chroms.ndim == 1:
+        return np.column_stack((chroms, chroms))
 
     return chroms
 
 
+LOCUS_COLS = [
+    'chrom1',
+    'start1',
+    'end1',
+    'strand1',
+    'chrom2',
+    'start2',
+    'end2',
+    'strand2'
+]
+
+
+def rel_loci_2_cols(loci_rel_chroms):
+    '''
+    Convert chromosome-relative loci into columns.
+
+    Args:
+
+    loci_rel_chroms (np.array): n x 6 array of
+        `chrom1, start1, end1, chrom2, start2, end2`
+
+    Return:
+
+    (dict): Lists of values by column name (see `LOCUS_COLS`)
+    '''
+    strand = np.where(
+        loci_rel_chroms[:, 1] < loci_rel_chroms[:, 2], 'coding', 'noncoding'
+    ).tolist()
+
+    return {
+        'chrom1': loci_rel_chroms[:, 0].tolist(),
+        'start1': loci_rel_chroms[:, 1].tolist(),
+        'end1': loci_rel_chroms[:, 2].tolist(),
+        'strand1': strand,
+        'chrom2': loci_rel_chroms[:, 3].tolist(),
+        'start2': loci_rel_chroms[:, 4].tolist(),
+        'end2': loci_rel_chroms[:, 5].tolist(),
+        'strand2': strand
+    }
+
+
 def rel_loci_2_obj(loci_rel_chroms):
-    loci = []
-
-    i = 0
-    for locus in loci_rel_chroms:
-        loci.append({
-            'chrom1': loci_rel_chroms[i, 0],
-            'start1': loci_rel_chroms[i, 1],
-            'end1': loci_rel_chroms[i, 2],
-            'strand1': (
-                'coding' if loci_rel_chroms[i, 1] < loci_rel_chroms[i, 2] else
-                'noncoding'
-            ),
-            'chrom2': loci_rel_chroms[i, 3],
-            'start2': loci_rel_chroms[i, 4],
-            'end2': loci_rel_chroms[i, 5],
-            'strand2': (
-                'coding' if loci_rel_chroms[i, 1] < loci_rel_chroms[i, 2] else
-                'noncoding'
-            )
-        })
-        i += 1
+    cols = rel_loci_2_cols(loci_rel_chroms)
 
-    return loci
+    return [
+        dict(zip(LOCUS_COLS, row))
+        for row in zip(*[cols[col] for col in LOCUS_COLS])
+    ]
 
 
 def abs_coord_2_bin(c, pos, chr_info):
@@ -1060,7 +1463,8 @@ def get_frag(
     balanced: bool = True,
     percentile: float = 100.0,
     ignore_diags: int = 0,
-    no_normalize: bool = False
+    no_normalize: bool = False,
+    weights: np.ndarray = None
 ) -> np.ndarray:
     """
     Retrieves a matrix fragment.
@@ -1104,6 +1508,9 @@ def get_frag(
         no_normalize:
             If `true` the returned matrix is not normalized.
             Defaults to `False`.
+        weights:
+            Balancing weights of all bins. Read from the cooler if not
+            given.
 
     Returns:
 
@@ -1186,18 +1593,19 @@ def get_frag(
         as_pixels=True, balance=False, max_chunk=np.inf
     )[real_start_bin1:end_bin1, real_start_bin2:end_bin2]
 
-    # Annotate pixels for balancing
-    bins = c.bins(convert_enum=False)[['weight']]
-    data = cooler.annotate(data, bins, replace=False)
-
     # Calculate relative bin IDs
     rel_bin1 = np.add(data['bin1_id'].values, -start_bin1)
     rel_bin2 = np.add(data['bin2_id'].values, -start_bin2)
 
     # Balance counts
     if balanced:
+        if weights is None:
+            weights = c.bins(convert_enum=False)['weight'][:].values
+
         values = data['count'].values.astype(np.float32)
-        values *= data['weight1'].values * data['weight2'].values
+        values *= (
+            weights[data['bin1_id'].values] * weights[data['bin2_id'].values]
+        )
     else:
         values = data['count'].values
 
@@ -1242,10 +1650,7 @@ def get_frag(
     scaled = False
     scale_x = width / frag.shape[0]
     if frag.shape[0] > width or frag.shape[1] > height:
-        scaledFrag = np.zeros((width, height), float)
-        frag = scaledFrag + zoomArray(
-            frag, scaledFrag.shape, order=1
-        )
+        frag = resample(frag, (width, height))
         scaled = True
 
     # Normalize by minimum
@@ -1330,70 +1735,3 @@ def get_frag(
 
     return frag
 
-
-def zoomArray(
-    inArray, finalShape, sameSum=False, zoomFunction=zoom, **zoomKwargs
-):
-    """
-    Normally, one can use scipy.ndimage.zoom to do array/image rescaling.
-    However, scipy.ndimage.zoom does not coarsegrain images well. It basically
-    takes nearest neighbor, rather than averaging all the pixels, when
-    coarsegraining arrays. This increases noise. Photoshop doesn't do that, and
-    performs some smart interpolation-averaging instead.
-
-    If you were to coarsegrain an array by an integer factor, e.g. 100x100 ->
-    25x25, you just need to do block-averaging, that's easy, and it reduces
-    noise. But what if you want to coarsegrain 100x100 -> 30x30?
-
-    Then my friend you are in trouble. But this function will help you. This
-    function will blow up your 100x100 array to a 120x120 array using
-    scipy.ndimage zoom Then it will coarsegrain a 120x120 array by
-    block-averaging in 4x4 chunks.
-
-    It will do it independently for each dimension, so if you want a 100x100
-    array to become a 60x120 array, it will blow up the first and the second
-    dimension to 120, and then block-average only the first dimension.
-
-    Parameters
-    ----------
-
-    inArray: n-dimensional numpy array (1D also works)
-    finalShape: resulting shape of an array
-    sameSum: bool, preserve a sum of the array, rather than values.
-             by default, values are preserved
-    zoomFunction: by default, scipy.ndimage.zoom. You can plug your own.
-    zoomKwargs:  a dict of options to pass to zoomFunction.
-    """
-    inArray = np.asarray(inArray, dtype=np.double)
-    inShape = inArray.shape
-    assert len(inShape) == len(finalShape)
-    mults = []  # multipliers for the final coarsegraining
-    for i in range(len(inShape)):
-        if finalShape[i] < inShape[i]:
-            mults.append(int(np.ceil(inShape[i] / finalShape[i])))
-        else:
-            mults.append(1)
-    # shape to which to blow up
-    tempShape = tuple([i * j for i, j in zip(finalShape, mults)])
-
-    # stupid zoom doesn't accept the final shape. Carefully crafting the
-    # multipliers to make sure that it will work.
-    zoomMultipliers = np.array(tempShape) / np.array(inShape) + 0.0000001
-    assert zoomMultipliers.min() >= 1
-
-    # applying zoom
-    rescaled = zoomFunction(inArray, zoomMultipliers, **zoomKwargs)
-
-    for ind, mult in enumerate(mults):
-        if mult != 1:
-            sh = list(rescaled.shape)
-            assert sh[ind] % mult == 0
-            newshape = sh[:ind] + [sh[ind] // mult, mult] + sh[ind + 1:]
-            rescaled.shape = newshape
-            rescaled = np.mean(rescaled, axis=ind + 1)
-    assert rescaled.shape == finalShape
-
-    if sameSum:
-        extraSize = np.prod(finalShape) / np.prod(inShape)
-        rescaled /= extraSize
-    return rescaled
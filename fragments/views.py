@@ -26,22 +26,28 @@ from fragments.utils import (
     calc_measure_noise,
     calc_measure_sharpness,
     aggregate_frags,
+    FragmentAggregator,
     get_frag_by_loc_from_cool,
     get_frag_by_loc_from_imtiles,
     get_frag_by_loc_from_osm,
     get_intra_chr_loops_from_looplist,
     get_params,
     get_rep_frags,
+    parse_bool,
+    rel_loci_2_cols,
     rel_loci_2_obj,
     np_to_png,
-    write_png,
+    encode_image,
     grey_to_rgb,
-    blob_to_zip
+    blob_to_zip_stream,
+    arrays_to_multipart,
+    np_to_dense,
+    to_dense_dtype,
+    IMAGE_CONTENT_TYPES
 )
-from higlass_server.utils import getRdb
+from higlass_server.utils import SingleFlight, getRdb
 from fragments.exceptions import SnippetTooLarge
-
-import h5py
+from tilesets import cooler_cache
 
 from math import floor, log
 
@@ -142,8 +148,16 @@ GET_FRAG_PARAMS = {
         'dtype': 'str',
         'default': 'matrix',
         'help': (
-            'Data encoding: matrix, b64, or image. (Image encoding only '
-            'supported when one fragment is to be returned)'
+            'Data encoding: matrix, b64, dense, binary, or image. (Image '
+            'encoding returns a ZIP archive for multiple fragments)'
+        )
+    },
+    'image-format': {
+        'short': 'if',
+        'dtype': 'str',
+        'default': 'png',
+        'help': (
+            'Image format when the encoding is image: png, webp, or jpeg.'
         )
     },
     'representatives': {
@@ -171,6 +185,17 @@ def get_fragments_by_loci_info(request):
     return JsonResponse(GET_FRAG_PARAMS)
 
 
+def get_cached_results(key):
+    try:
+        results = rdb.get(key)
+        if results:
+            return pickle.loads(results)
+    except:
+        pass
+
+    return None
+
+
 def get_fragments_by_loci(request):
     '''
     Retrieve a list of locations and return the corresponding matrix fragments
@@ -236,8 +261,17 @@ def get_fragments_by_loci(request):
     aggregation_method = params['aggregation-method']
     max_previews = params['max-previews']
     encoding = params['encoding']
+    image_format = params['image-format'].lower()
     representatives = params['representatives']
 
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+
+    if encoding == 'image' and image_format not in IMAGE_CONTENT_TYPES:
+        return JsonResponse({
+            'error': 'Unsupported image format: {}'.format(image_format),
+        }, status=400)
+
     # Check if requesting a snippet from a `.cool` cooler file
     is_cool = len(loci) and len(loci[0]) > 7
     tileset_idx = 6 if is_cool else 4
@@ -253,6 +287,9 @@ def get_fragments_by_loci(request):
     total_valid_loci = 0
     loci_lists = {}
     loci_ids = []
+    # Cooler fragments are `out_dim` pixels wide and aggregated at the
+    # smallest size
+    min_out_dim = None
     try:
         for locus in loci:
             tileset_file = ''
@@ -304,6 +341,9 @@ def get_fragments_by_loci(request):
                 else None
             )
             out_dim = dims if inset_dim is None else inset_dim
+            min_out_dim = (
+                out_dim if min_out_dim is None else min(min_out_dim, out_dim)
+            )
 
             # Make sure out dim (in pixel) is not too large
             if (
@@ -322,35 +362,32 @@ def get_fragments_by_loci(request):
                 # Get max abs dim in base pairs
                 max_abs_dim = max(locus[2] - locus[1], locus[5] - locus[4])
 
-                with h5py.File(tileset_file, 'r') as f:
-                    # get base resolution (bin size) of cooler file
-                    if 'resolutions' in f:
-                        # v2
-                        resolutions = sorted(
-                            [int(key) for key in f['resolutions'].keys()]
-                        )
-                        closest_res = 0
-                        for i, res in enumerate(resolutions):
-                            if (max_abs_dim / out_dim) - res < 0:
-                                closest_res = resolutions[max(0, i - 1)]
-                                break
-                        zoomout_level = (
-                            locus[zoom_level_idx]
-                            if locus[zoom_level_idx] >= 0
-                            else closest_res
-                        )
-                    else:
-                        # v1
-                        max_zoom = f.attrs['max-zoom']
-                        bin_size = int(f[str(max_zoom)].attrs['bin-size'])
-
-                        # Find closest zoom level if `zoomout_level < 0`
-                        # Assuming resolutions of powers of 2
-                        zoomout_level = (
-                            locus[zoom_level_idx]
-                            if locus[zoom_level_idx] >= 0
-                            else floor(log((max_abs_dim / bin_size) / out_dim, 2))
-                        )
+                layout = cooler_cache.get_layout(tileset_file)
+
+                # get base resolution (bin size) of cooler file
+                if layout.version == 2:
+                    resolutions = layout.resolutions
+                    closest_res = 0
+                    for i, res in enumerate(resolutions):
+                        if (max_abs_dim / out_dim) - res < 0:
+                            closest_res = resolutions[max(0, i - 1)]
+                            break
+                    zoomout_level = (
+                        locus[zoom_level_idx]
+                        if locus[zoom_level_idx] >= 0
+                        else closest_res
+                    )
+                else:
+                    # v1
+                    bin_size = cooler_cache.get_meta(tileset_file).resolution
+
+                    # Find closest zoom level if `zoomout_level < 0`
+                    # Assuming resolutions of powers of 2
+                    zoomout_level = (
+                        locus[zoom_level_idx]
+                        if locus[zoom_level_idx] >= 0
+                        else floor(log((max_abs_dim / bin_size) / out_dim, 2))
+                    )
 
             else:
                 # Get max abs dim in base pairs
@@ -418,198 +455,273 @@ def get_fragments_by_loci(request):
         str(aggregation_method) +
         str(max_previews) +
         str(encoding) +
+        str(image_format) +
         str(representatives)
     )
     uuid = hashlib.md5(dump.encode('utf-8')).hexdigest()
 
     # Check if something is cached
     if not no_cache:
-        try:
-            results = rdb.get('frag_by_loci_%s' % uuid)
-            if results:
-                return JsonResponse(pickle.loads(results))
-        except:
-            pass
-
-    matrices = [None] * total_valid_loci
-    data_types = [None] * total_valid_loci
-    try:
-        for dataset in loci_lists:
-            for zoomout_level in loci_lists[dataset]:
-                if filetype == 'cooler' or filetype == 'cool':
-                    raw_matrices = get_frag_by_loc_from_cool(
-                        dataset,
-                        loci_lists[dataset][zoomout_level],
-                        dims,
-                        zoomout_level=zoomout_level,
-                        balanced=not no_balance,
-                        padding=int(padding),
-                        percentile=percentile,
-                        ignore_diags=ignore_diags,
-                        no_normalize=no_normalize,
-                        aggregate=aggregate,
-                    )
+        results = get_cached_results('frag_by_loci_%s' % uuid)
+        if results:
+            return fragments_response(
+                results, encoding, image_format, no_cache
+            )
 
-                    for i, matrix in enumerate(raw_matrices):
-                        idx = loci_lists[dataset][zoomout_level][i][6]
-                        matrices[idx] = matrix
-                        data_types[idx] = 'matrix'
+    # Identical concurrent requests are only computed once unless they
+    # bypass the cache
+    with SingleFlight(
+        rdb, 'frag_by_loci_%s' % uuid, enabled=not no_cache
+    ) as flight:
+        # The results might have been computed while waiting
+        if not no_cache:
+            results = (
+                flight.value or get_cached_results('frag_by_loci_%s' % uuid)
+            )
+            if results:
+                return fragments_response(
+                    results, encoding, image_format, no_cache
+                )
 
-                if filetype == 'imtiles' or filetype == 'osm-image':
-                    extractor = (
-                        get_frag_by_loc_from_imtiles
-                        if filetype == 'imtiles'
-                        else get_frag_by_loc_from_osm
-                    )
+        # Without previews the cooler fragments can be aggregated while they
+        # are being extracted so we never have to hold all of them in memory.
+        # The size of image fragments is only known after extracting them.
+        aggregator = None
+        if (
+            aggregate and max_previews == 0 and total_valid_loci > 1 and
+            filetype in ('cooler', 'cool')
+        ):
+            aggregator = FragmentAggregator(
+                aggregation_method, shape=(min_out_dim, min_out_dim)
+            )
 
-                    sub_ims = extractor(
-                        imtiles_file=dataset,
-                        loci=loci_lists[dataset][zoomout_level],
-                        zoom_level=zoomout_level,
-                        padding=float(padding),
-                        no_cache=no_cache,
-                    )
+        matrices = [None] * total_valid_loci
+        data_types = [None] * total_valid_loci
+        try:
+            for dataset in loci_lists:
+                for zoomout_level in loci_lists[dataset]:
+                    if filetype == 'cooler' or filetype == 'cool':
+                        raw_matrices = get_frag_by_loc_from_cool(
+                            dataset,
+                            loci_lists[dataset][zoomout_level],
+                            dims,
+                            zoomout_level=zoomout_level,
+                            balanced=not no_balance,
+                            padding=int(padding),
+                            percentile=percentile,
+                            ignore_diags=ignore_diags,
+                            no_normalize=no_normalize,
+                            aggregate=aggregate,
+                            aggregator=aggregator,
+                        )
 
-                    for i, im in enumerate(sub_ims):
-                        idx = loci_lists[dataset][zoomout_level][i][4]
+                        for i, matrix in enumerate(raw_matrices):
+                            idx = loci_lists[dataset][zoomout_level][i][6]
+                            matrices[idx] = matrix
+                            data_types[idx] = 'matrix'
 
-                        matrices[idx] = im
+                    if filetype == 'imtiles' or filetype == 'osm-image':
+                        extractor = (
+                            get_frag_by_loc_from_imtiles
+                            if filetype == 'imtiles'
+                            else get_frag_by_loc_from_osm
+                        )
 
-                        data_types[idx] = 'matrix'
+                        sub_ims = extractor(
+                            imtiles_file=dataset,
+                            loci=loci_lists[dataset][zoomout_level],
+                            zoom_level=zoomout_level,
+                            padding=float(padding),
+                            no_cache=no_cache,
+                        )
 
-    except Exception as ex:
-        raise
-        return JsonResponse({
-            'error': 'Could not retrieve fragments.',
-            'error_message': str(ex)
-        }, status=500)
+                        for i, im in enumerate(sub_ims):
+                            idx = loci_lists[dataset][zoomout_level][i][4]
+                            matrices[idx] = im
+                            data_types[idx] = 'matrix'
 
-    if aggregate and len(matrices) > 1:
-        try:
-            cover, previews_1d, previews_2d = aggregate_frags(
-                matrices,
-                loci_ids,
-                aggregation_method,
-                max_previews,
-            )
-            matrices = [cover]
-            mat_idx = []
-            if previews_1d is not None:
-                previews = np.split(
-                    previews_1d, range(1, previews_1d.shape[0])
-                )
-            data_types = [data_types[0]]
         except Exception as ex:
             raise
             return JsonResponse({
-                'error': 'Could not aggregate fragments.',
+                'error': 'Could not retrieve fragments.',
                 'error_message': str(ex)
             }, status=500)
 
-    if representatives and len(matrices) > 1:
-        if forced_rep_idx and len(forced_rep_idx) <= len(matrices):
-            matrices = [matrices[i] for i in forced_rep_idx]
-            mat_idx = forced_rep_idx
-            data_types = [data_types[0]] * len(forced_rep_idx)
-        else:
+        if aggregator is not None:
+            matrices = [aggregator.result()]
+            mat_idx = []
+            data_types = [data_types[0]]
+        elif aggregate and len(matrices) > 1:
             try:
-                rep_frags, rep_idx = get_rep_frags(
-                    matrices, loci, loci_ids, representatives, no_cache
+                cover, previews_1d, previews_2d = aggregate_frags(
+                    matrices,
+                    loci_ids,
+                    aggregation_method,
+                    max_previews,
                 )
-                matrices = rep_frags
-                mat_idx = rep_idx
-                data_types = [data_types[0]] * len(rep_frags)
+                matrices = [cover]
+                mat_idx = []
+                if previews_1d is not None:
+                    previews = np.split(
+                        previews_1d, range(1, previews_1d.shape[0])
+                    )
+                data_types = [data_types[0]]
             except Exception as ex:
                 raise
                 return JsonResponse({
-                    'error': 'Could get representative fragments.',
+                    'error': 'Could not aggregate fragments.',
                     'error_message': str(ex)
                 }, status=500)
 
-    if encoding != 'b64' and encoding != 'image':
-        # Adjust precision and convert to list
-        for i, matrix in enumerate(matrices):
-            if precision > 0:
-                matrix = np.round(matrix, decimals=precision)
-            matrices[i] = matrix.tolist()
-
-        if max_previews > 0:
-            for i, preview in enumerate(previews):
-                previews[i] = preview.tolist()
-            for i, preview_2d in enumerate(previews_2d):
-                previews_2d[i] = preview_2d.tolist()
-
-    # Encode matrix if required
-    if encoding == 'b64':
-        for i, matrix in enumerate(matrices):
-            id = loci_ids[mat_idx[i]]
-            data_types[i] = 'dataUrl'
-            if not no_cache and id:
-                mat_b64 = None
+        if representatives and len(matrices) > 1:
+            if forced_rep_idx and len(forced_rep_idx) <= len(matrices):
+                matrices = [matrices[i] for i in forced_rep_idx]
+                mat_idx = forced_rep_idx
+                data_types = [data_types[0]] * len(forced_rep_idx)
+            else:
                 try:
-                    mat_b64 = rdb.get('im_b64_%s' % id)
-                    if mat_b64 is not None:
-                        matrices[i] = mat_b64.decode('ascii')
-                        continue
-                except:
-                    pass
+                    rep_frags, rep_idx = get_rep_frags(
+                        matrices, loci, loci_ids, representatives, no_cache
+                    )
+                    matrices = rep_frags
+                    mat_idx = rep_idx
+                    data_types = [data_types[0]] * len(rep_frags)
+                except Exception as ex:
+                    raise
+                    return JsonResponse({
+                        'error': 'Could get representative fragments.',
+                        'error_message': str(ex)
+                    }, status=500)
 
-            mat_b64 = pybase64.b64encode(np_to_png(matrix)).decode('ascii')
+        if encoding in ('dense', 'binary'):
+            # Raw float16 or float32 arrays either as base64 or as parts of
+            # a multipart response
+            encode = np_to_dense if encoding == 'dense' else to_dense_dtype
 
-            if not no_cache:
-                try:
-                    rdb.set('im_b64_%s' % id, mat_b64, 60 * 30)
-                except Exception as ex:
-                    # error caching a tile
-                    # log the error and carry forward, this isn't critical
-                    logger.warn(ex)
+            matrices = [encode(matrix) for matrix in matrices]
 
-            matrices[i] = mat_b64
+            if max_previews > 0:
+                previews = [encode(preview) for preview in previews]
+                previews_2d = [encode(preview) for preview in previews_2d]
 
-        if max_previews > 0:
-            for i, preview in enumerate(previews):
-                previews[i] = pybase64.b64encode(
-                    np_to_png(preview)
-                ).decode('ascii')
-            for i, preview_2d in enumerate(previews_2d):
-                previews_2d[i] = pybase64.b64encode(
-                    np_to_png(preview_2d)
+        elif encoding != 'b64' and encoding != 'image':
+            # Adjust precision and convert to list
+            for i, matrix in enumerate(matrices):
+                if precision > 0:
+                    matrix = np.round(matrix, decimals=precision)
+                matrices[i] = matrix.tolist()
+
+            if max_previews > 0:
+                for i, preview in enumerate(previews):
+                    previews[i] = preview.tolist()
+                for i, preview_2d in enumerate(previews_2d):
+                    previews_2d[i] = preview_2d.tolist()
+
+        # Encode matrix if required
+        if encoding == 'b64':
+            for i, matrix in enumerate(matrices):
+                id = loci_ids[mat_idx[i]]
+                data_types[i] = 'dataUrl'
+                if not no_cache and id:
+                    mat_b64 = None
+                    try:
+                        mat_b64 = rdb.get('im_b64_%s' % id)
+                        if mat_b64 is not None:
+                            matrices[i] = mat_b64.decode('ascii')
+                            continue
+                    except:
+                        pass
+
+                mat_b64 = pybase64.b64encode(
+                    np_to_png(matrix)
                 ).decode('ascii')
 
-    # Create results
-    results = {
-        'fragments': matrices,
-        'indices': [int(i) for i in mat_idx],
-        'dataTypes': data_types,
-    }
-
-    # Return Y aggregates as 1D previews on demand
-    if max_previews > 0:
-        results['previews'] = previews
-        results['previews2d'] = previews_2d
-
-    # Cache results for 30 minutes
-    try:
-        rdb.set('frag_by_loci_%s' % uuid, pickle.dumps(results), 60 * 30)
-    except Exception as ex:
-        # error caching a tile
-        # log the error and carry forward, this isn't critical
-        logger.warn(ex)
+                if not no_cache:
+                    try:
+                        rdb.set('im_b64_%s' % id, mat_b64, 60 * 30)
+                    except Exception as ex:
+                        # error caching a tile
+                        # log the error and carry forward, this isn't critical
+                        logger.warn(ex)
+
+                matrices[i] = mat_b64
+
+            if max_previews > 0:
+                for i, preview in enumerate(previews):
+                    previews[i] = pybase64.b64encode(
+                        np_to_png(preview)
+                    ).decode('ascii')
+                for i, preview_2d in enumerate(previews_2d):
+                    previews_2d[i] = pybase64.b64encode(
+                        np_to_png(preview_2d)
+                    ).decode('ascii')
+
+        # Create results
+        results = {
+            'fragments': matrices,
+            'indices': [int(i) for i in mat_idx],
+            'dataTypes': data_types,
+        }
+
+        # Return Y aggregates as 1D previews on demand
+        if max_previews > 0:
+            results['previews'] = previews
+            results['previews2d'] = previews_2d
+
+        # Cache results for 30 minutes
+        try:
+            rdb.set('frag_by_loci_%s' % uuid, pickle.dumps(results), 60 * 30)
+        except Exception as ex:
+            # error caching a tile
+            # log the error and carry forward, this isn't critical
+            logger.warn(ex)
+
+        flight.value = results
+
+    return fragments_response(results, encoding, image_format, no_cache)
+
+
+def fragments_response(results, encoding, image_format, no_cache=False):
+    matrices = results['fragments']
 
     if encoding == 'image':
         if len(matrices) == 1:
             return HttpResponse(
-                np_to_png(grey_to_rgb(matrices[0], to_rgba=True)),
-                content_type='image/png'
+                encode_image(
+                    grey_to_rgb(matrices[0], to_rgba=True),
+                    image_format,
+                    no_cache=no_cache
+                ),
+                content_type=IMAGE_CONTENT_TYPES[image_format]
             )
         else:
-            ims = []
-            for i, matrix in enumerate(matrices):
-                ims.append({
-                    'name': '{}.png'.format(i),
-                    'bytes': np_to_png(grey_to_rgb(matrix, to_rgba=True))
-                })
-            return blob_to_zip(ims, to_resp=True)
+            return blob_to_zip_stream(
+                [
+                    ('{}.{}'.format(i, image_format), matrix)
+                    for i, matrix in enumerate(matrices)
+                ],
+                lambda matrix: encode_image(
+                    grey_to_rgb(matrix, to_rgba=True),
+                    image_format,
+                    no_cache=no_cache
+                )
+            )
+
+    if encoding == 'binary':
+        # The arrays follow the JSON header in the order of the fragments,
+        # previews, and 2D previews
+        arrays = []
+        header = dict(results)
+
+        for key in ['fragments', 'previews', 'previews2d']:
+            if key in results:
+                arrays += results[key]
+                header[key] = [
+                    {'dtype': str(arr.dtype), 'shape': list(arr.shape)}
+                    for arr in results[key]
+                ]
+
+        return arrays_to_multipart(header, arrays)
 
     return JsonResponse(results)
 
@@ -680,137 +792,148 @@ def fragments_by_chr(request):
 
     # Check if something is cached
     if not no_cache:
-        try:
-            results = rdb.get('frag_by_chrom_%s' % uuid)
-
+        results = get_cached_results('frag_by_chrom_%s' % uuid)
+        if results:
+            return JsonResponse(results)
+
+    # Identical concurrent requests are only computed once unless they
+    # bypass the cache
+    with SingleFlight(
+        rdb, 'frag_by_chrom_%s' % uuid, enabled=not no_cache
+    ) as flight:
+        # The results might have been computed while waiting
+        if not no_cache:
+            results = (
+                flight.value or get_cached_results('frag_by_chrom_%s' % uuid)
+            )
             if results:
-                return JsonResponse(pickle.loads(results))
-        except:
-            pass
-
-    # Get relative loci
-    try:
-        (loci_rel, chroms) = get_intra_chr_loops_from_looplist(
-            path.join('data', loop_list), chrom
-        )
-    except Exception as e:
-        return JsonResponse({
-            'error': 'Could not retrieve loci.',
-            'error_message': str(e)
-        }, status=500)
+                return JsonResponse(results)
 
-    # Convert to chromosome-relative loci list
-    loci_rel_chroms = np.column_stack(
-        (chroms[:, 0], loci_rel[:, 0:2], chroms[:, 1], loci_rel[:, 2:4])
-    )
-
-    if limit > 0:
-        loci_rel_chroms = loci_rel_chroms[:limit]
+        # Get relative loci
+        try:
+            (loci_rel, chroms) = get_intra_chr_loops_from_looplist(
+                path.join('data', loop_list), chrom
+            )
+        except Exception as e:
+            return JsonResponse({
+                'error': 'Could not retrieve loci.',
+                'error_message': str(e)
+            }, status=500)
 
-    # Get fragments
-    try:
-        matrices = get_frag_by_loc(
-            cooler_file,
-            loci_rel_chroms,
-            zoomout_level=zoomout_level
+        # Convert to chromosome-relative loci list
+        loci_rel_chroms = np.column_stack(
+            (chroms[:, 0], loci_rel[:, 0:2], chroms[:, 1], loci_rel[:, 2:4])
         )
-    except Exception as e:
-        return JsonResponse({
-            'error': 'Could not retrieve fragments.',
-            'error_message': str(e)
-        }, status=500)
 
-    if precision > 0:
-        matrices = np.around(matrices, decimals=precision)
+        if limit > 0:
+            loci_rel_chroms = loci_rel_chroms[:limit]
 
-    fragments = []
+        # Get fragments
+        try:
+            matrices = get_frag_by_loc(
+                cooler_file,
+                loci_rel_chroms,
+                zoomout_level=zoomout_level
+            )
+        except Exception as e:
+            return JsonResponse({
+                'error': 'Could not retrieve fragments.',
+                'error_message': str(e)
+            }, status=500)
 
-    loci_struct = rel_loci_2_obj(loci_rel_chroms)
+        if precision > 0:
+            matrices = np.around(matrices, decimals=precision)
 
-    # Check supported measures
-    measures_applied = []
-    for measure in measures:
-        if measure in SUPPORTED_MEASURES:
-            measures_applied.append(measure)
+        fragments = []
 
-    i = 0
-    for matrix in matrices:
-        measures_values = []
+        loci_struct = rel_loci_2_obj(loci_rel_chroms)
 
+        # Check supported measures
+        measures_applied = []
         for measure in measures:
-            if measure == 'distance-to-diagonal':
-                measures_values.append(
-                    calc_measure_dtd(matrix, loci_struct[i])
-                )
+            if measure in SUPPORTED_MEASURES:
+                measures_applied.append(measure)
 
-            if measure == 'size':
-                measures_values.append(
-                    calc_measure_size(matrix, loci_struct[i])
-                )
+        i = 0
+        for matrix in matrices:
+            measures_values = []
 
-            if measure == 'noise':
-                measures_values.append(calc_measure_noise(matrix))
+            for measure in measures:
+                if measure == 'distance-to-diagonal':
+                    measures_values.append(
+                        calc_measure_dtd(matrix, loci_struct[i])
+                    )
 
-            if measure == 'sharpness':
-                measures_values.append(calc_measure_sharpness(matrix))
+                if measure == 'size':
+                    measures_values.append(
+                        calc_measure_size(matrix, loci_struct[i])
+                    )
 
-        frag_obj = {
-            # 'matrix': matrix.tolist()
+                if measure == 'noise':
+                    measures_values.append(calc_measure_noise(matrix))
+
+                if measure == 'sharpness':
+                    measures_values.append(calc_measure_sharpness(matrix))
+
+            frag_obj = {
+                # 'matrix': matrix.tolist()
+            }
+
+            frag_obj.update(loci_struct[i])
+            frag_obj.update({
+                "measures": measures_values
+            })
+            fragments.append(frag_obj)
+            i += 1
+
+        # Create results
+        results = {
+            'count': matrices.shape[0],
+            'dims': matrices.shape[1],
+            'fragments': fragments,
+            'measures': measures_applied,
+            'relativeLoci': True,
+            'zoomoutLevel': zoomout_level
         }
 
-        frag_obj.update(loci_struct[i])
-        frag_obj.update({
-            "measures": measures_values
-        })
-        fragments.append(frag_obj)
-        i += 1
+        if for_config:
+            results['fragmentsHeader'] = [
+                'chrom1',
+                'start1',
+                'end1',
+                'strand1',
+                'chrom2',
+                'start2',
+                'end2',
+                'strand2'
+            ] + measures_applied
+
+            fragments_arr = []
+            for fragment in fragments:
+                tmp = [
+                    fragment['chrom1'],
+                    fragment['start1'],
+                    fragment['end1'],
+                    fragment['strand1'],
+                    fragment['chrom2'],
+                    fragment['start2'],
+                    fragment['end2'],
+                    fragment['strand2'],
+                ] + fragment['measures']
+
+                fragments_arr.append(tmp)
+
+            results['fragments'] = fragments_arr
+
+        # Cache results for 30 mins
+        try:
+            rdb.set('frag_by_chrom_%s' % uuid, pickle.dumps(results), 60 * 30)
+        except Exception as ex:
+            # error caching a tile
+            # log the error and carry forward, this isn't critical
+            logger.warn(ex)
 
-    # Create results
-    results = {
-        'count': matrices.shape[0],
-        'dims': matrices.shape[1],
-        'fragments': fragments,
-        'measures': measures_applied,
-        'relativeLoci': True,
-        'zoomoutLevel': zoomout_level
-    }
-
-    if for_config:
-        results['fragmentsHeader'] = [
-            'chrom1',
-            'start1',
-            'end1',
-            'strand1',
-            'chrom2',
-            'start2',
-            'end2',
-            'strand2'
-        ] + measures_applied
-
-        fragments_arr = []
-        for fragment in fragments:
-            tmp = [
-                fragment['chrom1'],
-                fragment['start1'],
-                fragment['end1'],
-                fragment['strand1'],
-                fragment['chrom2'],
-                fragment['start2'],
-                fragment['end2'],
-                fragment['strand2'],
-            ] + fragment['measures']
-
-            fragments_arr.append(tmp)
-
-        results['fragments'] = fragments_arr
-
-    # Cache results for 30 mins
-    try:
-        rdb.set('frag_by_chrom_%s' % uuid, pickle.dumps(results), 60 * 30)
-    except Exception as ex:
-        # error caching a tile
-        # log the error and carry forward, this isn't critical
-        logger.warn(ex)
+        flight.value = results
 
     return JsonResponse(results)
 
@@ -821,6 +944,8 @@ def loci(request):
     chrom = request.GET.get('chrom', False)
     loop_list = request.GET.get('loop-list', False)
 
+    columnar = parse_bool(request.GET.get('columnar', False))
+
     # Get relative loci
     (loci_rel, chroms) = get_intra_chr_loops_from_looplist(
         path.join('data', loop_list), chrom
@@ -831,8 +956,13 @@ def loci(request):
     )
 
     # Create results
-    results = {
-        'loci': rel_loci_2_obj(loci_rel_chroms)
-    }
+    if columnar:
+        results = {
+            'loci': rel_loci_2_cols(loci_rel_chroms)
+        }
+    else:
+        results = {
+            'loci': rel_loci_2_obj(loci_rel_chroms)
+        }
 
     return JsonResponse(results)
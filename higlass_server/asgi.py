@@ -0,0 +1,197 @@
+"""
+ASGI config for the HiGlass server.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+and can be served by any ASGI server, e.g.:
+
+    uvicorn higlass_server.asgi:application
+
+Django 2.1 has no async views, so requests are handled by the regular WSGI
+application on a bounded thread pool (``ASGI_THREADS``). The event loop only
+takes care of the connections, which lets a single process keep hundreds of
+requests in flight while the threads block on file reads and Redis.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "higlass_server.settings")
+
+import higlass_server.settings as hss  # noqa: E402
+
+# Request bodies larger than this are spooled to disk
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+
+def build_environ(scope, body):
+    '''
+    Build the WSGI environ of an ASGI HTTP request.
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI wants the raw bytes of the path decoded as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_{}'.format(name)
+
+        if key in environ:
+            value = '{},{}'.format(environ[key], value)
+
+        environ[key] = value
+
+    return environ
+
+
+class WsgiToAsgi:
+    '''
+    Serve a WSGI application over ASGI. Every request is run on a thread
+    of a bounded pool and the response is streamed back chunk by chunk, so
+    that streaming responses (e.g., ZIP downloads) stay streaming.
+
+    Args:
+
+    wsgi_application (callable): The WSGI application
+    max_workers (int): Max number of requests handled at the same time
+    '''
+    def __init__(self, wsgi_application, max_workers=None):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or hss.ASGI_THREADS
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope type {}'.format(scope['type']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+
+            body.write(message.get('body', b''))
+
+            if not message.get('more_body', False):
+                break
+
+        body.seek(0)
+
+        loop = asyncio.get_event_loop()
+
+        try:
+            await loop.run_in_executor(
+                self.executor,
+                self.run_wsgi,
+                loop,
+                build_environ(scope, body),
+                send
+            )
+        finally:
+            body.close()
+
+    def run_wsgi(self, loop, environ, send):
+        '''
+        Run the WSGI application on the current (pool) thread and hand the
+        response over to the event loop.
+        '''
+        def send_sync(message):
+            # Wait for every chunk to be sent so that slow clients throttle
+            # the response instead of having it pile up in memory
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response_start.update({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers
+                ],
+            })
+
+        def send_start():
+            # Headers go out with the first non-empty chunk, so that errors
+            # raised before can still change them
+            if not started:
+                send_sync(response_start)
+                started.append(True)
+
+        response = self.wsgi_application(environ, start_response)
+
+        try:
+            for chunk in response:
+                if not chunk:
+                    continue
+
+                send_start()
+                send_sync({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                })
+
+            send_start()
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            # Fires Django's request_finished, which closes the DB connection
+            if hasattr(response, 'close'):
+                response.close()
+
+
+application = WsgiToAsgi(get_wsgi_application())
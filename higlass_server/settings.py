@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
+import hashlib
 import json
 import os
 import os.path as op
@@ -124,6 +125,20 @@ else:
 THUMBNAILS_ROOT = os.path.join(MEDIA_ROOT, 'thumbnails')
 AWS_BUCKET_MOUNT_POINT = os.path.join(MEDIA_ROOT, 'aws')
 THUMBNAIL_RENDER_URL_BASE = '/app/'
+# Number of thumbnails rendered at the same time by the shared browser, the
+# max number of seconds a render may take, and how long a thumbnail request
+# waits for the render before a placeholder is returned
+THUMBNAIL_RENDER_POOL_SIZE = int(get_setting('THUMBNAIL_RENDER_POOL_SIZE', 2))
+THUMBNAIL_RENDER_TIMEOUT = float(get_setting('THUMBNAIL_RENDER_TIMEOUT', 30))
+THUMBNAIL_RENDER_WAIT = float(get_setting('THUMBNAIL_RENDER_WAIT', 3))
+# Render the thumbnail of a viewconf as soon as it is saved
+THUMBNAIL_PRERENDER = get_setting('THUMBNAIL_PRERENDER', False)
+# Disk budget of the rendered thumbnails and their variants in bytes and the
+# quality of JPEG and WebP variants
+THUMBNAILS_STORE_SIZE = int(
+    get_setting('THUMBNAILS_STORE_SIZE', 256 * 1024 * 1024)
+)
+THUMBNAIL_QUALITY = int(get_setting('THUMBNAIL_QUALITY', 85))
 
 LOGGING = {
     'version': 1,
@@ -180,6 +195,61 @@ else:
     REDIS_HOST = None
     REDIS_PORT = None
 
+# Tiles are cached in a memory-mapped file shared by all processes of the
+# host in front of Redis (or instead of it if there is no Redis). A size of
+# 0 bytes disables the shared memory cache. Docker only gives containers
+# 64MB of /dev/shm unless `shm_size` is set. The file is named after the
+# base directory, so that servers on the same host don't share tiles.
+TILE_CACHE_SHM_SIZE = int(get_setting('TILE_CACHE_SHM_SIZE', 32 * 1024 * 1024))
+TILE_CACHE_SHM_PATH = get_setting(
+    'TILE_CACHE_SHM_PATH',
+    os.path.join(
+        '/dev/shm' if op.isdir('/dev/shm') else '/tmp',
+        'higlass-tiles-{}'.format(
+            hashlib.md5(BASE_DIR.encode('utf-8')).hexdigest()[:8]
+        )
+    )
+)
+
+# Seconds that tiles are kept in Redis by default and per filetype (e.g.,
+# {"cooler": 86400}). Tiles of the `TILE_CACHE_COARSE_ZOOMS` coarsest zoom
+# levels are requested the most and are kept twice as long for every level
+# closer to zoom level 0. A TTL of 0 keeps tiles until they are evicted.
+TILE_CACHE_TTL = int(get_setting('TILE_CACHE_TTL', 7 * 24 * 3600))
+TILE_CACHE_TTLS = get_setting('TILE_CACHE_TTLS', {})
+
+if isinstance(TILE_CACHE_TTLS, str):
+    TILE_CACHE_TTLS = json.loads(TILE_CACHE_TTLS)
+
+TILE_CACHE_COARSE_ZOOMS = int(get_setting('TILE_CACHE_COARSE_ZOOMS', 4))
+
+# Max bytes of tiles in Redis (0 for no limit). Every
+# `TILE_CACHE_CHECK_INTERVAL` cached tiles, the size of the cache is
+# estimated from a sample of `TILE_CACHE_SAMPLE_SIZE` random keys and the
+# sampled tiles that are closest to expiring are evicted until it fits.
+TILE_CACHE_MAX_BYTES = int(get_setting('TILE_CACHE_MAX_BYTES', 0))
+TILE_CACHE_CHECK_INTERVAL = int(get_setting('TILE_CACHE_CHECK_INTERVAL', 1000))
+TILE_CACHE_SAMPLE_SIZE = int(get_setting('TILE_CACHE_SAMPLE_SIZE', 64))
+
+# Identical concurrent requests are computed only once. Waiting requests
+# give up after `REQUEST_LOCK_WAIT` seconds and a lock whose owner died
+# expires after `REQUEST_LOCK_TIMEOUT` seconds.
+REQUEST_LOCK_TIMEOUT = float(get_setting('REQUEST_LOCK_TIMEOUT', 60))
+REQUEST_LOCK_WAIT = float(get_setting('REQUEST_LOCK_WAIT', 30))
+
+# Max age in seconds of cacheable responses (tiles, tileset info, chrom sizes
+# and viewconfs). Clients revalidate them with their ETag afterwards.
+HTTP_CACHE_MAX_AGE = int(get_setting('HTTP_CACHE_MAX_AGE', 60))
+
+# Seconds for which the modification times of tileset files are reused
+# for ETags, so that files on remote (FUSE) mounts aren't checked on every
+# request
+TILESET_MTIME_INTERVAL = float(get_setting('TILESET_MTIME_INTERVAL', 5))
+
+# Number of threads handling requests per process when served over ASGI
+# (see higlass_server/asgi.py)
+ASGI_THREADS = int(get_setting('ASGI_THREADS', 32))
+
 # DEFAULT_FILE_STORAGE = 'tilesets.storage.HashedFilenameFileSystemStorage'
 
 # Application definition
@@ -307,6 +377,54 @@ SNIPPET_IMG_MAX_OUT_DIM = get_setting('SNIPPET_IMG_MAX_OUT_DIM', 1024)
 SNIPPET_OSM_MAX_DATA_DIM = get_setting('SNIPPET_OSM_MAX_DATA_DIM', 2048)
 SNIPPET_IMT_MAX_DATA_DIM = get_setting('SNIPPET_IMT_MAX_DATA_DIM', 2048)
 
+# zlib compression level of snippet PNGs. `0` stores the pixels uncompressed,
+# which is the fastest option.
+SNIPPET_PNG_COMPRESSION = int(get_setting('SNIPPET_PNG_COMPRESSION', 5))
+# Quality of lossy snippet images (WebP and JPEG)
+SNIPPET_IMG_QUALITY = int(get_setting('SNIPPET_IMG_QUALITY', 90))
+# Number of threads encoding the images of multi-snippet ZIP downloads
+SNIPPET_ENCODING_THREADS = int(get_setting('SNIPPET_ENCODING_THREADS', 4))
+
+# Number of coolers whose metadata (offsets, chromsizes, weights, ...) is
+# kept in memory per process
+COOLER_META_CACHE_SIZE = int(get_setting('COOLER_META_CACHE_SIZE', 32))
+# Bytes of raw cooler tiles kept in memory per process. Every transform of
+# a tile is derived from its raw counts.
+COOLER_PIXEL_CACHE_SIZE = int(
+    get_setting('COOLER_PIXEL_CACHE_SIZE', 256 * 1024 * 1024)
+)
+
+# Number of rendered chrom-sizes responses kept in memory per process
+CHROMSIZES_CACHE_SIZE = int(get_setting('CHROMSIZES_CACHE_SIZE', 128))
+
+# Number of viewconfs kept in memory per process and the number of seconds
+# they are cached in memory and in Redis
+VIEWCONF_CACHE_SIZE = int(get_setting('VIEWCONF_CACHE_SIZE', 256))
+VIEWCONF_CACHE_TTL = float(get_setting('VIEWCONF_CACHE_TTL', 300))
+
+# Generate the tiles visible in the initial view of a viewconf in the
+# background as soon as it is saved. Views are assumed to be
+# `VIEWCONF_WARMUP_WIDTH` pixels wide when they span the whole page and
+# at most `VIEWCONF_WARMUP_MAX_TILES` tiles are generated per viewconf.
+VIEWCONF_WARMUP = get_setting('VIEWCONF_WARMUP', False)
+VIEWCONF_WARMUP_WIDTH = int(get_setting('VIEWCONF_WARMUP_WIDTH', 1200))
+VIEWCONF_WARMUP_MAX_TILES = int(get_setting('VIEWCONF_WARMUP_MAX_TILES', 256))
+VIEWCONF_WARMUP_THREADS = int(get_setting('VIEWCONF_WARMUP_THREADS', 2))
+
+# Upstream of OSM snippets. `{s}` is replaced with a random subdomain.
+SNIPPET_OSM_TILE_URL = get_setting(
+    'SNIPPET_OSM_TILE_URL', 'http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png'
+)
+SNIPPET_OSM_TIMEOUT = float(get_setting('SNIPPET_OSM_TIMEOUT', 10))
+SNIPPET_OSM_THREADS = int(get_setting('SNIPPET_OSM_THREADS', 8))
+# Local OSM tile store. A size of 0 bytes disables the store.
+SNIPPET_OSM_TILE_STORE_DIR = get_setting(
+    'SNIPPET_OSM_TILE_STORE_DIR', os.path.join(MEDIA_ROOT, 'osm-tiles')
+)
+SNIPPET_OSM_TILE_STORE_SIZE = int(
+    get_setting('SNIPPET_OSM_TILE_STORE_SIZE', 512 * 1024 * 1024)
+)
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
@@ -8,3 +8,9 @@ DATABASES = {
 }
 
 DEBUG = False
+
+# Tilesets of different tests share uuids, so tiles must not outlive a test
+TILE_CACHE_SHM_SIZE = 0
+
+# Tests change files in place and expect new ETags right away
+TILESET_MTIME_INTERVAL = 0
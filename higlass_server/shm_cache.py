@@ -0,0 +1,389 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Cache file layout:
+#
+#   HEADER                magic, data capacity, number of index sets and
+#                         the write position
+#   index                 `num_sets` sets of WAYS entries, see ENTRY
+#   data                  ring of records, see RECORD_HEADER
+#
+# Records are appended at the write position, which only ever grows, and
+# wrap around at the end of the ring, so the oldest records are
+# overwritten first. An index entry is valid as long as its record is
+# within the last `capacity` bytes that were written. Records are never
+# split at the end of the ring.
+MAGIC = b'HGSHMC01'
+HEADER = struct.Struct('<8sQQQ')
+# Key hash, position of the record + 1 (0 for empty entries), record size
+ENTRY = struct.Struct('<QQI')
+# Key length, value length
+RECORD_HEADER = struct.Struct('<II')
+
+WAYS = 8
+# Expected mean size of a record, which determines the number of entries
+AVERAGE_RECORD_SIZE = 4096
+# Hits on records that are about to be overwritten (in the oldest quarter
+# of the ring) append them again, so that entries which are in use stay
+# cached like with LRU eviction
+PROMOTE_FRACTION = 0.25
+# Seconds between checks whether the cache file was replaced by another
+# process
+REOPEN_INTERVAL = 1
+
+
+def key_hash(key):
+    return int.from_bytes(
+        hashlib.blake2b(key, digest_size=8).digest(), 'little'
+    )
+
+
+class SharedMemoryCache:
+    '''
+    Byte cache in a memory-mapped file that is shared by all processes on a
+    host. Placed in /dev/shm, it lives in memory and outlives the processes
+    using it. Every operation takes a lock on the file, so processes and
+    threads can use it concurrently. If the file cannot be created (e.g.,
+    because /dev/shm is too small), the cache stays empty in that process.
+
+    Args:
+
+    path (str): The cache file, which is created if it doesn't exist and
+        replaced if it was created with a different size
+    size (int): The number of bytes of keys and values to keep
+    '''
+    def __init__(self, path, size):
+        self.path = path
+        self.capacity = size
+        self.num_sets = max(1, size // (AVERAGE_RECORD_SIZE * WAYS))
+        self.index_offset = HEADER.size
+        self.data_offset = self.index_offset + self.num_sets * WAYS * ENTRY.size
+        self.file_size = self.data_offset + self.capacity
+
+        self.fd = None
+        self.mm = None
+        self._pid = None
+        self._inode = None
+        self._checked = 0
+        self._failed_pid = None
+        self._lock = threading.Lock()
+
+    def _header(self):
+        return HEADER.pack(MAGIC, self.capacity, self.num_sets, 0)
+
+    def _create(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        try:
+            # Allocate the memory up front, since running out of it in a
+            # mapped file crashes the process
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, self.file_size)
+            else:
+                os.ftruncate(fd, self.file_size)
+
+            os.pwrite(fd, self._header(), 0)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            os.close(fd)
+
+    def _is_open(self):
+        # Locks belong to the open file, so forked processes have to open
+        # the file themselves
+        if self._pid != os.getpid():
+            return False
+
+        if time.time() - self._checked < REOPEN_INTERVAL:
+            return True
+
+        # Another process might have replaced the file
+        self._checked = time.time()
+
+        try:
+            return os.stat(self.path).st_ino == self._inode
+        except FileNotFoundError:
+            return False
+
+    def _open(self):
+        if self._is_open():
+            return
+
+        if self.mm is not None:
+            self.mm.close()
+            os.close(self.fd)
+            self.mm = None
+
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR)
+            except FileNotFoundError:
+                self._create()
+                continue
+
+            stat = os.fstat(fd)
+            magic, capacity, num_sets, _ = HEADER.unpack(
+                os.pread(fd, HEADER.size, 0).ljust(HEADER.size, b'\0')
+            )
+            matches = (
+                stat.st_size == self.file_size and magic == MAGIC and
+                capacity == self.capacity and num_sets == self.num_sets
+            )
+
+            # The file might have been replaced in the meantime
+            if os.stat(self.path).st_ino == stat.st_ino:
+                if matches:
+                    break
+
+                logger.info('Replacing shared memory cache %s', self.path)
+                self._create()
+
+            os.close(fd)
+
+        self.fd = fd
+        self.mm = mmap.mmap(fd, self.file_size)
+        self._pid = os.getpid()
+        self._inode = stat.st_ino
+        self._checked = time.time()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Lock the cache for the threads of this and all other processes.
+
+        Yield:
+
+        (bool): Whether the cache can be used
+        '''
+        with self._lock:
+            if self._failed_pid == os.getpid():
+                yield False
+                return
+
+            try:
+                self._open()
+            except OSError as ex:
+                # Don't try again on every request
+                logger.warning(
+                    'Shared memory cache %s is disabled: %r', self.path, ex
+                )
+                self._failed_pid = os.getpid()
+                yield False
+                return
+
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+            try:
+                yield True
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _get_head(self):
+        return HEADER.unpack_from(self.mm, 0)[3]
+
+    def _set_head(self, head):
+        struct.pack_into('<Q', self.mm, HEADER.size - 8, head)
+
+    def _entry_offset(self, h, way):
+        return self.index_offset + ((h % self.num_sets) * WAYS + way) * ENTRY.size
+
+    def _is_valid(self, position, head):
+        return position > 0 and head - (position - 1) <= self.capacity
+
+    def _record_key(self, position):
+        offset = self.data_offset + (position - 1) % self.capacity
+        key_length, value_length = RECORD_HEADER.unpack_from(self.mm, offset)
+        start = offset + RECORD_HEADER.size
+
+        return self.mm[start:start + key_length], start + key_length, value_length
+
+    def _find(self, key, h, head):
+        '''
+        Get the index entry of a key.
+
+        Return:
+
+        (tuple): The (entry offset, record position) or `None`
+        '''
+        for way in range(WAYS):
+            entry_offset = self._entry_offset(h, way)
+            entry_hash, position, _ = ENTRY.unpack_from(self.mm, entry_offset)
+
+            if (
+                entry_hash == h and self._is_valid(position, head) and
+                self._record_key(position)[0] == key
+            ):
+                return entry_offset, position
+
+        return None
+
+    def _victim(self, h, head):
+        '''
+        Get an empty entry of the set of a hash or else its oldest entry.
+        '''
+        victim = None
+        oldest = None
+
+        for way in range(WAYS):
+            entry_offset = self._entry_offset(h, way)
+            position = ENTRY.unpack_from(self.mm, entry_offset)[1]
+
+            if not self._is_valid(position, head):
+                return entry_offset
+
+            if oldest is None or position < oldest:
+                victim, oldest = entry_offset, position
+
+        return victim
+
+    def _append(self, entry_offset, h, record):
+        head = self._get_head()
+        offset = head % self.capacity
+
+        if offset + len(record) > self.capacity:
+            # Skip the rest of the ring
+            head += self.capacity - offset
+            offset = 0
+
+        # Moving the head first invalidates the records that are about to
+        # be overwritten and the entry is written last, so that no entry
+        # ever points to a partially written record, even if the process
+        # dies in between
+        self._set_head(head + len(record))
+
+        start = self.data_offset + offset
+        self.mm[start:start + len(record)] = record
+
+        ENTRY.pack_into(self.mm, entry_offset, h, head + 1, len(record))
+
+    def get(self, key):
+        '''
+        Get the value of a key or `None` if it is not cached.
+        '''
+        key = key.encode('utf-8')
+        h = key_hash(key)
+
+        with self._locked() as available:
+            if not available:
+                return None
+
+            head = self._get_head()
+            found = self._find(key, h, head)
+
+            if found is None:
+                return None
+
+            entry_offset, position = found
+            _, value_offset, value_length = self._record_key(position)
+            value = self.mm[value_offset:value_offset + value_length]
+
+            if head - (position - 1) > self.capacity * (1 - PROMOTE_FRACTION):
+                self._append(
+                    entry_offset, h,
+                    RECORD_HEADER.pack(len(key), len(value)) + key + value
+                )
+
+            return value
+
+    def exists(self, key):
+        key = key.encode('utf-8')
+
+        with self._locked() as available:
+            return available and (
+                self._find(key, key_hash(key), self._get_head()) is not None
+            )
+
+    def set(self, key, value):
+        '''
+        Cache a value. Values that take up more than a quarter of the cache
+        are not cached.
+
+        Return:
+
+        (bool): Whether the value was cached
+        '''
+        key = key.encode('utf-8')
+        record = RECORD_HEADER.pack(len(key), len(value)) + key + value
+
+        if len(record) > self.capacity // 4:
+            return False
+
+        h = key_hash(key)
+
+        with self._locked() as available:
+            if not available:
+                return False
+
+            head = self._get_head()
+            found = self._find(key, h, head)
+
+            if found is not None:
+                entry_offset = found[0]
+            else:
+                entry_offset = self._victim(h, head)
+
+            self._append(entry_offset, h, record)
+
+        return True
+
+    def delete(self, key):
+        key = key.encode('utf-8')
+
+        with self._locked() as available:
+            if not available:
+                return 0
+
+            found = self._find(key, key_hash(key), self._get_head())
+
+            if found is None:
+                return 0
+
+            ENTRY.pack_into(self.mm, found[0], 0, 0, 0)
+
+            return 1
+
+    def iter_keys(self):
+        '''
+        Iterate over the cached keys and the sizes of their records.
+        '''
+        keys = []
+
+        with self._locked() as available:
+            if not available:
+                return iter(keys)
+
+            head = self._get_head()
+
+            for entry in range(self.num_sets * WAYS):
+                _, position, size = ENTRY.unpack_from(
+                    self.mm, self.index_offset + entry * ENTRY.size
+                )
+
+                if self._is_valid(position, head):
+                    keys.append((
+                        self._record_key(position)[0].decode('utf-8'), size
+                    ))
+
+        return iter(keys)
+
+    def clear(self):
+        with self._locked() as available:
+            if not available:
+                return
+
+            self.mm[self.index_offset:self.data_offset] = bytes(
+                self.data_offset - self.index_offset
+            )
+
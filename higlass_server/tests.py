@@ -1,9 +1,20 @@
+import asyncio
+import multiprocessing as mp
+import os
+import os.path as op
 import unittest
 import slugid
 import subprocess
+import tempfile
+import threading
+import time
 
 import tilesets.models as tm
 
+from higlass_server.asgi import WsgiToAsgi
+from higlass_server.shm_cache import SharedMemoryCache
+from higlass_server.utils import EmptyRDB, SingleFlight
+
 class CommandlineTest(unittest.TestCase):
     def setUp(self):
         # TODO: There is probably a better way to clear data from previous test runs. Is it even necessary?
@@ -94,3 +105,187 @@ class CommandlineTest(unittest.TestCase):
         #self.assertRun('curl -s -H "Host: somesite.com" http://localhost:6000/api/v1/tilesets/', [r'count'])
         pass
 
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_local_single_flight(self):
+        computed = []
+        results = []
+
+        def request():
+            with SingleFlight(EmptyRDB(), 'key', timeout=5, wait=5) as flight:
+                value = flight.value
+                if value is None:
+                    time.sleep(0.1)
+                    computed.append(1)
+                    value = 'result'
+                    flight.value = value
+                results.append(value)
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_disabled_single_flight(self):
+        with SingleFlight(EmptyRDB(), 'key', timeout=5, wait=5):
+            start = time.time()
+
+            # Requests bypassing the cache don't wait for others
+            with SingleFlight(
+                EmptyRDB(), 'key', timeout=5, wait=5, enabled=False
+            ) as flight:
+                self.assertIsNone(flight.value)
+                flight.value = 'ignored'
+
+            self.assertLess(time.time() - start, 1)
+
+
+
+def set_shm_value(path, size, key, value):
+    SharedMemoryCache(path, size).set(key, value)
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = op.join(self.tmp_dir.name, 'tiles')
+        self.size = 256 * 1024
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_set(self):
+        cache = SharedMemoryCache(self.path, self.size)
+
+        self.assertIsNone(cache.get('a'))
+
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.set('a', b'3')
+
+        self.assertEqual(cache.get('a'), b'3')
+        self.assertEqual(cache.get('b'), b'2')
+        self.assertTrue(cache.exists('b'))
+
+        self.assertEqual(cache.delete('b'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertFalse(cache.exists('b'))
+
+        # Values that don't fit are not cached
+        self.assertFalse(cache.set('c', bytes(self.size)))
+
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+
+    def test_shared(self):
+        cache = SharedMemoryCache(self.path, self.size)
+        cache.set('a', b'1')
+
+        # Other processes see the values of this one and vice versa
+        process = mp.Process(
+            target=set_shm_value, args=(self.path, self.size, 'b', b'2')
+        )
+        process.start()
+        process.join()
+
+        self.assertEqual(cache.get('b'), b'2')
+
+        # Values outlive the processes that use the cache
+        self.assertEqual(SharedMemoryCache(self.path, self.size).get('a'), b'1')
+
+        # The cache is created again if its size changes
+        self.assertIsNone(SharedMemoryCache(self.path, self.size * 2).get('a'))
+
+    def test_eviction(self):
+        cache = SharedMemoryCache(self.path, self.size)
+        file_size = None
+
+        for i in range(64):
+            cache.set(str(i), bytes([i]) * 16 * 1024)
+
+            # Values that are in use are kept
+            self.assertIsNotNone(cache.get('0'))
+
+            if file_size is None:
+                file_size = op.getsize(self.path)
+
+        self.assertEqual(op.getsize(self.path), file_size)
+        self.assertEqual(cache.get('0'), bytes(16 * 1024))
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(cache.get('63'), bytes([63]) * 16 * 1024)
+
+    def test_unavailable(self):
+        cache = SharedMemoryCache(
+            op.join(self.tmp_dir.name, 'missing', 'tiles'), self.size
+        )
+
+        # The cache is disabled instead of failing requests
+        self.assertFalse(cache.set('a', b'1'))
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse(cache.exists('a'))
+        self.assertEqual(list(cache.iter_keys()), [])
+
+    def test_replaced(self):
+        cache = SharedMemoryCache(self.path, self.size)
+        cache.set('a', b'1')
+
+        # Another process replaces the file
+        os.unlink(self.path)
+        other = SharedMemoryCache(self.path, self.size)
+        other.set('b', b'2')
+
+        cache._checked = 0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), b'2')
+
+class WsgiToAsgiTest(unittest.TestCase):
+    def test_request(self):
+        def wsgi_application(environ, start_response):
+            start_response('201 Created', [('Content-Type', 'text/plain')])
+            return [
+                environ['wsgi.input'].read(),
+                b'',
+                environ['QUERY_STRING'].encode('latin-1'),
+                environ['HTTP_X_TEST'].encode('latin-1'),
+            ]
+
+        application = WsgiToAsgi(wsgi_application, max_workers=2)
+
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/api/v1/tiles/',
+            'query_string': b'd=a.0.0',
+            'headers': [(b'x-test', b'1'), (b'x-test', b'2')],
+        }
+        requests = [
+            {'type': 'http.request', 'body': b'he', 'more_body': True},
+            {'type': 'http.request', 'body': b'llo'},
+        ]
+        messages = []
+
+        async def receive():
+            return requests.pop(0)
+
+        async def send(message):
+            messages.append(message)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(application(scope, receive, send))
+        loop.close()
+
+        self.assertEqual(messages[0], {
+            'type': 'http.response.start',
+            'status': 201,
+            'headers': [(b'content-type', b'text/plain')],
+        })
+        self.assertEqual(
+            b''.join(message['body'] for message in messages[1:]),
+            b'hellod=a.0.01,2'
+        )
+        self.assertFalse(messages[-1].get('more_body', False))
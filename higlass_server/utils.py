@@ -1,7 +1,17 @@
+import collections as col
+import hashlib
+import json
+import logging
 import redis
+import slugid
+import threading
+import time
 import higlass_server.settings as hss
 
-from redis.exceptions import ConnectionError
+from django.http import HttpResponse, HttpResponseNotModified
+from redis.exceptions import ConnectionError, RedisError
+
+logger = logging.getLogger(__name__)
 
 
 class EmptyRDB:
@@ -17,6 +27,12 @@ class EmptyRDB:
     def set(self, name, value, ex=None, px=None, nx=False, xx=False):
         pass
 
+    def incr(self, name, amount=1):
+        return None
+
+    def delete(self, *names):
+        return 0
+
 
 def getRdb():
     if hss.REDIS_HOST is not None:
@@ -33,3 +49,258 @@ def getRdb():
             return EmptyRDB()
     else:
         return EmptyRDB()
+
+
+# Deletes the lock only if it is still held by the same owner
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+
+class SingleFlight:
+    '''
+    Make sure that only one worker at a time computes the result that is
+    going to be cached under `key`. Everyone else waits until the result
+    has been computed and then picks it up:
+
+        with SingleFlight(rdb, cache_key) as flight:
+            value = flight.value or rdb.get(cache_key)
+            if value is None:
+                value = compute()
+                rdb.set(cache_key, value)
+                flight.value = value
+
+    With Redis the lock is shared across workers, the result is picked up
+    from the cache and the lock expires after `timeout` seconds in case
+    its owner dies. Without Redis nothing is cached, so the lock is local
+    to the process and the result is handed over through `value`. Waiting
+    is given up after `wait` seconds, in which case the result is computed
+    anyway. A flight that is not `enabled` (e.g., for requests bypassing
+    the cache) never waits.
+    '''
+    def __init__(self, rdb, key, timeout=None, wait=None, poll=0.05,
+                 enabled=True):
+        self.rdb = rdb
+        self.key = 'lock_{}'.format(key)
+        self.timeout = hss.REQUEST_LOCK_TIMEOUT if timeout is None else timeout
+        self.wait = hss.REQUEST_LOCK_WAIT if wait is None else wait
+        self.poll = poll
+        self.token = slugid.nice()
+        self.acquired = False
+        self.local = isinstance(rdb, EmptyRDB)
+        self.enabled = enabled
+
+    @property
+    def value(self):
+        if self.local and self.acquired:
+            return _local_locks[self.key][2]
+
+        return None
+
+    @value.setter
+    def value(self, value):
+        if self.local and self.acquired:
+            _local_locks[self.key][2] = value
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        if self.local:
+            self._acquire_local()
+        else:
+            self._acquire_redis()
+
+        return self
+
+    def __exit__(self, *args):
+        if not self.acquired:
+            return
+
+        if self.local:
+            self._release_local()
+        else:
+            try:
+                self.rdb.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+            except RedisError as ex:
+                # The lock expires on its own
+                logger.warn(ex)
+
+        self.acquired = False
+
+    def _acquire_redis(self):
+        deadline = time.time() + self.wait
+
+        try:
+            while True:
+                if self.rdb.set(
+                    self.key,
+                    self.token,
+                    px=int(self.timeout * 1000),
+                    nx=True
+                ):
+                    self.acquired = True
+                    return
+
+                if time.time() >= deadline:
+                    return
+
+                time.sleep(self.poll)
+        except RedisError as ex:
+            logger.warn(ex)
+
+    def _acquire_local(self):
+        with _local_locks_lock:
+            if self.key not in _local_locks:
+                # lock, number of requests holding or waiting, value
+                _local_locks[self.key] = [threading.Lock(), 0, None]
+            _local_locks[self.key][1] += 1
+            lock = _local_locks[self.key][0]
+
+        self.acquired = lock.acquire(timeout=self.wait)
+
+        if not self.acquired:
+            self._unref_local()
+
+    def _release_local(self):
+        _local_locks[self.key][0].release()
+        self._unref_local()
+
+    def _unref_local(self):
+        with _local_locks_lock:
+            _local_locks[self.key][1] -= 1
+            if _local_locks[self.key][1] == 0:
+                del _local_locks[self.key]
+
+
+def make_etag(content):
+    '''
+    Get a strong ETag for the given bytes.
+    '''
+    return '"{}"'.format(hashlib.md5(content).hexdigest())
+
+
+def etag_matches(request, etag):
+    '''
+    Check whether the client already has the representation with `etag`
+    according to the request's `If-None-Match` header.
+    '''
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+
+    if not header:
+        return False
+
+    tags = [tag.strip() for tag in header.split(',')]
+
+    # Weak comparison as required for If-None-Match
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def version_etag(*parts):
+    '''
+    Get a strong ETag for a response that is fully determined by `parts`,
+    e.g., the versions of the data and the request parameters, so that
+    it can be checked before the response is rendered.
+    '''
+    return make_etag(
+        json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    )
+
+
+def cache_headers(response, etag=None, public=True, max_age=None):
+    '''
+    Set the ETag and the Cache-Control header of a response. Only public
+    responses may be stored by shared caches like nginx.
+    '''
+    if etag is not None:
+        response['ETag'] = etag
+
+    response['Cache-Control'] = '{}, max-age={}'.format(
+        'public' if public else 'private',
+        hss.HTTP_CACHE_MAX_AGE if max_age is None else max_age
+    )
+
+    return response
+
+
+def etag_response(
+    request, content, content_type, etag=None, public=True, max_age=None
+):
+    '''
+    Respond with `content` and its ETag or with a 304 if the client's copy
+    is up to date.
+    '''
+    etag = etag or make_etag(content)
+
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+
+    return cache_headers(response, etag, public, max_age)
+
+
+class ResponseCache:
+    '''
+    Per-process LRU cache of rendered responses. Every entry is stored
+    with the version of the data it was rendered from and is only
+    returned for that same version, so outdated entries are never served
+    and are simply replaced.
+
+    Args:
+
+    max_size (int): Max number of responses to keep
+    max_age (float): Number of seconds after which entries expire or
+        `None` to keep them until they are replaced
+    '''
+    def __init__(self, max_size=128, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries = col.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        '''
+        Get the `(content, content_type, etag)` of `key` if it was rendered
+        from `version` or `None` otherwise.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != version:
+                return None
+
+            if entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+            return entry[2:]
+
+    def set(self, key, version, content, content_type, etag=None):
+        expires = (
+            time.time() + self.max_age if self.max_age is not None else None
+        )
+        entry = (
+            version, expires, content, content_type, etag or make_etag(content)
+        )
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return entry[2:]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
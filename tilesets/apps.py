@@ -5,3 +5,8 @@ from django.apps import AppConfig
 
 class TilesetsConfig(AppConfig):
     name = 'tilesets'
+
+    def ready(self):
+        # Connect the signal handlers
+        import tilesets.chromsizes  # noqa: F401
+        import tilesets.viewconf_cache  # noqa: F401
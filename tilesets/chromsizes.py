@@ -1,13 +1,27 @@
 import csv
 import h5py
+import json
 import logging
 import numpy as np
 import pandas as pd
 
-from fragments.utils import get_cooler
+import tilesets.cooler_cache as tcc
+import tilesets.models as tm
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from higlass_server.utils import getRdb
 
 logger = logging.getLogger(__name__)
 
+rdb = getRdb()
+
+LIST_VERSION_KEY = 'chromsizes_list_version'
+
+# Bumped whenever a tileset is changed by this process. With Redis the
+# shared counter under `LIST_VERSION_KEY` is bumped as well.
+_list_version = 0
+
 def chromsizes_array_to_series(chromsizes):
     '''
     Convert an array of [[chrname, size]...] values to a series
@@ -58,22 +72,15 @@ def get_cooler_chromsizes(filename):
     chromsizes: [(name:string, size:int), ...]
         An ordered list of chromosome names and sizes
     '''
-    with h5py.File(filename, 'r') as f:
+    try:
+        meta = tcc.get_meta(filename)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Yikes... Couldn~\'t init cooler files 😵')
 
-        try:
-            c = get_cooler(f)
-        except Exception as e:
-            logger.error(e)
-            raise Exception('Yikes... Couldn~\'t init cooler files 😵')
-
-        try:
-            data = []
-            for chrom, size in c.chromsizes.iteritems():
-                data.append([chrom, size])
-            return data
-        except Exception as e:
-            logger.error(e)
-            raise Exception( 'Cooler file has no `chromsizes` attribute 🤔')
+    return [
+        [chrom, size] for chrom, size in meta.chromsizes.iteritems()
+    ]
 
 def get_tsv_chromsizes(filename):
     '''
@@ -107,3 +114,59 @@ def get_tsv_chromsizes(filename):
 
         raise Exception(err_msg)
 
+def render_chromsizes(chromsizes, res_type='tsv', incl_cum=False):
+    '''
+    Render a list of chromosome sizes as TSV or JSON.
+
+    Parameters:
+    -----------
+    chromsizes: [(name:string, size:int), ...]
+        An ordered list of chromosome names and sizes
+    res_type: string
+        Either `tsv` or `json`
+    incl_cum: bool
+        Whether to include the cumulative offsets in the JSON output
+
+    Returns
+    -------
+    content: bytes
+        The UTF-8 encoded TSV or JSON
+    '''
+    if res_type != 'json':
+        return ''.join(
+            '{}\t{}\n'.format(row[0], row[1]) for row in chromsizes
+        ).encode('utf-8')
+
+    json_out = {}
+    cum = 0
+
+    for row in chromsizes:
+        size = int(row[1])
+
+        json_out[row[0]] = {'size': size}
+
+        if incl_cum:
+            json_out[row[0]]['offset'] = cum
+            cum += size
+
+    return json.dumps(json_out).encode('utf-8')
+
+
+def get_list_version():
+    '''
+    Get the version of the list of available chromosome sizes.
+    '''
+    return (rdb.get(LIST_VERSION_KEY), _list_version)
+
+
+@receiver(post_save, sender=tm.Tileset)
+@receiver(post_delete, sender=tm.Tileset)
+def bump_list_version(sender, **kwargs):
+    global _list_version
+
+    _list_version += 1
+
+    try:
+        rdb.incr(LIST_VERSION_KEY)
+    except Exception as ex:
+        logger.warn(ex)
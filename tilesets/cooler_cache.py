@@ -0,0 +1,209 @@
+import collections as col
+import h5py
+import logging
+import numpy as np
+import os
+import pandas as pd
+import threading
+
+import higlass_server.settings as hss
+
+logger = logging.getLogger(__name__)
+
+# Bin weight vectors that tiles can be normalized with
+TRANSFORMS = ('weight', 'KR', 'VC', 'VC_SQRT')
+
+
+class CoolerLayout:
+    '''
+    How the coolers of a file are organized.
+
+    `version` is 2 for multi-resolution files with a `resolutions` group,
+    1 for legacy multi-zoom files and 0 for single coolers. `resolutions`
+    lists the available resolutions (v2) or zoom levels (v1) in ascending
+    order.
+    '''
+    def __init__(self, version, resolutions=None, attrs=None):
+        self.version = version
+        self.resolutions = resolutions or []
+        self.attrs = attrs or {}
+
+    def group(self, zoomout_level=None):
+        '''
+        Get the HDF5 group path of the cooler closest to `zoomout_level`,
+        which is a resolution for v2 files and a number of zoom levels
+        relative to the max zoom for v1 files.
+        '''
+        if self.version == 2:
+            resolutions = np.array(self.resolutions)
+            resolution = (
+                resolutions[0] if zoomout_level is None else zoomout_level
+            )
+
+            # Get the closest resolution
+            resolution = resolutions[
+                np.argmin(np.abs(resolutions - resolution))
+            ]
+
+            return 'resolutions/{}'.format(resolution)
+
+        if self.version == 1:
+            zoomout_level = 0 if zoomout_level is None else zoomout_level
+
+            max_zoom = self.resolutions[-1]
+            min_zoom = self.resolutions[0]
+
+            zoom_level = max_zoom - max(zoomout_level, 0)
+
+            if zoom_level >= min_zoom and zoom_level <= max_zoom:
+                return str(zoom_level)
+
+            return '0'
+
+        return '/'
+
+
+class CoolerMeta:
+    '''
+    Structural metadata of a single cooler.
+
+    Attributes:
+
+    group (str): HDF5 group path of the cooler
+    info (dict): Attributes of the cooler (i.e., `Cooler.info`)
+    resolution (int): Bin size
+    chromsizes (pd.Series): Chromosome lengths in base pairs
+    offsets (pd.Series): Offset of the first bin of every chromosome
+    weights (np.array): Balancing weights or `None` if not balanced
+    transforms (list): Names of the available bin weight vectors
+    '''
+    def __init__(self, grp, group):
+        self.filepath = grp.file.filename
+        self.group = group
+        self.info = {
+            k: (v.decode('utf-8') if isinstance(v, bytes) else v)
+            for k, v in grp.attrs.items()
+        }
+        self.resolution = int(self.info['bin-size'])
+
+        names = grp['chroms/name'][:]
+        names = [
+            name.decode('utf-8') if isinstance(name, bytes) else name
+            for name in names
+        ]
+        self.chromsizes = pd.Series(grp['chroms/length'][:], index=names)
+
+        nbins = np.ceil(self.chromsizes / self.resolution).astype(int)
+        self.offsets = np.cumsum(nbins) - nbins
+
+        self.weights = (
+            grp['bins/weight'][:] if 'weight' in grp['bins'] else None
+        )
+
+        self.transforms = [
+            name for name in TRANSFORMS if name in grp['bins']
+        ]
+        self._bin_weights = {'weight': self.weights}
+        self._lock = threading.Lock()
+
+    def bin_weights(self, name):
+        '''
+        Get a vector of bin weights (e.g., 'weight' or 'KR'), which is
+        read once when first needed.
+
+        Return:
+
+        (np.array): The weights or `None` if the cooler has no such vector
+        '''
+        if name not in self.transforms:
+            return None
+
+        with self._lock:
+            if name not in self._bin_weights:
+                with h5py.File(self.filepath, 'r') as f:
+                    self._bin_weights[name] = f[self.group]['bins'][name][:]
+
+            return self._bin_weights[name]
+
+
+def _read_layout(f):
+    if 'resolutions' in f:
+        return CoolerLayout(
+            2, sorted(int(res) for res in f['resolutions'].keys())
+        )
+
+    try:
+        zoom_levels = sorted(int(key) for key in f.keys())
+        return CoolerLayout(1, zoom_levels, dict(f.attrs.items()))
+    except ValueError:
+        return CoolerLayout(0)
+
+
+class CoolerCache:
+    '''
+    Per-process LRU cache of cooler layouts and metadata keyed by the
+    file's path and mtime, so that changed files are reread.
+    '''
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._layouts = {}
+        self._metas = col.OrderedDict()
+        self._lock = threading.Lock()
+
+    def layout(self, filepath):
+        mtime = os.path.getmtime(filepath)
+        key = (filepath, mtime)
+
+        with self._lock:
+            if key in self._layouts:
+                return self._layouts[key]
+
+        with h5py.File(filepath, 'r') as f:
+            layout = _read_layout(f)
+
+        with self._lock:
+            # Drop layouts of older versions of the file
+            for old_key in [k for k in self._layouts if k[0] == filepath]:
+                del self._layouts[old_key]
+            self._layouts[key] = layout
+
+        return layout
+
+    def meta(self, filepath, zoomout_level=None):
+        return self.group_meta(
+            filepath, self.layout(filepath).group(zoomout_level)
+        )
+
+    def group_meta(self, filepath, group):
+        mtime = os.path.getmtime(filepath)
+        key = (filepath, group, mtime)
+
+        with self._lock:
+            if key in self._metas:
+                self._metas.move_to_end(key)
+                return self._metas[key]
+
+        with h5py.File(filepath, 'r') as f:
+            meta = CoolerMeta(f[group], group)
+
+        with self._lock:
+            self._metas[key] = meta
+            while len(self._metas) > self.max_size:
+                self._metas.popitem(last=False)
+
+        return meta
+
+
+cache = CoolerCache(hss.COOLER_META_CACHE_SIZE)
+
+
+def get_layout(filepath):
+    return cache.layout(filepath)
+
+
+def get_meta(filepath, zoomout_level=None):
+    return cache.meta(filepath, zoomout_level)
+
+
+def get_group_meta(filepath, group):
+    return cache.group_meta(filepath, group)
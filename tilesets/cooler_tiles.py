@@ -0,0 +1,417 @@
+import collections as col
+import h5py
+import math
+import numpy as np
+import os
+import threading
+
+import clodius.tiles.cooler as hgco
+import clodius.tiles.format as hgfo
+
+import higlass_server.settings as hss
+import tilesets.cooler_cache as tcc
+
+BINS_PER_TILE = 256
+
+# Transforms that divide the counts by their bin weights. All others
+# multiply them.
+DIVIDING_TRANSFORMS = ('KR', 'VC', 'VC_SQRT')
+
+
+class RawTile:
+    '''
+    The unnormalized counts of a tile and the bins of its rows and columns.
+
+    Attributes:
+
+    counts (np.array): 256x256 float32 counts. Rows run along `bin2` and
+        columns along `bin1`, just like in clodius.
+    row_bins (np.array): Bin of every row or -1 at and past the end of the
+        genome
+    col_bins (np.array): Bin of every column or -1 at and past the end of
+        the genome
+    shared_bins (tuple): The (rows, row bins, columns, column bins) of
+        bins that share their line with the next bin, which happens at the
+        ends of chromosomes
+    shared_pixels (tuple): The (rows, columns, bin1, bin2, counts) of the
+        pixels on lines that several bins share
+    '''
+    __slots__ = (
+        'counts', 'row_bins', 'col_bins', 'shared_bins', 'shared_pixels'
+    )
+
+    def __init__(
+        self, counts, row_bins, col_bins, shared_bins, shared_pixels
+    ):
+        self.counts = counts
+        self.row_bins = row_bins
+        self.col_bins = col_bins
+        self.shared_bins = shared_bins
+        self.shared_pixels = shared_pixels
+
+    @property
+    def nbytes(self):
+        return (
+            self.counts.nbytes + self.row_bins.nbytes + self.col_bins.nbytes +
+            sum(a.nbytes for a in self.shared_bins) +
+            sum(a.nbytes for a in self.shared_pixels)
+        )
+
+
+class RawTileCache:
+    '''
+    Per-process LRU cache of raw tiles with a budget in bytes. Tiles are
+    keyed by the file's path and mtime, so that changed files are reread.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = col.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+
+            if tile is not None:
+                self._tiles.move_to_end(key)
+
+            return tile
+
+    def set(self, key, tile):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+
+            if old is not None:
+                self.nbytes -= old.nbytes
+
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+
+            while self.nbytes > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+raw_tiles = RawTileCache(hss.COOLER_PIXEL_CACHE_SIZE)
+
+
+def _chrom_starts(meta):
+    sizes = meta.chromsizes.values.astype(np.int64)
+    return np.cumsum(sizes) - sizes
+
+
+def genome_starts(meta, bins):
+    '''
+    Get the absolute genomic start positions of bins.
+    '''
+    offsets = np.asarray(meta.offsets)
+    chroms = np.searchsorted(offsets, bins, side='right') - 1
+
+    return (
+        _chrom_starts(meta)[chroms] +
+        (bins - offsets[chroms]) * meta.resolution
+    )
+
+
+def first_bin_at(meta, pos):
+    '''
+    Get the first bin that starts at or after an absolute genomic position.
+    '''
+    sizes = meta.chromsizes.values
+    chrom_starts = _chrom_starts(meta)
+    offsets = np.asarray(meta.offsets)
+
+    if pos >= chrom_starts[-1] + sizes[-1]:
+        return int(offsets[-1] + math.ceil(sizes[-1] / meta.resolution))
+
+    chrom = np.searchsorted(chrom_starts, pos, side='right') - 1
+    nbins = math.ceil(sizes[chrom] / meta.resolution)
+
+    return int(offsets[chrom] + min(
+        math.ceil((pos - chrom_starts[chrom]) / meta.resolution), nbins
+    ))
+
+
+def line_bins(meta, start, tile_size, resolution):
+    '''
+    Get the bin of every row or column of a tile that starts at `start`.
+
+    Return:
+
+    (tuple): The bin of every line and the (lines, bins) of the bins that
+        are shadowed by the next bin in their line
+    '''
+    bins = np.arange(
+        first_bin_at(meta, start), first_bin_at(meta, start + tile_size)
+    )
+    bin_lines = ((genome_starts(meta, bins) - start) // resolution).astype(int)
+
+    lines = np.full(BINS_PER_TILE, -1, dtype=np.int64)
+    lines[bin_lines] = bins
+
+    # Like clodius, count everything from the line that contains the end
+    # of the genome as past the end
+    past_end = (
+        np.arange(meta.chromsizes.values.sum(), start + tile_size, resolution) -
+        start
+    ) // resolution
+    lines[past_end[past_end >= 0].astype(int)] = -1
+
+    shadowed = np.nonzero(bin_lines[:-1] == bin_lines[1:])[0]
+
+    return lines, (bin_lines[shadowed], bins[shadowed])
+
+
+def read_pixels(grp, rows, cols):
+    '''
+    Read the stored pixels of a range of rows (`bin1`) that fall into a
+    range of columns (`bin2`).
+    '''
+    if rows[0] >= rows[1] or cols[0] >= cols[1]:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+
+    offsets = grp['indexes/bin1_offset'][rows[0]:rows[1] + 1]
+    lo, hi = offsets[0], offsets[-1]
+
+    bin1 = grp['pixels/bin1_id'][lo:hi]
+    bin2 = grp['pixels/bin2_id'][lo:hi]
+    count = grp['pixels/count'][lo:hi]
+
+    in_cols = (bin2 >= cols[0]) & (bin2 < cols[1])
+
+    return bin1[in_cols], bin2[in_cols], count[in_cols]
+
+
+def read_raw_tiles(meta, resolution, tile_size, positions):
+    '''
+    Read the raw tiles at `positions` with one pass over the pixels of
+    their bounding box.
+    '''
+    x0 = min(x for x, _ in positions)
+    x1 = max(x for x, _ in positions) + 1
+    y0 = min(y for _, y in positions)
+    y1 = max(y for _, y in positions) + 1
+
+    x_bins = (first_bin_at(meta, x0 * tile_size), first_bin_at(meta, x1 * tile_size))
+    y_bins = (first_bin_at(meta, y0 * tile_size), first_bin_at(meta, y1 * tile_size))
+
+    # Just like clodius, only the stored pixels are returned. Symmetric
+    # matrices are mirrored by the client.
+    with h5py.File(meta.filepath, 'r') as f:
+        bin1, bin2, count = read_pixels(f[meta.group], x_bins, y_bins)
+
+    cols = ((genome_starts(meta, bin1) - x0 * tile_size) // resolution).astype(int)
+    rows = ((genome_starts(meta, bin2) - y0 * tile_size) // resolution).astype(int)
+
+    block = np.zeros(
+        ((y1 - y0) * BINS_PER_TILE, (x1 - x0) * BINS_PER_TILE), dtype=np.float32
+    )
+    block[rows, cols] = count
+
+    tiles = {}
+
+    for x, y in positions:
+        i = (y - y0) * BINS_PER_TILE
+        j = (x - x0) * BINS_PER_TILE
+
+        row_bins, (shared_rows, shared_row_bins) = line_bins(
+            meta, y * tile_size, tile_size, resolution
+        )
+        col_bins, (shared_cols, shared_col_bins) = line_bins(
+            meta, x * tile_size, tile_size, resolution
+        )
+
+        # Pixels of bins that share a line are kept apart, so that every
+        # one of them can be weighted with its own bins
+        shared = np.zeros(len(count), dtype=bool)
+
+        if len(shared_rows) or len(shared_cols):
+            shared = (
+                (rows >= i) & (rows < i + BINS_PER_TILE) &
+                (cols >= j) & (cols < j + BINS_PER_TILE) &
+                (np.isin(rows - i, shared_rows) | np.isin(cols - j, shared_cols))
+            )
+
+        tiles[(x, y)] = RawTile(
+            block[i:i + BINS_PER_TILE, j:j + BINS_PER_TILE].copy(),
+            row_bins,
+            col_bins,
+            (shared_rows, shared_row_bins, shared_cols, shared_col_bins),
+            (
+                rows[shared] - i, cols[shared] - j,
+                bin1[shared], bin2[shared], count[shared]
+            )
+        )
+
+    return tiles
+
+
+def get_raw_tiles(meta, resolution, tile_size, positions):
+    '''
+    Get raw tiles from the cache, reading the missing ones.
+
+    Return:
+
+    (dict): The `RawTile`s by (x, y) position
+    '''
+    key_prefix = (meta.filepath, os.path.getmtime(meta.filepath), meta.group)
+
+    tiles = {}
+    missing = []
+
+    for position in positions:
+        tile = raw_tiles.get(key_prefix + position)
+
+        if tile is None:
+            missing.append(position)
+        else:
+            tiles[position] = tile
+
+    if not missing:
+        return tiles
+
+    width = max(x for x, _ in missing) - min(x for x, _ in missing) + 1
+    height = max(y for _, y in missing) - min(y for _, y in missing) + 1
+
+    # Tiles that are far apart are read one by one instead of reading
+    # everything between them
+    if width * height > 4 * len(missing):
+        groups = [[position] for position in missing]
+    else:
+        groups = [missing]
+
+    for group in groups:
+        for position, tile in read_raw_tiles(
+            meta, resolution, tile_size, group
+        ).items():
+            raw_tiles.set(key_prefix + position, tile)
+            tiles[position] = tile
+
+    return tiles
+
+
+def normalize(meta, raw_tile, transform):
+    '''
+    Apply a transform to a raw tile like clodius does: counts are
+    multiplied (or divided) by the weights of their bins and the rows
+    and columns of bins without a weight are set to NaN.
+
+    Return:
+
+    (np.array): 256x256 float32 tile
+    '''
+    if transform == 'default':
+        transform = 'weight'
+
+    weights = meta.bin_weights(transform)
+
+    if weights is None:
+        return raw_tile.counts.copy()
+
+    def line_weights(bins):
+        return np.where(bins >= 0, weights[np.maximum(bins, 0)], np.nan)
+
+    def balance(counts, col_weights, row_weights):
+        if transform in DIVIDING_TRANSFORMS:
+            return counts / col_weights / row_weights
+
+        return counts * col_weights * row_weights
+
+    row_weights = line_weights(raw_tile.row_bins)
+    col_weights = line_weights(raw_tile.col_bins)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        out = np.nan_to_num(balance(
+            raw_tile.counts, col_weights[np.newaxis, :], row_weights[:, np.newaxis]
+        )).astype(np.float32)
+
+        rows, cols, bin1, bin2, counts = raw_tile.shared_pixels
+        out[rows, cols] = np.nan_to_num(
+            balance(counts, weights[bin1], weights[bin2])
+        )
+
+    shared_rows, shared_row_bins, shared_cols, shared_col_bins = (
+        raw_tile.shared_bins
+    )
+
+    out[:, np.isnan(col_weights)] = np.nan
+    out[:, shared_cols[np.isnan(weights[shared_col_bins])]] = np.nan
+    out[np.isnan(row_weights), :] = np.nan
+    out[shared_rows[np.isnan(weights[shared_row_bins])], :] = np.nan
+
+    return out
+
+
+def generate_tiles(filepath, tile_ids):
+    '''
+    Generate cooler tiles. Raw tiles are read once and cached, so the
+    same tile is derived in any transform without reading the file again.
+
+    Parameters
+    ----------
+    filepath: str
+        The cooler file
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0.1.ice)
+
+    Returns
+    -------
+    generated_tiles: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples
+    '''
+    if tcc.get_layout(filepath).version == 0:
+        # Single-resolution coolers are left to clodius
+        return hgco.generate_tiles(filepath, tile_ids)
+
+    tileset_info = hgco.tileset_info(filepath)
+    tiles_by_zoom = col.defaultdict(list)
+
+    for tile_id in tile_ids:
+        tile_id_parts = tile_id.split('.')
+        zoom_level, x, y = map(int, tile_id_parts[1:4])
+
+        if x < 0 or y < 0:
+            continue
+
+        tiles_by_zoom[zoom_level].append(
+            (tile_id, (x, y), hgco.get_transform_type(tile_id))
+        )
+
+    generated_tiles = []
+
+    for zoom_level, tiles in tiles_by_zoom.items():
+        if 'resolutions' in tileset_info:
+            resolutions = sorted(tileset_info['resolutions'], reverse=True)
+
+            if zoom_level >= len(resolutions):
+                # this tile has too high of a zoom level specified
+                continue
+
+            resolution = resolutions[zoom_level]
+            group = 'resolutions/{}'.format(resolution)
+        else:
+            if zoom_level > tileset_info['max_zoom']:
+                continue
+
+            resolution = tileset_info['max_width'] / 2 ** zoom_level / BINS_PER_TILE
+            group = str(zoom_level)
+
+        meta = tcc.get_group_meta(filepath, group)
+        raw = get_raw_tiles(
+            meta,
+            resolution,
+            resolution * BINS_PER_TILE,
+            sorted(set(position for _, position, _ in tiles))
+        )
+
+        for tile_id, position, transform in tiles:
+            generated_tiles.append((
+                tile_id,
+                hgfo.format_dense_tile(
+                    normalize(meta, raw[position], transform).ravel()
+                )
+            ))
+
+    return generated_tiles
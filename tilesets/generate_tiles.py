@@ -10,19 +10,28 @@ import clodius.tiles.bigwig as hgbi
 import clodius.tiles.bigbed as hgbb
 import clodius.tiles.cooler as hgco
 import clodius.tiles.geo as hggo
-import clodius.tiles.imtiles as hgim
+import clodius.tiles.imtiles as ctim
 import clodius.tiles.multivec as ctmu
+import clodius.tiles.time_interval as ctti
 import clodius.tiles.zarr as ctza
 
 import h5py
+import hashlib
 import itertools as it
+import json
+import math
 import numpy as np
 import os
+import requests
 import shutil
 import time
 import tempfile
+import urllib
 import tilesets.models as tm
 import tilesets.chromsizes  as tcs
+import tilesets.cooler_tiles as tct
+import tilesets.imtiles as tim
+import tilesets.tile_archive as tta
 
 import higlass.tilesets as hgti
 
@@ -109,6 +118,65 @@ def extract_tileset_uid(tile_id):
 def get_tileset_filetype(tileset):
     return tileset.filetype
 
+
+_mtimes = {}
+
+
+def get_mtime(path):
+    '''
+    Get the modification time of a file or `None` if it doesn't exist. The
+    time is only checked again after `TILESET_MTIME_INTERVAL` seconds.
+    '''
+    now = time.time()
+    checked_mtime = _mtimes.get(path)
+
+    if checked_mtime is None or now - checked_mtime[0] >= hss.TILESET_MTIME_INTERVAL:
+        checked_mtime = (
+            now, os.path.getmtime(path) if os.path.isfile(path) else None
+        )
+        _mtimes[path] = checked_mtime
+
+    return checked_mtime[1]
+
+
+def tileset_version(tileset):
+    '''
+    Get a version string of a tileset that changes whenever its data
+    files or the metadata that is sent to clients change.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset
+        The tileset
+
+    Returns
+    -------
+    version: str
+        A hash of the tileset's metadata, its generation and the mtimes of
+        its files
+    '''
+    parts = [
+        tileset.uuid,
+        tileset.generation,
+        tileset.filetype,
+        tileset.datatype,
+        tileset.name,
+        tileset.coordSystem,
+        tileset.coordSystem2,
+        tileset.private,
+    ]
+
+    for datafile in [tileset.datafile, tileset.indexfile]:
+        if not datafile:
+            parts += [None, None]
+            continue
+
+        path = datafile.path
+        parts += [path, get_mtime(path)]
+
+    return hashlib.md5(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
 def generate_1d_tiles(filename, tile_ids, get_data_function, tileset_options):
     '''
     Generate a set of tiles for the given tile_ids.
@@ -525,7 +593,7 @@ def generate_tiles(tileset_tile_ids):
     elif tileset.filetype == 'hibed':
         return generate_hibed_tiles(tileset, tile_ids)
     elif tileset.filetype == 'cooler':
-        return hgco.generate_tiles(tileset.datafile.path, tile_ids)
+        return tct.generate_tiles(tileset.datafile.path, tile_ids)
     elif tileset.filetype == 'bigwig':
         chromsizes = get_chromsizes(tileset)
         return hgbi.tiles(tileset.datafile.path, tile_ids, chromsizes=chromsizes)
@@ -545,7 +613,7 @@ def generate_tiles(tileset_tile_ids):
                 ctza.get_single_tile,
                 tileset_options)
     elif tileset.filetype == 'imtiles':
-        return hgim.get_tiles(tileset.datafile.path, tile_ids, raw)
+        return tim.get_tiles(tileset.datafile.path, tile_ids, raw)
     elif tileset.filetype == 'bam':
         return ctb.tiles(
             tileset.datafile.path,
@@ -553,6 +621,8 @@ def generate_tiles(tileset_tile_ids):
             index_filename=tileset.indexfile.path,
             max_tile_width=hss.MAX_BAM_TILE_WIDTH
         )
+    elif tileset.filetype == 'tilearchive':
+        return tta.tiles(tileset.datafile.path, tile_ids)
     else:
         filetype = tileset.filetype
         filepath = tileset.datafile.path
@@ -563,3 +633,108 @@ def generate_tiles(tileset_tile_ids):
         return [(ti, {'error': 'Unknown tileset filetype: {}'.format(tileset.filetype)}) for ti in tile_ids]
 
 
+
+
+def get_tileset_info(tileset):
+    '''
+    Get the information that clients need to display a tileset, such as
+    its extent, tile size and max zoom level.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset
+        The tileset
+
+    Returns
+    -------
+    tileset_info: dict
+        The tileset info or a dict with an 'error' entry
+    '''
+    if (
+        tileset.filetype == 'hitile' or
+        tileset.filetype == 'hibed'
+    ):
+        tileset_info = hdft.get_tileset_info(
+            h5py.File(tileset.datafile.path, 'r'))
+        tsinfo = {
+            "min_pos": [int(tileset_info['min_pos'])],
+            "max_pos": [int(tileset_info['max_pos'])],
+            "max_width": 2 ** math.ceil(
+                math.log(
+                    tileset_info['max_pos'] - tileset_info['min_pos']
+                ) / math.log(2)
+            ),
+            "tile_size": int(tileset_info['tile_size']),
+            "max_zoom": int(tileset_info['max_zoom'])
+        }
+    elif tileset.filetype == 'bigwig':
+        chromsizes = get_chromsizes(tileset)
+        tsinfo = hgbi.tileset_info(
+                tileset.datafile.path,
+                chromsizes
+            )
+        if 'chromsizes' in tsinfo:
+            tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
+        if tileset.indexfile != None and tileset.indexfile.path != None:
+            info_url = tileset.indexfile.path
+            if info_url.startswith(hss.MEDIA_ROOT) and info_url[len(hss.MEDIA_ROOT)+1:].startswith("http"):
+                info_url = info_url[len(hss.MEDIA_ROOT)+1:-2]
+                if info_url.startswith("https"):
+                    info_url = info_url.replace("https/", "https://")
+                elif info_url.startswith("http"):
+                    info_url = info_url.replace("http/", "http://")
+
+                r = requests.get(info_url)
+                if r.ok:
+                    try:
+                        tsinfo['rowinfo'] = json.dumps(r.json())
+                    except:
+                        tsinfo['rowinfo'] = json.dumps(dict())
+    elif tileset.filetype == 'bigbed':
+        chromsizes = get_chromsizes(tileset)
+        tsinfo = hgbi.tileset_info(
+                tileset.datafile.path,
+                chromsizes
+            )
+        if 'chromsizes' in tsinfo:
+            tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
+    elif tileset.filetype == 'multivec':
+        tsinfo = ctmu.tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'zarr':
+        tsinfo = ctza.tileset_info(tileset.datafile.path)
+    elif tileset.filetype == "elastic_search":
+        response = urllib.urlopen(
+            tileset.datafile + "/tileset_info")
+        tsinfo = json.loads(response.read())
+    elif tileset.filetype == 'beddb':
+        tsinfo = cdt.get_tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'bed2ddb':
+        tsinfo = cdt.get_2d_tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'cooler':
+        tsinfo = hgco.tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'time-interval-json':
+        tsinfo = ctti.tileset_info(tileset.datafile.path)
+    elif (
+        tileset.filetype == '2dannodb' or
+        tileset.filetype == 'imtiles'
+    ):
+        tsinfo = ctim.get_tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'geodb':
+        tsinfo = hggo.tileset_info(tileset.datafile.path)
+    elif tileset.filetype == 'bam':
+        tsinfo = ctb.tileset_info(tileset.datafile.path)
+        tsinfo['max_tile_width'] = hss.MAX_BAM_TILE_WIDTH
+    elif tileset.filetype == 'tilearchive':
+        tsinfo = tta.tileset_info(tileset.datafile.path)
+    else:
+        # Unknown filetype
+        tsinfo = {
+            'error': 'Unknown filetype ' + tileset.filetype
+        }
+
+    tsinfo['name'] = tileset.name
+    tsinfo['datatype'] = tileset.datatype
+    tsinfo['coordSystem'] = tileset.coordSystem
+    tsinfo['coordSystem2'] = tileset.coordSystem2
+
+    return tsinfo
@@ -0,0 +1,190 @@
+import base64
+import collections as col
+import os
+import sqlite3
+import threading
+
+from io import BytesIO
+from PIL import Image
+from urllib.request import pathname2url
+
+MAX_VARS = 450
+
+_local = threading.local()
+
+
+def get_db(filename):
+    '''
+    Get a read-only SQLite connection to an imtiles file that stays open
+    across requests. Connections are kept per thread because SQLite
+    connections must not be shared between threads, and they are reopened
+    when the file changes.
+    '''
+    if not hasattr(_local, 'dbs'):
+        _local.dbs = {}
+
+    mtime = os.path.getmtime(filename)
+
+    try:
+        db_mtime, db, info = _local.dbs[filename]
+        if db_mtime == mtime:
+            return db, info
+        db.close()
+    except KeyError:
+        pass
+
+    db = sqlite3.connect(
+        'file:{}?mode=ro'.format(pathname2url(filename)), uri=True
+    )
+    info = db.execute('SELECT * FROM tileset_info').fetchone()
+
+    _local.dbs[filename] = (mtime, db, info)
+
+    return db, info
+
+
+class TileCache:
+    '''
+    Bounded LRU of imtiles tiles that reads missing tiles with a single
+    query per batch and decodes every tile at most once.
+
+    Args:
+
+    filename (str): Path to the imtiles file
+    max_size (int): Max number of tiles to keep
+    '''
+    def __init__(self, filename, max_size=64):
+        self.db, self.info = get_db(filename)
+        self.max_size = max_size
+        self._blobs = col.OrderedDict()
+        self._images = {}
+
+    def _put(self, key, blob):
+        self._blobs[key] = blob
+        self._blobs.move_to_end(key)
+
+        while len(self._blobs) > self.max_size:
+            old_key, _ = self._blobs.popitem(last=False)
+            self._images.pop(old_key, None)
+
+    def load(self, z, xs, ys, xys=None):
+        '''
+        Make sure that the tiles of the cross product of `xs` and `ys` at
+        zoom level `z`, or only the `(x, y)` pairs of `xys` if given, are
+        cached.
+        '''
+        xs = sorted(set(xs))
+        ys = sorted(set(ys))
+
+        if xys is None:
+            xys = [(x, y) for y in ys for x in xs]
+
+        missing = [(x, y) for x, y in xys if (z, x, y) not in self._blobs]
+
+        if not missing:
+            return
+
+        found = {}
+
+        # Consecutive ranges can use the index on (z, y, x) as a range
+        if xs[-1] - xs[0] + 1 == len(xs) and ys[-1] - ys[0] + 1 == len(ys):
+            res = self.db.execute(
+                'SELECT x, y, image FROM tiles '
+                'WHERE z = ? AND y BETWEEN ? AND ? AND x BETWEEN ? AND ?',
+                (z, ys[0], ys[-1], xs[0], xs[-1])
+            )
+            found.update(((x, y), blob) for x, y, blob in res)
+        else:
+            # Stay below SQLite's limit of 999 variables per query
+            for i in range(0, len(ys), MAX_VARS):
+                for j in range(0, len(xs), MAX_VARS):
+                    ys_chunk = ys[i:i + MAX_VARS]
+                    xs_chunk = xs[j:j + MAX_VARS]
+                    res = self.db.execute(
+                        'SELECT x, y, image FROM tiles '
+                        'WHERE z = ? AND y IN ({}) AND x IN ({})'.format(
+                            ','.join('?' * len(ys_chunk)),
+                            ','.join('?' * len(xs_chunk))
+                        ),
+                        [z] + ys_chunk + xs_chunk
+                    )
+                    found.update(((x, y), blob) for x, y, blob in res)
+
+        for x, y in missing:
+            self._put((z, x, y), found.get((x, y)))
+
+    def blob(self, z, x, y):
+        key = (z, x, y)
+
+        if key not in self._blobs:
+            self.load(z, [x], [y])
+
+        self._blobs.move_to_end(key)
+
+        return self._blobs[key]
+
+    def image(self, z, x, y):
+        key = (z, x, y)
+
+        if key not in self._images:
+            blob = self.blob(z, x, y)
+            self._images[key] = (
+                Image.open(BytesIO(blob)) if blob is not None else None
+            )
+        else:
+            self._blobs.move_to_end(key)
+
+        return self._images[key]
+
+
+def get_tiles(filename, tile_ids, raw):
+    '''
+    Retrieve tiles from an imtiles file. Same output as
+    `clodius.tiles.imtiles.get_tiles` but reading the tiles of every zoom
+    level with a single query.
+
+    Parameters
+    ----------
+    filename: str
+        The path to the imtiles file
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0.1) identifying the tiles
+        to be retrieved
+    raw: bool
+        If true, return the image blobs rather than base64 encoded strings
+    Returns
+    -------
+    generated_tiles: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples
+    '''
+    positions = {}
+    by_zoom = col.defaultdict(list)
+
+    for tile_id in tile_ids:
+        z, y, x = map(int, tile_id[tile_id.find('.') + 1:].split('.')[:3])
+        positions[tile_id] = (z, x, y)
+        by_zoom[z].append((x, y))
+
+    cache = TileCache(filename, max_size=max(len(tile_ids), 1))
+
+    for z, xys in by_zoom.items():
+        cache.load(z, [x for x, y in xys], [y for x, y in xys], xys)
+
+    generated_tiles = []
+
+    for tile_id in tile_ids:
+        blob = cache.blob(*positions[tile_id])
+
+        if blob is None:
+            continue
+
+        if raw:
+            tile_data = {'image': blob}
+        else:
+            tile_data = {
+                'dense': base64.b64encode(blob).decode('latin-1'),
+            }
+
+        generated_tiles.append((tile_id, tile_data))
+
+    return generated_tiles
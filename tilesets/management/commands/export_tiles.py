@@ -0,0 +1,301 @@
+from django.core.management.base import BaseCommand, CommandError
+import django.db as db
+import multiprocessing as mp
+import os
+import re
+import time
+import tilesets.chromsizes as tcs
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+import tilesets.tile_cache as ttc
+import tilesets.warmup as twu
+
+from tilesets.tile_archive import TileArchiveWriter
+
+REGION = re.compile(r'^(?P<chrom>[^:]+)(:(?P<start>[\d,]+)-(?P<end>[\d,]+))?$')
+
+
+def get_region_chromsizes(tileset, tileset_info):
+    '''
+    Get the chromosome sizes that the coordinates of a tileset refer to.
+    '''
+    if 'chromsizes' in tileset_info:
+        return tileset_info['chromsizes']
+
+    if tileset.filetype == 'cooler':
+        return tcs.get_cooler_chromsizes(tileset.datafile.path)
+
+    if tileset.filetype == 'multivec':
+        return tcs.get_multivec_chromsizes(tileset.datafile.path)
+
+    return tgt.get_chromsizes(tileset)
+
+
+def parse_region(region, chromsizes):
+    '''
+    Convert a region (e.g., 'chr1' or 'chr1:1,000,000-2,000,000') to
+    absolute coordinates.
+
+    Return:
+
+    (tuple): The start and end of the region
+    '''
+    match = REGION.match(region)
+
+    if match is None:
+        raise CommandError('Invalid region: {}'.format(region))
+
+    offset = 0
+
+    for chrom, size in chromsizes or []:
+        size = int(size)
+
+        if chrom == match.group('chrom'):
+            if match.group('start') is None:
+                return (offset, offset + size)
+
+            start = int(match.group('start').replace(',', ''))
+            end = int(match.group('end').replace(',', ''))
+
+            return (offset + start, offset + min(end, size))
+
+        offset += size
+
+    raise CommandError('Unknown chromosome: {}'.format(match.group('chrom')))
+
+
+def get_max_zoom(tileset_info):
+    if 'resolutions' in tileset_info:
+        return len(tileset_info['resolutions']) - 1
+
+    return int(tileset_info['max_zoom'])
+
+
+def get_pyramid_tile_ids(tileset_uuid, tileset_info, zoom_level, bounds=None):
+    '''
+    Get the ids of the tiles of a zoom level, optionally only those
+    overlapping `bounds` along every dimension.
+    '''
+    dims = len(tileset_info['min_pos'])
+    positions = [
+        twu.get_tile_positions(
+            tileset_info,
+            zoom_level,
+            bounds or (tileset_info['min_pos'][dim], tileset_info['max_pos'][dim]),
+            dim
+        )
+        for dim in range(dims)
+    ]
+
+    if dims == 1:
+        return [
+            '{}.{}.{}'.format(tileset_uuid, zoom_level, x)
+            for x in positions[0]
+        ]
+
+    return [
+        '{}.{}.{}.{}'.format(tileset_uuid, zoom_level, x, y)
+        for x in positions[0]
+        for y in positions[1]
+    ]
+
+
+def get_transforms(tileset, tileset_info):
+    '''
+    Get the transforms that tiles of a tileset can be requested with. Only
+    cooler tiles have transforms.
+    '''
+    if tileset.filetype != 'cooler':
+        return [None]
+
+    transforms = ['default', 'none']
+
+    for transform in tileset_info.get('transforms') or []:
+        if transform['value'] not in transforms:
+            transforms.append(transform['value'])
+
+    return transforms
+
+
+def generate_chunk(tileset_tile_ids):
+    '''
+    Generate a chunk of tiles in a worker process.
+    '''
+    tileset, tile_ids = tileset_tile_ids
+
+    return list(tgt.generate_tiles((tileset, tile_ids, False, None)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate the tiles of a tileset down to a zoom level into the tile '
+        'cache or a tile archive. Tiles that are there already are skipped, '
+        'so an interrupted export can be run again to continue.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, required=True)
+        parser.add_argument('--min-zoom', type=int, default=0)
+        parser.add_argument('--max-zoom', type=int)
+        parser.add_argument(
+            '--region', type=str,
+            help='Only export the tiles of a region, e.g., chr1:1000000-2000000'
+        )
+        parser.add_argument(
+            '--output', type=str,
+            help='Write the tiles into this tile archive instead of the cache'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1
+        )
+        parser.add_argument('--chunk-size', type=int, default=32)
+        parser.add_argument(
+            '--report-interval', type=float, default=10,
+            help='Seconds between progress reports'
+        )
+        parser.add_argument(
+            '--force', action='store_true', default=False,
+            help='Generate tiles that are there already again'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            tileset = tm.Tileset.objects.get(uuid=options['uuid'])
+        except tm.Tileset.DoesNotExist:
+            raise CommandError(
+                'Instance for specified uuid ({}) was not found'.format(
+                    options['uuid']
+                )
+            )
+
+        tileset_info = tgt.get_tileset_info(tileset)
+
+        if 'error' in tileset_info:
+            raise CommandError(tileset_info['error'])
+
+        if 'min_pos' not in tileset_info:
+            raise CommandError(
+                'Tilesets of type {} cannot be exported'.format(
+                    tileset.filetype
+                )
+            )
+
+        max_zoom = get_max_zoom(tileset_info)
+
+        if options['max_zoom'] is not None:
+            max_zoom = min(max_zoom, options['max_zoom'])
+
+        bounds = None
+
+        if options['region']:
+            bounds = parse_region(
+                options['region'],
+                get_region_chromsizes(tileset, tileset_info)
+            )
+
+        writer = None
+
+        if options['output']:
+            writer = TileArchiveWriter(options['output'])
+
+        def get_cache_key(tile_id):
+            if tileset.filetype == 'cooler':
+                tile_id = ttc.add_transform_type(tile_id)
+
+            return ttc.get_cache_key(tile_id, generation=tileset.generation)
+
+        def is_done(tile_id):
+            if options['force']:
+                return False
+
+            if writer is not None:
+                return tile_id in writer
+
+            return ttc.is_cached(get_cache_key(tile_id))
+
+        # Archives are served instead of the tileset, so they need the
+        # tiles of every transform
+        tile_ids = [
+            tile_id if transform is None else '{}.{}'.format(tile_id, transform)
+            for zoom_level in range(options['min_zoom'], max_zoom + 1)
+            for transform in get_transforms(tileset, tileset_info)
+            for tile_id in get_pyramid_tile_ids(
+                tileset.uuid, tileset_info, zoom_level, bounds
+            )
+        ]
+        todo = [tile_id for tile_id in tile_ids if not is_done(tile_id)]
+
+        self.stdout.write('{} tiles, {} to generate'.format(
+            len(tile_ids), len(todo)
+        ))
+
+        # Tiles of a chunk are adjacent, so generators that fetch whole
+        # blocks of data can share them
+        chunk_size = options['chunk_size']
+        chunks = [
+            (tileset, todo[i:i + chunk_size])
+            for i in range(0, len(todo), chunk_size)
+        ]
+
+        finished = False
+        num_tiles = 0
+        num_bytes = 0
+        start = time.time()
+        last_report = start
+
+        pool = None
+
+        try:
+            if options['processes'] > 1:
+                # Worker processes must not share the connections of this one
+                db.connections.close_all()
+
+                pool = mp.Pool(options['processes'])
+                results = pool.imap_unordered(generate_chunk, chunks)
+            else:
+                results = map(generate_chunk, chunks)
+
+            for tiles in results:
+                for tile_id, tile_value in tiles:
+                    if writer is not None:
+                        num_bytes += writer.add(tile_id, tile_value)
+                    else:
+                        ttc.set_cached_tile(
+                            get_cache_key(tile_id),
+                            tile_value,
+                            ttc.get_ttl(tileset.filetype, tile_id)
+                        )
+
+                num_tiles += len(tiles)
+
+                if time.time() - last_report >= options['report_interval']:
+                    last_report = time.time()
+                    self.report(num_tiles, len(todo), num_bytes, start)
+
+                    # Whatever has been reported is kept if interrupted
+                    if writer is not None:
+                        writer.flush()
+
+            finished = True
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+            if writer is not None:
+                if finished:
+                    writer.finish(tileset_info)
+                else:
+                    writer.close()
+
+        self.report(num_tiles, len(todo), num_bytes, start)
+
+    def report(self, num_tiles, total, num_bytes, start):
+        elapsed = max(time.time() - start, 1e-6)
+        message = '{}/{} tiles, {:.1f} tiles/s'.format(
+            num_tiles, total, num_tiles / elapsed
+        )
+
+        if num_bytes:
+            message += ', {:.2f} MB/s'.format(num_bytes / elapsed / 1e6)
+
+        self.stdout.write(message)
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import django.core.management as dcm
+import os
+import os.path as op
+import tilesets.models as tm
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate all tiles of a tileset into a tile archive and serve the '
+        'tileset from the archive from then on. The original file is kept.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, required=True)
+        parser.add_argument('--max-zoom', type=int)
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        uuid = options['uuid']
+
+        try:
+            tileset = tm.Tileset.objects.get(uuid=uuid)
+        except tm.Tileset.DoesNotExist:
+            raise CommandError(
+                'Instance for specified uuid ({}) was not found'.format(uuid)
+            )
+
+        if tileset.filetype == 'tilearchive':
+            raise CommandError('Tileset {} is frozen already'.format(uuid))
+
+        filename = op.join('uploads', '{}.tiles'.format(uuid))
+
+        dcm.call_command(
+            'export_tiles',
+            uuid=uuid,
+            max_zoom=options['max_zoom'],
+            output=op.join(settings.MEDIA_ROOT, filename),
+            processes=options['processes'],
+            stdout=self.stdout,
+            stderr=self.stderr
+        )
+
+        original = tileset.datafile.name
+
+        tileset.filetype = 'tilearchive'
+        tileset.datafile.name = filename
+        tileset.save()
+
+        self.stdout.write('Froze {} (original file: {})'.format(uuid, original))
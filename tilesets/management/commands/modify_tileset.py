@@ -3,15 +3,26 @@ from django.db.models import ProtectedError
 from django.conf import settings
 import tilesets.models as tm
 import os
+import os.path as op
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--uuid', type=str, required=True)
         parser.add_argument('--name', type=str)
+        parser.add_argument(
+            '--datafile', type=str,
+            help='Point the tileset to another file under the media root'
+        )
+        parser.add_argument(
+            '--indexfile', type=str,
+            help='Point the tileset to another index file under the media root'
+        )
         
     def handle(self, *args, **options):
         uuid = options.get('uuid')
         name = options.get('name')
+        datafile = options.get('datafile')
+        indexfile = options.get('indexfile')
         
         # search for Django object, modify associated record
         instance = tm.Tileset.objects.get(uuid=uuid)
@@ -26,6 +37,37 @@ class Command(BaseCommand):
                 if name and name != instance.name:
                     instance.name = name
                     instance_dirty = True
+
+                # changing the files bumps the generation of the tileset,
+                # which invalidates its cached tiles
+                for field, filename in (
+                    ('datafile', datafile), ('indexfile', indexfile)
+                ):
+                    if not filename:
+                        continue
+
+                    # file fields store paths relative to the media root
+                    media_root = op.abspath(settings.MEDIA_ROOT)
+                    filepath = op.abspath(op.join(media_root, filename))
+
+                    if op.commonpath([media_root, filepath]) != media_root:
+                        raise CommandError(
+                            'File is not under media root: {}'.format(filename)
+                        )
+
+                    if not op.isfile(filepath):
+                        raise CommandError(
+                            'File does not exist under media root: {}'.format(
+                                filename
+                            )
+                        )
+
+                    filename = op.relpath(filepath, media_root)
+                    current = getattr(instance, field).name
+
+                    if not current or op.normpath(current) != filename:
+                        setattr(instance, field, filename)
+                        instance_dirty = True
                     
                 # if any changes were applied, persist them
                 if instance_dirty:
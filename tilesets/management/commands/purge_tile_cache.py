@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+import tilesets.models as tm
+import tilesets.tile_cache as ttc
+
+
+class Command(BaseCommand):
+    help = (
+        'Invalidate the cached tiles of tilesets by bumping their '
+        'generation and optionally remove them from Redis and the shared '
+        'memory cache of this host'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--uuid', type=str, action='append', required=True,
+            help='Tileset to purge, can be given several times'
+        )
+        parser.add_argument(
+            '--delete', action='store_true', default=False,
+            help=(
+                'Remove the tiles right away instead of leaving them to '
+                'expire, which scans all keys'
+            )
+        )
+
+    def handle(self, *args, **options):
+        for uuid in options['uuid']:
+            for tileset in tm.Tileset.objects.filter(uuid=uuid):
+                tileset.bump_generation()
+
+                self.stdout.write('{}: now at generation {}'.format(
+                    uuid, tileset.generation
+                ))
+
+            if options['delete']:
+                num_redis, num_shm = ttc.delete_tiles(uuid)
+
+                self.stdout.write(
+                    '{}: {} tiles removed from Redis, {} from shared memory'.format(
+                        uuid, num_redis, num_shm
+                    )
+                )
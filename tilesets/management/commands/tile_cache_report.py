@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+import higlass_server.settings as hss
+import tilesets.models as tm
+import tilesets.tile_cache as ttc
+
+from higlass_server.utils import EmptyRDB
+
+
+class Command(BaseCommand):
+    help = (
+        'Report the number of cached tiles, their size and the hit ratio '
+        'of every tileset'
+    )
+
+    def handle(self, *args, **options):
+        usage = ttc.get_usage()
+        stats = ttc.get_stats()
+        uuids = set(usage) | set(stats)
+
+        names = dict(
+            tm.Tileset.objects.filter(uuid__in=uuids).values_list('uuid', 'name')
+        )
+
+        self.stdout.write('{:<24} {:<24} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'uuid', 'name', 'tiles', 'MB', 'shm tiles', 'shm MB', 'hit ratio'
+        ))
+
+        # Tilesets that take up the most space first
+        for uuid in sorted(uuids, key=lambda uuid: -usage[uuid]['redis'][1]):
+            redis_tiles, redis_bytes = usage[uuid]['redis']
+            shm_tiles, shm_bytes = usage[uuid]['shm']
+            tileset_stats = stats.get(uuid, {'hits': 0, 'misses': 0})
+            requests = tileset_stats['hits'] + tileset_stats['misses']
+
+            self.stdout.write(
+                '{:<24} {:<24} {:>10} {:>10.2f} {:>10} {:>10.2f} {:>10}'.format(
+                    uuid[:24],
+                    (names.get(uuid) or '')[:24],
+                    redis_tiles,
+                    redis_bytes / 1e6,
+                    shm_tiles,
+                    shm_bytes / 1e6,
+                    '{:.1%}'.format(tileset_stats['hits'] / requests)
+                    if requests else '-'
+                )
+            )
+
+        self.stdout.write('Total: {} tiles, {:.2f} MB in Redis'.format(
+            sum(u['redis'][0] for u in usage.values()),
+            sum(u['redis'][1] for u in usage.values()) / 1e6
+        ))
+
+        if hss.TILE_CACHE_MAX_BYTES and not isinstance(ttc.rdb, EmptyRDB):
+            self.stdout.write('Estimated size: {:.2f} MB of {:.2f} MB'.format(
+                ttc.estimate_size()[0] / 1e6, hss.TILE_CACHE_MAX_BYTES / 1e6
+            ))
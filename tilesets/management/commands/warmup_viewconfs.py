@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+import tilesets.models as tm
+import tilesets.warmup as twu
+
+
+class Command(BaseCommand):
+    help = 'Generate the tiles visible in the initial views of viewconfs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--uuid', type=str, action='append',
+            help='Viewconf to warm up, can be given several times'
+        )
+        parser.add_argument(
+            '--recent', type=int, default=100,
+            help='Warm up the most recent viewconfs if no uuid is given'
+        )
+        parser.add_argument('--max-tiles', type=int)
+
+    def handle(self, *args, **options):
+        uuids = options.get('uuid')
+
+        if uuids:
+            viewconfs = tm.ViewConf.objects.filter(uuid__in=uuids)
+            missing = set(uuids) - set(v.uuid for v in viewconfs)
+
+            if missing:
+                raise CommandError(
+                    'No viewconfs with uuids: {}'.format(', '.join(missing))
+                )
+        else:
+            viewconfs = tm.ViewConf.objects.order_by('-created')[
+                :options['recent']
+            ]
+
+        for viewconf in viewconfs:
+            try:
+                num_tiles = twu.warmup_viewconf(
+                    viewconf.viewconf, options.get('max_tiles')
+                )
+            except Exception as ex:
+                self.stderr.write(
+                    'Could not warm up {}: {!r}'.format(viewconf.uuid, ex)
+                )
+                continue
+
+            self.stdout.write('{}: {} tiles'.format(viewconf.uuid, num_tiles))
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.11 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tilesets', '0012_auto_20190923_0257'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='viewconf',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='viewconf',
+            name='viewconf_gz',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.11 on 2026-10-19 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tilesets', '0013_viewconf_gz'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='generation',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
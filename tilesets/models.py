@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 import django
 import django.contrib.auth.models as dcam
+import gzip
+import hashlib
 import slugid
 
 from django.db import models
@@ -13,6 +15,11 @@ class ViewConf(models.Model):
     uuid = models.CharField(max_length=100, unique=True, default=slugid.nice)
     viewconf = models.TextField()
 
+    # The gzipped viewconf and the hash of the viewconf, computed on save so
+    # that reads can serve the bytes as they are
+    viewconf_gz = models.BinaryField(blank=True, null=True, editable=False)
+    etag = models.CharField(max_length=32, blank=True, default='')
+
     class Meta:
         ordering = ('created',)
 
@@ -23,6 +30,19 @@ class ViewConf(models.Model):
         '''
         return "Viewconf [uuid: {}]".format(self.uuid)
 
+    def compress(self):
+        '''
+        Compute the gzipped viewconf and its hash.
+        '''
+        data = self.viewconf.encode('utf-8')
+
+        self.viewconf_gz = gzip.compress(data)
+        self.etag = hashlib.md5(data).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.compress()
+        super().save(*args, **kwargs)
+
 def decoded_slugid():
     return slugid.nice()
 
@@ -73,6 +93,10 @@ class Tileset(models.Model):
     private = models.BooleanField(default=False)
     name = models.TextField(blank=True)
 
+    # Bumped whenever the data files change, so that everything cached for
+    # the tileset (e.g., tiles) is invalidated at once
+    generation = models.IntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ('created',)
         permissions = (('read', "Read permission"),
@@ -86,3 +110,42 @@ class Tileset(models.Model):
         admin interface.
         '''
         return "Tileset [name: {}] [ft: {}] [uuid: {}]".format(self.name, self.filetype, self.uuid)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # Remember the files that were loaded to see if they change
+        instance._loaded_files = {
+            name: value or None
+            for name, value in zip(field_names, values)
+            if name in ('datafile', 'indexfile')
+        }
+
+        return instance
+
+    def _files_changed(self):
+        return any(
+            (getattr(self, name).name or None) != loaded
+            for name, loaded in getattr(self, '_loaded_files', {}).items()
+        )
+
+    def save(self, *args, **kwargs):
+        if self._files_changed():
+            self.generation += 1
+
+        super().save(*args, **kwargs)
+
+        self._loaded_files = {
+            name: getattr(self, name).name or None
+            for name in ('datafile', 'indexfile')
+        }
+
+    def bump_generation(self):
+        '''
+        Invalidate everything that is cached for this tileset.
+        '''
+        Tileset.objects.filter(pk=self.pk).update(
+            generation=models.F('generation') + 1
+        )
+        self.refresh_from_db(fields=['generation'])
@@ -1,4 +1,161 @@
+import collections as col
+import numpy as np
+import os
 import sqlite3
+import threading
+
+from urllib.request import pathname2url
+
+# Max length of the substrings that are indexed
+MAX_GRAM = 3
+
+
+class SuggestionIndex:
+    '''
+    In-memory substring index over the gene names of a beddb file.
+
+    The genes are ranked by importance once and every 1-, 2- and 3-letter
+    substring of a lowercased gene name maps to the ranks of the genes
+    containing it. Posting lists are therefore sorted by importance, so a
+    query only has to walk the shortest posting list of its substrings
+    until it has found enough genes.
+
+    Args:
+
+    db_file (str): The filename for the SQLite file containing gene
+        annotations
+    '''
+    def __init__(self, db_file):
+        con = sqlite3.connect(
+            'file:{}?mode=ro'.format(pathname2url(db_file)), uri=True
+        )
+        try:
+            rows = con.execute(
+                'SELECT importance, fields FROM intervals '
+                'ORDER BY importance DESC'
+            ).fetchall()
+        finally:
+            con.close()
+
+        # Only the columns of the suggestions are kept, as parallel arrays
+        chroms = {}
+        self.chroms = []
+        self.gene_names = []
+        self.names = []
+        self.importances = []
+        self.starts = np.empty(len(rows), dtype=np.int64)
+        self.ends = np.empty(len(rows), dtype=np.int64)
+
+        for rank, (importance, fields) in enumerate(rows):
+            chrom, start, end, gene_name = fields.split('\t', 4)[:4]
+            name = gene_name.lower()
+
+            self.chroms.append(chroms.setdefault(chrom, chrom))
+            self.gene_names.append(gene_name)
+            self.names.append(gene_name if name == gene_name else name)
+            self.importances.append(importance)
+            self.starts[rank] = int(start)
+            self.ends[rank] = int(end)
+
+        # Free the rows before building the postings
+        del rows
+
+        postings = col.defaultdict(list)
+
+        for rank, name in enumerate(self.names):
+            grams = set(
+                name[i:i + n]
+                for n in range(1, MAX_GRAM + 1)
+                for i in range(len(name) - n + 1)
+            )
+            for gram in grams:
+                postings[gram].append(rank)
+
+        self.postings = {
+            gram: np.array(ranks, dtype=np.int32)
+            for gram, ranks in postings.items()
+        }
+
+    def candidates(self, text):
+        '''
+        Get the ranks of the genes that might contain `text` in order of
+        importance. Queries no longer than `MAX_GRAM` are answered exactly.
+        '''
+        n = min(len(text), MAX_GRAM)
+        empty = np.array([], dtype=np.int32)
+
+        return min(
+            (
+                self.postings.get(text[i:i + n], empty)
+                for i in range(len(text) - n + 1)
+            ),
+            key=len
+        )
+
+    def search(self, text, limit=10):
+        text = text.lower()
+
+        # Every gene contains the empty string
+        candidates = (
+            self.candidates(text) if text else range(len(self.names))
+        )
+
+        ranks = []
+        exact = len(text) <= MAX_GRAM
+
+        for rank in candidates:
+            if exact or text in self.names[rank]:
+                ranks.append(rank)
+
+                if len(ranks) == limit:
+                    break
+
+        return [
+            {
+                'chr': self.chroms[rank],
+                'txStart': int(self.starts[rank]),
+                'txEnd': int(self.ends[rank]),
+                'score': self.importances[rank],
+                'geneName': self.gene_names[rank]
+            }
+            for rank in ranks
+        ]
+
+
+_indices = {}
+_index_locks = {}
+_indices_lock = threading.Lock()
+
+
+def get_suggestion_index(db_file):
+    '''
+    Get the suggestion index of a beddb file, building it lazily and only
+    once until the file changes.
+    '''
+    mtime = os.path.getmtime(db_file)
+
+    with _indices_lock:
+        mtime_index = _indices.get(db_file)
+
+        if mtime_index is not None and mtime_index[0] == mtime:
+            return mtime_index[1]
+
+        index_lock = _index_locks.setdefault(db_file, threading.Lock())
+
+    # Building an index takes a while, so only requests for the same file
+    # wait for it
+    with index_lock:
+        with _indices_lock:
+            mtime_index = _indices.get(db_file)
+
+        if mtime_index is None or mtime_index[0] != mtime:
+            mtime_index = (mtime, SuggestionIndex(db_file))
+
+            with _indices_lock:
+                _indices[db_file] = mtime_index
+
+    return mtime_index[1]
+
 
 def get_gene_suggestions(db_file, text):
     '''
@@ -15,30 +172,4 @@ def get_gene_suggestions(db_file, text):
     suggestions (list): A list of dictionaries containing the suggestions:
         e.g. ([{'txStart': 10, 'txEnd': 20, 'score': 15, 'geneName': 'XV4'}])
     '''
-    con = sqlite3.connect(db_file)
-    c = con.cursor()
-
-    query = """
-        SELECT importance, chrOffset, fields FROM intervals
-        WHERE fields LIKE '%{}%'
-        ORDER BY importance DESC
-        LIMIT 10
-        """.format(text)
-
-    rows = c.execute(query).fetchall()
-
-    to_return = []
-    for (importance, chrOffset, fields) in rows:
-        field_parts = fields.split('\t')
-        to_return += [{
-                      'chr': field_parts[0],
-                      'txStart': int(field_parts[1]),
-                      'txEnd': int(field_parts[2]),
-                      'score': importance,
-                      'geneName': field_parts[3]}]
-
-    c.execute(query)
-
-
-
-    return to_return
+    return get_suggestion_index(db_file).search(text)
@@ -9,19 +9,34 @@ import django.db as db
 
 import base64
 import django.test as dt
+import gzip
 import h5py
 import clodius.tiles.cooler as hgco
+import cooler
 import json
 import logging
 import os
 import os.path as op
+import re
 import numpy as np
 import rest_framework.status as rfs
 import tilesets.models as tm
 import higlass_server.settings as hss
 import tilesets.generate_tiles as tgt
 import slugid
-
+import sqlite3
+import tempfile
+import tilesets.imtiles as tim
+import tilesets.cooler_cache as tcc
+import tilesets.cooler_tiles as tct
+import tilesets.suggestions as tsu
+import tilesets.tile_cache as ttc
+import tilesets.tile_archive as tta
+import tilesets.viewconf_cache as tvc
+import tilesets.warmup as twu
+
+from higlass_server.shm_cache import SharedMemoryCache
+from io import StringIO
 
 logger = logging.getLogger(__name__)
 
@@ -580,6 +595,70 @@ class ChromosomeSizes(dt.TestCase):
         assert(ret.status_code == 200)
         assert('offset' in data['chr1'])
 
+    def test_chromsizes_etag(self):
+        self.user1 = dcam.User.objects.create_user(
+            username='user1', password='pass'
+        )
+        upload_file = open('data/chromSizes.tsv', 'rb')
+        self.chroms = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(
+                upload_file.name, upload_file.read()
+            ),
+            filetype='chromsizes-tsv',
+            datatype='chromsizes',
+            coordSystem="hg19",
+            owner=self.user1,
+            uuid='cs-hg19'
+        )
+
+        url = '/api/v1/chrom-sizes/?id=cs-hg19&type=json&cum=1'
+        ret = self.client.get(url)
+        etag = ret['ETag']
+
+        self.assertEqual(ret.status_code, 200)
+
+        ret = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(ret.status_code, 304)
+        self.assertEqual(ret['ETag'], etag)
+
+        # The TSV is a different representation
+        ret = self.client.get(
+            '/api/v1/chrom-sizes/?id=cs-hg19', HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(ret.status_code, 200)
+        self.assertTrue(ret.content.startswith(b'chr1\t'))
+
+        # Changing the file invalidates the cached response
+        with open(self.chroms.datafile.path, 'w') as f:
+            f.write('chrA\t100\nchrB\t50\n')
+        os.utime(self.chroms.datafile.path, (0, 0))
+
+        ret = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(json.loads(ret.content.decode('utf-8')), {
+            'chrA': {'size': 100, 'offset': 0},
+            'chrB': {'size': 50, 'offset': 100},
+        })
+
+        ret = self.client.get('/api/v1/available-chrom-sizes/')
+        etag = ret['ETag']
+
+        ret = self.client.get(
+            '/api/v1/available-chrom-sizes/', HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(ret.status_code, 304)
+
+        self.chroms.name = 'hg19 chromosomes'
+        self.chroms.save()
+
+        ret = self.client.get(
+            '/api/v1/available-chrom-sizes/', HTTP_IF_NONE_MATCH=etag
+        )
+        data = json.loads(ret.content.decode('utf-8'))
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(data['results'][0]['name'], 'hg19 chromosomes')
+
     def test_chromsizes_from_cooler(self):
         self.user1 = dcam.User.objects.create_user(
             username='user1', password='pass'
@@ -636,6 +715,66 @@ class TilesetModelTest(dt.TestCase):
         cooler_string = str(self.cooler)
         self.assertTrue(cooler_string.find("name") > 0)
 
+    def test_generation(self):
+        upload_file = open('data/dixon2012-h1hesc-hindiii-allreps-filtered.1000kb.multires.cool', 'rb')
+        tileset = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name,
+            upload_file.read()),
+            filetype='cooler',
+            uuid='gen'
+        )
+        version = tgt.tileset_version(tileset)
+        key = ttc.get_cache_key('gen.0.0.0', generation=tileset.generation)
+
+        # Saving without touching the files keeps the generation
+        tileset = tm.Tileset.objects.get(uuid='gen')
+        tileset.name = 'renamed'
+        tileset.save()
+        self.assertEqual(tileset.generation, 0)
+
+        dcm.call_command(
+            'modify_tileset', uuid='gen', datafile=tileset.datafile.name
+        )
+        self.assertEqual(tm.Tileset.objects.get(uuid='gen').generation, 0)
+
+        # Pointing the tileset at another file bumps it
+        other_file = op.join(hss.MEDIA_ROOT, 'uploads', 'gen-other.cool')
+
+        with open(other_file, 'wb') as f:
+            f.write(b'')
+
+        dcm.call_command(
+            'modify_tileset', uuid='gen', datafile='uploads/gen-other.cool'
+        )
+        tileset = tm.Tileset.objects.get(uuid='gen')
+
+        self.assertEqual(tileset.generation, 1)
+        # The file is stored relative to the media root like uploads
+        self.assertEqual(tileset.datafile.name, 'uploads/gen-other.cool')
+
+        # Files outside of the media root are rejected
+        with self.assertRaises(dcm.CommandError):
+            dcm.call_command(
+                'modify_tileset', uuid='gen',
+                datafile='../' + op.basename(hss.MEDIA_ROOT) + '-other.cool'
+            )
+        self.assertNotEqual(tgt.tileset_version(tileset), version)
+        self.assertNotEqual(
+            ttc.get_cache_key('gen.0.0.0', generation=tileset.generation), key
+        )
+        self.assertEqual(
+            ttc.get_key_tileset_uuid(
+                ttc.get_cache_key('gen.0.0.0', generation=tileset.generation)
+            ),
+            'gen'
+        )
+
+        # Purging the tile cache bumps it as well
+        dcm.call_command('purge_tile_cache', uuid=['gen'], stdout=StringIO())
+        self.assertEqual(tm.Tileset.objects.get(uuid='gen').generation, 2)
+
+        os.remove(other_file)
+
 
 class UnknownTilesetTypeTest(dt.TestCase):
     def setUp(self):
@@ -743,6 +882,403 @@ class ViewConfTest(dt.TestCase):
             )
             assert(ret.status_code == 400)
 
+    def test_viewconf_etag(self):
+        tm.ViewConf.objects.create(uuid='etag', viewconf='{"hello": "sir"}')
+
+        ret = self.client.get('/api/v1/viewconfs/?d=etag')
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertTrue(ret['Cache-Control'].startswith('public'))
+
+        ret = self.client.get(
+            '/api/v1/viewconfs/?d=etag', HTTP_IF_NONE_MATCH=ret['ETag']
+        )
+        self.assertEqual(ret.status_code, 304)
+
+    def test_viewconf_gzip(self):
+        tm.ViewConf.objects.create(uuid='gz', viewconf='{"hello": "gzip"}')
+
+        ret = self.client.get(
+            '/api/v1/viewconfs/?d=gz', HTTP_ACCEPT_ENCODING='gzip, deflate'
+        )
+
+        self.assertEqual(ret['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', ret['Vary'])
+        self.assertEqual(
+            json.loads(gzip.decompress(ret.content).decode('utf-8')),
+            {'hello': 'gzip'}
+        )
+
+        # The plain and the gzipped viewconf are different representations
+        plain = self.client.get('/api/v1/viewconfs/?d=gz')
+
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertNotEqual(plain['ETag'], ret['ETag'])
+
+        # Viewconfs stored before they were compressed still work
+        tm.ViewConf.objects.filter(uuid='gz').update(viewconf_gz=None, etag='')
+        tvc.hot_cache.delete('gz')
+        tvc.rdb.delete(tvc.get_cache_key('gz'))
+
+        ret = self.client.get('/api/v1/viewconfs/?d=gz')
+
+        self.assertEqual(
+            json.loads(ret.content.decode('utf-8')), {'hello': 'gzip'}
+        )
+        self.assertIsNotNone(tm.ViewConf.objects.get(uuid='gz').viewconf_gz)
+
+        # Changes invalidate the cached viewconf
+        obj = tm.ViewConf.objects.get(uuid='gz')
+        obj.viewconf = '{"hello": "again"}'
+        obj.save()
+
+        ret = self.client.get('/api/v1/viewconfs/?d=gz')
+
+        self.assertEqual(
+            json.loads(ret.content.decode('utf-8')), {'hello': 'again'}
+        )
+
+
+class HttpCacheTest(dt.TestCase):
+    def setUp(self):
+        self.user1 = dcam.User.objects.create_user(
+            username='user1', password='pass'
+        )
+
+        self.tileset = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile('sizes.tsv', b'chr1\t100\n'),
+            filetype='chromsizes-tsv',
+            datatype='chromsizes',
+            coordSystem='hg19',
+            owner=self.user1,
+            uuid='cache-me'
+        )
+
+    def test_tileset_info_etag(self):
+        url = '/api/v1/tileset_info/?d=cache-me'
+        ret = self.client.get(url)
+        etag = ret['ETag']
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(
+            ret['Cache-Control'],
+            'public, max-age={}'.format(hss.HTTP_CACHE_MAX_AGE)
+        )
+
+        ret = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(ret.status_code, 304)
+
+        # Other tilesets make for a different response
+        ret = self.client.get(url + '&d=other', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(ret.status_code, 200)
+
+        # So does a change of the tileset
+        self.tileset.name = 'renamed'
+        self.tileset.save()
+
+        ret = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        content = json.loads(ret.content.decode('utf-8'))
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(content['cache-me']['name'], 'renamed')
+
+    def test_private_responses(self):
+        self.tileset.private = True
+        self.tileset.save()
+
+        ret = self.client.get('/api/v1/tileset_info/?d=cache-me')
+        self.assertTrue(ret['Cache-Control'].startswith('private'))
+        forbidden_etag = ret['ETag']
+
+        ret = self.client.get('/api/v1/chrom-sizes/?id=cache-me')
+        self.assertTrue(ret['Cache-Control'].startswith('private'))
+
+        # The owner gets a different response
+        self.client.login(username='user1', password='pass')
+
+        ret = self.client.get(
+            '/api/v1/tileset_info/?d=cache-me',
+            HTTP_IF_NONE_MATCH=forbidden_etag
+        )
+        content = json.loads(ret.content.decode('utf-8'))
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertNotEqual(content['cache-me'].get('error'), 'Forbidden')
+
+
+class TileCacheTest(dt.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.shm = ttc.shm
+        ttc.shm = SharedMemoryCache(
+            op.join(self.tmp_dir.name, 'tiles'), 1024 * 1024
+        )
+
+    def tearDown(self):
+        ttc.shm = self.shm
+        self.tmp_dir.cleanup()
+
+    def test_ttl(self):
+        ttl = hss.TILE_CACHE_TTLS.get('cooler', hss.TILE_CACHE_TTL)
+
+        # Coarse zoom levels are kept longer
+        self.assertEqual(
+            ttc.get_ttl('cooler', 'a.0.0.0'),
+            ttl * 2 ** hss.TILE_CACHE_COARSE_ZOOMS
+        )
+        self.assertEqual(
+            ttc.get_ttl('cooler', 'a.{}.0.0'.format(hss.TILE_CACHE_COARSE_ZOOMS)),
+            ttl
+        )
+        self.assertEqual(ttc.get_ttl('cooler', 'a.20.0.0'), ttl)
+
+    def test_purge(self):
+        ttc.set_cached_tile(ttc.get_cache_key('a.0.0'), {'dense': 'a'})
+        ttc.set_cached_tile(ttc.get_cache_key('a.1.1'), {'dense': 'b'})
+        ttc.set_cached_tile(ttc.get_cache_key('b.0.0'), {'dense': 'c'})
+
+        self.assertEqual(
+            ttc.get_cached_tile(ttc.get_cache_key('a.1.1')), {'dense': 'b'}
+        )
+
+        usage = ttc.get_usage()
+        self.assertEqual(usage['a']['shm'][0], 2)
+        self.assertEqual(usage['b']['shm'][0], 1)
+
+        out = StringIO()
+        dcm.call_command(
+            'purge_tile_cache', uuid=['a'], delete=True, stdout=out
+        )
+
+        self.assertIn('2 from shared memory', out.getvalue())
+        self.assertIsNone(ttc.get_cached_tile(ttc.get_cache_key('a.0.0')))
+        self.assertEqual(
+            ttc.get_cached_tile(ttc.get_cache_key('b.0.0')), {'dense': 'c'}
+        )
+
+        out = StringIO()
+        dcm.call_command('tile_cache_report', stdout=out)
+        self.assertRegex(out.getvalue(), r'(?m)^b\s')
+
+    def test_delete_tileset(self):
+        upload_file = open('data/wgEncodeCaltechRnaSeqHuvecR1x75dTh1014IlnaPlusSignalRep2.hitile', 'rb')
+        content = upload_file.read()
+
+        tileset = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name, content),
+            filetype='hitile',
+            uuid='deleted'
+        )
+        key = ttc.get_cache_key('deleted.0.0', generation=tileset.generation)
+        ttc.set_cached_tile(key, {'dense': 'old'})
+
+        tileset.delete()
+
+        # A tileset ingested again under the same uuid doesn't get the
+        # tiles of the deleted one
+        tileset = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name, content),
+            filetype='hitile',
+            uuid='deleted'
+        )
+
+        self.assertEqual(
+            ttc.get_cache_key('deleted.0.0', generation=tileset.generation),
+            key
+        )
+        self.assertIsNone(ttc.get_cached_tile(key))
+
+
+class WarmupTest(dt.TestCase):
+    def setUp(self):
+        self.user1 = dcam.User.objects.create_user(
+            username='user1', password='pass'
+        )
+
+        upload_file = open('data/wgEncodeCaltechRnaSeqHuvecR1x75dTh1014IlnaPlusSignalRep2.hitile', 'rb')
+        self.hitile = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name, upload_file.read()),
+            filetype='hitile',
+            owner=self.user1,
+            uuid='warm-hitile'
+        )
+
+    def test_visible_tiles(self):
+        tileset_infos = {
+            'a': {
+                'min_pos': [0], 'max_pos': [2 ** 20],
+                'max_width': 2 ** 20, 'tile_size': 256, 'max_zoom': 10
+            },
+            'b': {
+                'min_pos': [0, 0], 'max_pos': [2 ** 20, 2 ** 20],
+                'max_width': 2 ** 20, 'bins_per_dimension': 256,
+                'max_zoom': 10
+            },
+        }
+        viewconf = {
+            'views': [{
+                'initialXDomain': [0, 2 ** 17],
+                'initialYDomain': [0, 2 ** 15],
+                'layout': {'w': 12, 'h': 20},
+                'tracks': {
+                    'top': [{'tilesetUid': 'a', 'height': 60}],
+                    'center': [{
+                        'type': 'combined',
+                        'contents': [{'tilesetUid': 'b'}]
+                    }],
+                    'left': [{'tilesetUid': 'unknown', 'width': 60}],
+                }
+            }]
+        }
+
+        # The center is 1140x540 pixels, so the x domain fits and the y
+        # domain is widened to the same number of units per pixel
+        tile_ids = twu.get_visible_tiles(viewconf, tileset_infos, 1200)
+
+        self.assertEqual(
+            set(t for t in tile_ids if t.startswith('a.')),
+            set('a.5.{}'.format(x) for x in range(4))
+        )
+        self.assertEqual(
+            set(t for t in tile_ids if t.startswith('b.')),
+            set('b.5.{}.{}'.format(x, y) for x in range(4) for y in range(2))
+        )
+
+        # The central tiles of all tracks come first, so capping the
+        # number of tiles keeps them
+        self.assertEqual(set(tile_ids[:2]), set(['a.5.1', 'b.5.1.0']))
+        self.assertEqual(
+            set(tile_ids[-4:]),
+            set(['b.5.0.0', 'b.5.0.1', 'b.5.3.0', 'b.5.3.1'])
+        )
+
+    def test_warmup_viewconf(self):
+        viewconf = {
+            'views': [{
+                'initialXDomain': [0, 1000000],
+                'tracks': {'top': [{'tilesetUid': 'warm-hitile'}]}
+            }]
+        }
+
+        self.assertGreater(twu.warmup_viewconf(json.dumps(viewconf)), 0)
+        self.assertEqual(twu.warmup_viewconf(viewconf, max_tiles=1), 1)
+
+        # Private tilesets are not warmed up
+        self.hitile.private = True
+        self.hitile.save()
+
+        self.assertEqual(twu.warmup_viewconf(viewconf), 0)
+
+
+class ExportTilesTest(dt.TestCase):
+    def setUp(self):
+        self.user1 = dcam.User.objects.create_user(
+            username='user1', password='pass'
+        )
+
+        upload_file = open('data/wgEncodeCaltechRnaSeqHuvecR1x75dTh1014IlnaPlusSignalRep2.hitile', 'rb')
+        self.hitile = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name, upload_file.read()),
+            filetype='hitile',
+            owner=self.user1,
+            uuid='export-hitile'
+        )
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = op.join(self.directory.name, 'hitile.tiles')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_export_to_archive(self):
+        out = StringIO()
+        dcm.call_command(
+            'export_tiles', uuid='export-hitile', max_zoom=2,
+            output=self.output, processes=1, stdout=out
+        )
+
+        num_tiles, num_todo = re.match(
+            r'(\d+) tiles, (\d+) to generate', out.getvalue()
+        ).groups()
+
+        self.assertGreater(int(num_tiles), 0)
+        self.assertEqual(num_tiles, num_todo)
+        self.assertTrue(op.exists(self.output))
+        self.assertFalse(op.exists(self.output + '.partial'))
+
+    def test_resume(self):
+        writer = tta.TileArchiveWriter(self.output)
+        writer.add('export-hitile.0.0', {'dense': 'a'})
+        writer.close()
+
+        # A tile that was cut off by an interruption is dropped
+        with open(self.output + '.partial', 'ab') as f:
+            f.write(tta.RECORD_HEADER.pack(3, 100) + b'1.0')
+
+        writer = tta.TileArchiveWriter(self.output)
+        self.assertEqual(len(writer), 1)
+        self.assertIn('export-hitile.0.0', writer)
+        writer.close()
+
+        out = StringIO()
+        dcm.call_command(
+            'export_tiles', uuid='export-hitile', max_zoom=0,
+            output=self.output, processes=1, stdout=out
+        )
+
+        self.assertIn('1 tiles, 0 to generate', out.getvalue())
+        self.assertTrue(op.exists(self.output))
+
+    def test_cooler_transforms(self):
+        upload_file = open('data/dixon2012-h1hesc-hindiii-allreps-filtered.1000kb.multires.cool', 'rb')
+        tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(upload_file.name, upload_file.read()),
+            filetype='cooler',
+            owner=self.user1,
+            uuid='export-cooler'
+        )
+
+        dcm.call_command(
+            'export_tiles', uuid='export-cooler', max_zoom=0,
+            output=self.output, processes=1, stdout=StringIO()
+        )
+
+        # Every transform of the tileset info can be served
+        archive = tta.TileArchive(self.output)
+        transforms = [t['value'] for t in archive.tileset_info['transforms']]
+
+        for transform in ['default', 'none'] + transforms:
+            self.assertIsNotNone(
+                archive.get('export-cooler.0.0.0.{}'.format(transform))
+            )
+
+    def test_freeze(self):
+        original = json.loads(self.client.get(
+            '/api/v1/tiles/?d=export-hitile.1.0'
+        ).content.decode('utf-8'))
+
+        dcm.call_command(
+            'freeze_tileset', uuid='export-hitile', max_zoom=1, processes=1,
+            stdout=StringIO()
+        )
+
+        tileset = tm.Tileset.objects.get(uuid='export-hitile')
+        self.addCleanup(os.remove, tileset.datafile.path)
+
+        self.assertEqual(tileset.filetype, 'tilearchive')
+
+        ret = self.client.get('/api/v1/tiles/?d=export-hitile.1.0')
+        frozen = json.loads(ret.content.decode('utf-8'))
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(frozen, original)
+
+        ret = self.client.get('/api/v1/tileset_info/?d=export-hitile')
+        info = json.loads(ret.content.decode('utf-8'))['export-hitile']
+
+        self.assertEqual(info['datatype'], tileset.datatype)
+        self.assertIn('max_zoom', info)
+
 
 class PermissionsTest(dt.TestCase):
     def setUp(self):
@@ -1347,6 +1883,53 @@ class SuggestionsTest(dt.TestCase):
         self.assertGreater(len(suggestions), 0)
         self.assertGreater(suggestions[0]['score'], suggestions[1]['score'])
 
+    def test_suggestion_index(self):
+        genes = [
+            ('BRCA1', 5), ('BRCA2', 9), ('ABCA1', 3), ('TP53', 7),
+            ('NBR1', 1), ('brcc3', 2),
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = op.join(tmp_dir, 'genes.db')
+            con = sqlite3.connect(db_file)
+            con.execute(
+                'CREATE TABLE intervals '
+                '(id int, importance real, chrOffset int, fields text)'
+            )
+            con.executemany(
+                'INSERT INTO intervals VALUES (?, ?, ?, ?)',
+                [
+                    (i, importance, 0, 'chr1\t{}\t{}\t{}\t0\t+'.format(
+                        i * 10, i * 10 + 5, name
+                    ))
+                    for i, (name, importance) in enumerate(genes)
+                ]
+            )
+            con.commit()
+            con.close()
+
+            def names(text):
+                return [
+                    s['geneName'] for s in tsu.get_gene_suggestions(db_file, text)
+                ]
+
+            # Case-insensitive substrings ranked by importance
+            self.assertEqual(names('brc'), ['BRCA2', 'BRCA1', 'brcc3'])
+            self.assertEqual(names('BR'), ['BRCA2', 'BRCA1', 'brcc3', 'NBR1'])
+            self.assertEqual(names('rca1'), ['BRCA1'])
+            self.assertEqual(names('ca1'), ['BRCA1', 'ABCA1'])
+            self.assertEqual(names('xyz'), [])
+            self.assertEqual(len(names('')), len(genes))
+
+            # Quotes are just text
+            self.assertEqual(names("'%"), [])
+
+            suggestion = tsu.get_gene_suggestions(db_file, 'tp5')[0]
+            self.assertEqual(suggestion, {
+                'chr': 'chr1', 'txStart': 30, 'txEnd': 35, 'score': 7,
+                'geneName': 'TP53'
+            })
+
 
 class FileUploadTest(dt.TestCase):
     '''
@@ -1485,6 +2068,62 @@ class GetterTest(dt.TestCase):
         self.assertEqual(info['max_width'], 1000000 * 2 ** 12)
 
 
+class CoolerCacheTest(dt.TestCase):
+    def test_get_meta(self):
+        filepath = 'data/dixon2012-h1hesc-hindiii-allreps-filtered.1000kb.multires.cool'
+
+        self.assertEqual(tcc.get_layout(filepath).version, 1)
+
+        meta = tcc.get_meta(filepath)
+
+        with h5py.File(filepath, 'r') as f:
+            c = cooler.Cooler(f[meta.group])
+
+            self.assertEqual(meta.resolution, c.info['bin-size'])
+            self.assertEqual(list(meta.chromsizes), list(c.chromsizes))
+            self.assertTrue(np.allclose(
+                meta.weights, c.bins()['weight'][:].values, equal_nan=True
+            ))
+
+        # Unchanged files are only read once
+        self.assertIs(tcc.get_meta(filepath), meta)
+
+    def test_cooler_tiles(self):
+        filepath = 'data/dixon2012-h1hesc-hindiii-allreps-filtered.1000kb.multires.cool'
+        tct.raw_tiles = tct.RawTileCache(hss.COOLER_PIXEL_CACHE_SIZE)
+
+        for transform in ['default', 'weight', 'none']:
+            tile_ids = [
+                'a.{}.{}.{}.{}'.format(z, x, y, transform)
+                for z in range(3)
+                for x in range(2 ** z)
+                for y in range(2 ** z)
+            ]
+
+            expected = dict(hgco.generate_tiles(filepath, tile_ids))
+            tiles = dict(tct.generate_tiles(filepath, tile_ids))
+
+            self.assertEqual(set(tiles), set(expected))
+
+            for tile_id in tiles:
+                self.assertEqual(tiles[tile_id]['dtype'], expected[tile_id]['dtype'])
+                self.assertTrue(np.allclose(
+                    np.frombuffer(
+                        base64.b64decode(tiles[tile_id]['dense']),
+                        dtype=tiles[tile_id]['dtype']
+                    ),
+                    np.frombuffer(
+                        base64.b64decode(expected[tile_id]['dense']),
+                        dtype=expected[tile_id]['dtype']
+                    ),
+                    rtol=1e-3,
+                    equal_nan=True
+                ))
+
+        # Every transform is derived from the same raw tiles
+        self.assertEqual(len(tct.raw_tiles._tiles), 1 + 4 + 16)
+
+
 class Bed2DDBTest(dt.TestCase):
     def setUp(self):
         self.user1 = dcam.User.objects.create_user(
@@ -2104,4 +2743,56 @@ class TilesetsViewSetTest(dt.TestCase):
         # make sure above doesn't raise an error
 
 
+class ImtilesTest(dt.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filepath = op.join(self.tmp.name, 'test.imtiles')
+
+        conn = sqlite3.connect(self.filepath)
+        conn.execute(
+            'CREATE TABLE tileset_info (a, b, c, d, e, tile_size, max_zoom, '
+            'max_size, width, height)'
+        )
+        conn.execute(
+            'INSERT INTO tileset_info VALUES (0, 0, 0, 0, 0, 256, 2, 1024, '
+            '1024, 1024)'
+        )
+        conn.execute('CREATE TABLE tiles (z INT, y INT, x INT, image BLOB)')
+        for x in range(4):
+            for y in range(4):
+                conn.execute(
+                    'INSERT INTO tiles VALUES (2, ?, ?, ?)',
+                    (y, x, bytes([x, y]))
+                )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_tiles(self):
+        tiles = tim.get_tiles(
+            self.filepath, ['a.2.1.3', 'a.2.3.0', 'a.2.9.9'], False
+        )
+
+        self.assertEqual([tile_id for tile_id, _ in tiles], ['a.2.1.3', 'a.2.3.0'])
+        self.assertEqual(
+            base64.b64decode(tiles[0][1]['dense']), bytes([3, 1])
+        )
+
+        tiles = tim.get_tiles(self.filepath, ['a.2.1.3'], True)
+        self.assertEqual(tiles[0][1]['image'], bytes([3, 1]))
+
+    def test_tile_cache(self):
+        cache = tim.TileCache(self.filepath, max_size=4)
+        cache.load(2, range(1, 3), range(0, 2))
+
+        self.assertEqual(cache.blob(2, 2, 1), bytes([2, 1]))
+        self.assertIsNone(cache.blob(2, 9, 9))
+
+        # The least recently used tile was evicted
+        self.assertEqual(len(cache._blobs), 4)
+        self.assertNotIn((2, 1, 0), cache._blobs)
+
+
 # Create your tests here.
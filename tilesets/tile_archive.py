@@ -0,0 +1,259 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Archive layout:
+#
+#   MAGIC
+#   record*               tile records, see RECORD_HEADER
+#   index                 JSON: {'tileset_info': ..., 'tiles': {key: [offset, length]}}
+#   FOOTER                offset and length of the index, then MAGIC
+#
+# Tiles are stored as the JSON that is sent to clients and are keyed by
+# their tile id without the tileset uuid (e.g., '3.1' or '3.1.2'), so that
+# an archive can be served under any uuid. While an archive is being
+# written, it only consists of the magic and the records, so an interrupted
+# export can continue where it stopped.
+MAGIC = b'HGTILES1'
+RECORD_HEADER = struct.Struct('<HI')
+FOOTER = struct.Struct('<QQ8s')
+
+
+class EncodedTile(bytes):
+    '''
+    A tile that is JSON-encoded already and can be sent as it is.
+    '''
+    pass
+
+
+def get_tile_key(tile_id):
+    '''
+    Get the key of a tile in an archive, which is its id without the
+    tileset uuid.
+    '''
+    return tile_id.split('.', 1)[1]
+
+
+class TileArchiveWriter:
+    '''
+    Write tiles into an archive. Tiles are appended to `<path>.partial`,
+    which is turned into the archive by `finish`. Opening a partial
+    archive again picks up the tiles that are in it already.
+
+    Args:
+
+    path (str): The archive to write
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.tiles = {}
+
+        if os.path.exists(self.partial_path):
+            self.f = open(self.partial_path, 'r+b')
+            self._recover()
+        else:
+            self.f = open(self.partial_path, 'wb')
+            self.f.write(MAGIC)
+
+    def _recover(self):
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a partial tile archive: {}'.format(
+                self.partial_path
+            ))
+
+        size = os.fstat(self.f.fileno()).st_size
+        end = len(MAGIC)
+
+        while end + RECORD_HEADER.size <= size:
+            self.f.seek(end)
+            key_length, length = RECORD_HEADER.unpack(
+                self.f.read(RECORD_HEADER.size)
+            )
+            offset = end + RECORD_HEADER.size + key_length
+
+            # The tile might have been cut off by the interruption
+            if offset + length > size:
+                break
+
+            key = self.f.read(key_length).decode('utf-8')
+            self.tiles[key] = (offset, length)
+            end = offset + length
+
+        # Drop a tile that was only partly written
+        self.f.seek(end)
+        self.f.truncate()
+
+    def __contains__(self, tile_id):
+        return get_tile_key(tile_id) in self.tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def add(self, tile_id, tile_value):
+        '''
+        Append a tile to the archive.
+
+        Return:
+
+        (int): The number of bytes of the encoded tile
+        '''
+        key = get_tile_key(tile_id).encode('utf-8')
+
+        if isinstance(tile_value, EncodedTile):
+            data = bytes(tile_value)
+        else:
+            data = json.dumps(tile_value, cls=DjangoJSONEncoder).encode('utf-8')
+
+        self.f.write(RECORD_HEADER.pack(len(key), len(data)))
+        self.f.write(key)
+        self.tiles[key.decode('utf-8')] = (self.f.tell(), len(data))
+        self.f.write(data)
+
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def finish(self, tileset_info):
+        '''
+        Write the index and move the archive into place.
+
+        Args:
+
+        tileset_info (dict): The tileset info that is served with the
+            archive
+        '''
+        index = json.dumps({
+            'tileset_info': tileset_info,
+            'tiles': self.tiles,
+        }).encode('utf-8')
+
+        index_offset = self.f.tell()
+        self.f.write(index)
+        self.f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        self.flush()
+        self.f.close()
+
+        os.replace(self.partial_path, self.path)
+
+    def close(self):
+        '''
+        Close the archive without finishing it. It can be reopened to add
+        more tiles.
+        '''
+        self.flush()
+        self.f.close()
+
+
+class TileArchive:
+    '''
+    Read-only view of a tile archive. The archive is memory-mapped, so
+    tiles are sliced out of the page cache and shared between processes.
+
+    Args:
+
+    path (str): The archive
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index_offset, index_length, magic = FOOTER.unpack(
+            self.mm[-FOOTER.size:]
+        )
+
+        if self.mm[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError('Not a tile archive: {}'.format(path))
+
+        index = json.loads(
+            self.mm[index_offset:index_offset + index_length].decode('utf-8')
+        )
+
+        self.tileset_info = index['tileset_info']
+        self.tiles = index['tiles']
+
+    def get(self, tile_id):
+        '''
+        Get an encoded tile or `None` if it is not in the archive. Cooler
+        tiles are stored with their transform, which defaults to 'default'.
+        '''
+        key = get_tile_key(tile_id)
+        entry = self.tiles.get(key) or self.tiles.get(key + '.default')
+
+        if entry is None:
+            return None
+
+        offset, length = entry
+
+        return EncodedTile(self.mm[offset:offset + length])
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_tile_archive(path):
+    '''
+    Get the open archive at a path, opening it only once until the file
+    changes.
+    '''
+    mtime = os.path.getmtime(path)
+
+    with _archives_lock:
+        mtime_archive = _archives.get(path)
+
+        if mtime_archive is None or mtime_archive[0] != mtime:
+            mtime_archive = (mtime, TileArchive(path))
+            _archives[path] = mtime_archive
+
+    return mtime_archive[1]
+
+
+def tileset_info(path):
+    return dict(get_tile_archive(path).tileset_info)
+
+
+def tiles(path, tile_ids):
+    '''
+    Get tiles from an archive. Tiles that are not in the archive, e.g.,
+    because they are out of bounds, are left out.
+
+    Return:
+
+    tile_list: [(tile_id, tile_data),...]
+        The tiles as `EncodedTile`s
+    '''
+    archive = get_tile_archive(path)
+    generated_tiles = []
+
+    for tile_id in tile_ids:
+        tile_value = archive.get(tile_id)
+
+        if tile_value is not None:
+            generated_tiles.append((tile_id, tile_value))
+
+    return generated_tiles
+
+
+def dumps_tiles(tiles):
+    '''
+    JSON-encode a dict of tiles, splicing in tiles that are encoded
+    already.
+    '''
+    parts = []
+
+    for tile_id, tile_value in tiles.items():
+        if not isinstance(tile_value, EncodedTile):
+            tile_value = json.dumps(
+                tile_value, cls=DjangoJSONEncoder
+            ).encode('utf-8')
+
+        parts.append(json.dumps(tile_id).encode('utf-8') + b':' + tile_value)
+
+    return b'{' + b','.join(parts) + b'}'
@@ -0,0 +1,607 @@
+import collections as col
+import contextlib
+import itertools as it
+import logging
+import re
+import threading
+
+import clodius.tiles.cooler as hgco
+
+import higlass_server.settings as hss
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from higlass_server.shm_cache import SharedMemoryCache
+from higlass_server.utils import EmptyRDB, SingleFlight, getRdb
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger(__name__)
+
+rdb = getRdb()
+
+# Tiles are looked up in the shared memory cache of the host first
+shm = (
+    SharedMemoryCache(hss.TILE_CACHE_SHM_PATH, hss.TILE_CACHE_SHM_SIZE)
+    if hss.TILE_CACHE_SHM_SIZE > 0 else None
+)
+
+# Tiles that are read straight from memory-mapped files are not worth a
+# round trip to the cache
+UNCACHED_FILETYPES = {'tilearchive'}
+
+TILE_KEY_PREFIX = 'tile_'
+# Hashes with the number of cache hits and misses of a tileset
+STATS_KEY_PREFIX = 'tilestats_'
+
+# Max number of sampling rounds when evicting tiles to stay within the
+# budget
+MAX_EVICTION_ROUNDS = 64
+
+
+def add_transform_type(tile_id):
+    '''
+    Add a transform type to a cooler tile id if it's not already
+    present.
+
+    Parameters
+    ----------
+    tile_id: str
+        A tile id (e.g. xyz.0.1.0)
+
+    Returns
+    -------
+    new_tile_id: str
+        A formatted tile id, potentially with an added transform_type
+    '''
+    tile_id_parts = tile_id.split('.')
+    tileset_uuid = tile_id_parts[0]
+    tile_position = tile_id_parts[1:4]
+
+    transform_type = hgco.get_transform_type(tile_id)
+    new_tile_id = ".".join([tileset_uuid] + tile_position + [transform_type])
+    return new_tile_id
+
+
+def get_cache_key(tile_id, tileset_options=None, generation=0):
+    '''
+    Get the key a tile is cached under. Keys start with the generation of
+    the tileset, so that bumping it invalidates all of its tiles. Tiles
+    generated with options (e.g., aggregation) are cached separately for
+    every set of options.
+    '''
+    key = '{}{}:{}'.format(TILE_KEY_PREFIX, generation, tile_id)
+
+    if tileset_options is not None:
+        key += tileset_options["options_hash"]
+
+    return key
+
+
+def get_key_tileset_uuid(key):
+    return key[len(TILE_KEY_PREFIX):].split(':', 1)[-1].split('.')[0]
+
+
+def get_ttl(filetype, tile_id):
+    '''
+    Get the number of seconds that a tile is kept in Redis. Tiles of
+    coarse zoom levels are kept longer.
+
+    Return:
+
+    (int): The TTL or `None` if the tile is kept until it is evicted
+    '''
+    ttl = hss.TILE_CACHE_TTLS.get(filetype, hss.TILE_CACHE_TTL)
+
+    if not ttl:
+        return None
+
+    try:
+        zoom_level = int(tile_id.split('.')[1])
+    except (IndexError, ValueError):
+        return int(ttl)
+
+    return int(ttl * 2 ** max(0, hss.TILE_CACHE_COARSE_ZOOMS - zoom_level))
+
+
+def get_cached_tile(key):
+    tile_value = None
+
+    if shm is not None:
+        try:
+            tile_value = shm.get(key)
+        except Exception as ex:
+            logger.warn(ex)
+
+    if tile_value is None:
+        try:
+            tile_value = rdb.get(key)
+        except Exception as ex:
+            # there was an error accessing the cache server
+            # log the error and carry forward fetching the tile
+            # from the original data
+            logger.warn(ex)
+            return None
+
+        if tile_value is None:
+            return None
+
+        _set_shm(key, tile_value)
+
+    return pickle.loads(tile_value)
+
+
+def set_cached_tile(key, tile_value, ttl=None):
+    tile_value = pickle.dumps(tile_value)
+    _set_shm(key, tile_value)
+
+    try:
+        rdb.set(key, tile_value, ex=ttl)
+    except Exception as ex:
+        # error caching a tile
+        # log the error and carry forward, this isn't critical
+        logger.warn(ex)
+
+    _count_set()
+
+
+def _set_shm(key, tile_value):
+    if shm is None:
+        return
+
+    try:
+        shm.set(key, tile_value)
+    except Exception as ex:
+        logger.warn(ex)
+
+
+def is_cached(key):
+    '''
+    Check whether a tile is cached without fetching it.
+    '''
+    try:
+        return (
+            (shm is not None and shm.exists(key)) or bool(rdb.exists(key))
+        )
+    except Exception as ex:
+        logger.warn(ex)
+        return False
+
+
+_num_sets = 0
+_num_sets_lock = threading.Lock()
+
+
+def _count_set():
+    global _num_sets
+
+    if not hss.TILE_CACHE_MAX_BYTES or isinstance(rdb, EmptyRDB):
+        return
+
+    with _num_sets_lock:
+        _num_sets += 1
+
+        if _num_sets < hss.TILE_CACHE_CHECK_INTERVAL:
+            return
+
+        _num_sets = 0
+
+    # Evicting takes a few round trips, which requests shouldn't wait for
+    threading.Thread(target=_enforce_budget, daemon=True).start()
+
+
+def _enforce_budget():
+    try:
+        enforce_budget()
+    except Exception as ex:
+        logger.warn(ex)
+
+
+def sample_tiles(sample_size=None):
+    '''
+    Get the tiles among a sample of random Redis keys.
+
+    Return:
+
+    (int, list): The number of sampled keys and the (key, size, ttl) of
+        the sampled tiles, where a TTL of -1 means that the tile doesn't
+        expire
+    '''
+    sample_size = sample_size or hss.TILE_CACHE_SAMPLE_SIZE
+    prefix = TILE_KEY_PREFIX.encode('utf-8')
+
+    pipe = rdb.pipeline(transaction=False)
+
+    for _ in range(sample_size):
+        pipe.randomkey()
+
+    keys = [
+        key for key in pipe.execute()
+        if key is not None and key.startswith(prefix)
+    ]
+
+    pipe = rdb.pipeline(transaction=False)
+
+    for key in keys:
+        pipe.strlen(key)
+        pipe.ttl(key)
+
+    values = pipe.execute()
+
+    return sample_size, [
+        (key.decode('utf-8'), size, ttl)
+        for key, size, ttl in zip(keys, values[::2], values[1::2])
+        if ttl != -2
+    ]
+
+
+def estimate_size():
+    '''
+    Estimate the number of bytes of the tiles in Redis from a sample of
+    random keys.
+
+    Return:
+
+    (float, list): The estimate and the sampled tiles (see `sample_tiles`)
+    '''
+    num_keys = rdb.dbsize()
+    sample_size, tiles = sample_tiles()
+
+    return num_keys * sum(size for _, size, _ in tiles) / sample_size, tiles
+
+
+def enforce_budget(max_bytes=None):
+    '''
+    Evict tiles from Redis until they fit into `TILE_CACHE_MAX_BYTES`.
+    Tiles are sampled at random and the half of the sampled tiles that is
+    closest to expiring is evicted, which are mostly tiles of fine zoom
+    levels and tiles that have not been regenerated for long.
+
+    Return:
+
+    (int): The number of evicted tiles
+    '''
+    max_bytes = max_bytes or hss.TILE_CACHE_MAX_BYTES
+
+    if isinstance(rdb, EmptyRDB):
+        return 0
+
+    size, tiles = estimate_size()
+    excess = size - max_bytes
+    num_evicted = 0
+
+    for _ in range(MAX_EVICTION_ROUNDS):
+        if excess <= 0 or not tiles:
+            break
+
+        # Tiles without a TTL are from before TTLs were set and go first
+        tiles = sorted(set(tiles), key=lambda tile: tile[2])
+        evicted = tiles[:max(1, len(tiles) // 2)]
+
+        num_evicted += rdb.delete(*[key for key, _, _ in evicted])
+        excess -= sum(size for _, size, _ in evicted)
+
+        _, tiles = sample_tiles()
+
+    if num_evicted:
+        logger.info('Evicted %d tiles from the tile cache', num_evicted)
+
+    return num_evicted
+
+
+def record_stats(hits, misses):
+    '''
+    Add to the number of cache hits and misses of tilesets.
+
+    Args:
+
+    hits (dict): The number of hits by tileset uuid
+    misses (dict): The number of misses by tileset uuid
+    '''
+    if isinstance(rdb, EmptyRDB) or not (hits or misses):
+        return
+
+    try:
+        pipe = rdb.pipeline(transaction=False)
+
+        for field, counts in (('hits', hits), ('misses', misses)):
+            for tileset_uuid, count in counts.items():
+                pipe.hincrby(STATS_KEY_PREFIX + tileset_uuid, field, count)
+
+        pipe.execute()
+    except Exception as ex:
+        logger.warn(ex)
+
+
+def get_stats():
+    '''
+    Get the number of cache hits and misses of all tilesets.
+
+    Return:
+
+    (dict): {'hits': int, 'misses': int} by tileset uuid
+    '''
+    if isinstance(rdb, EmptyRDB):
+        return {}
+
+    stats = {}
+
+    for key in rdb.scan_iter(match=STATS_KEY_PREFIX + '*', count=1000):
+        counts = rdb.hgetall(key)
+        key = key.decode('utf-8')
+
+        stats[key[len(STATS_KEY_PREFIX):]] = {
+            field: int(counts.get(field.encode('utf-8'), 0))
+            for field in ('hits', 'misses')
+        }
+
+    return stats
+
+
+def _iter_redis_tiles(tileset_uuid=None):
+    match = TILE_KEY_PREFIX + '*'
+
+    if tileset_uuid is not None:
+        # Tiles of all generations, escaping glob patterns in the uuid
+        match = '{}*:{}.*'.format(
+            TILE_KEY_PREFIX, re.sub(r'([*?\[\]\\])', r'\\\1', tileset_uuid)
+        )
+
+    for key in rdb.scan_iter(match=match, count=1000):
+        key = key.decode('utf-8')
+
+        if tileset_uuid is None or get_key_tileset_uuid(key) == tileset_uuid:
+            yield key
+
+
+def get_usage():
+    '''
+    Count the tiles of every tileset and their bytes in Redis and in the
+    shared memory cache of this host.
+
+    Return:
+
+    (dict): {'redis': [tiles, bytes], 'shm': [tiles, bytes]} by tileset
+        uuid
+    '''
+    usage = col.defaultdict(lambda: {'redis': [0, 0], 'shm': [0, 0]})
+
+    if not isinstance(rdb, EmptyRDB):
+        keys = list(_iter_redis_tiles())
+
+        for i in range(0, len(keys), 1000):
+            pipe = rdb.pipeline(transaction=False)
+
+            for key in keys[i:i + 1000]:
+                pipe.strlen(key)
+
+            for key, size in zip(keys[i:i + 1000], pipe.execute()):
+                tileset_usage = usage[get_key_tileset_uuid(key)]['redis']
+                tileset_usage[0] += 1
+                tileset_usage[1] += size
+
+    if shm is not None:
+        for key, size in shm.iter_keys():
+            if key.startswith(TILE_KEY_PREFIX):
+                tileset_usage = usage[get_key_tileset_uuid(key)]['shm']
+                tileset_usage[0] += 1
+                tileset_usage[1] += size
+
+    return usage
+
+
+def delete_tiles(tileset_uuid):
+    '''
+    Remove the cached tiles of all generations and the cache stats of a
+    tileset from Redis and the shared memory cache of this host. Bumping
+    the generation of the tileset is enough to invalidate its tiles, this
+    frees their memory right away.
+
+    Return:
+
+    (int, int): The number of tiles removed from Redis and from the shared
+        memory cache
+    '''
+    num_redis = 0
+    num_shm = 0
+
+    if not isinstance(rdb, EmptyRDB):
+        keys = list(_iter_redis_tiles(tileset_uuid))
+
+        for i in range(0, len(keys), 1000):
+            num_redis += rdb.delete(*keys[i:i + 1000])
+
+        rdb.delete(STATS_KEY_PREFIX + tileset_uuid)
+
+    if shm is not None:
+        for key, _ in shm.iter_keys():
+            if (
+                key.startswith(TILE_KEY_PREFIX) and
+                get_key_tileset_uuid(key) == tileset_uuid
+            ):
+                num_shm += shm.delete(key)
+
+    return num_redis, num_shm
+
+
+@receiver(post_delete, sender=tm.Tileset)
+def delete_tileset_tiles(sender, instance, **kwargs):
+    # A tileset ingested again under the same uuid starts at generation 0
+    # again and must not get the tiles of the deleted one
+    try:
+        delete_tiles(instance.uuid)
+    except Exception as ex:
+        logger.warn(ex)
+
+
+def get_tiles(tile_ids, tilesets=None, tileset_to_options=None, raw=False,
+              user=None):
+    '''
+    Get tiles from the cache, generating and caching the ones that are
+    missing. Tiles requested concurrently by several clients are only
+    generated once.
+
+    Parameters
+    ----------
+    tile_ids: set
+        The ids of the tiles (e.g. xyz.0.0.1)
+    tilesets: dict
+        Tilesets by uuid that have been loaded already. Missing tilesets
+        are loaded and added.
+    tileset_to_options: dict
+        Optional tileset options by tileset uuid
+    raw: str or False
+        The value of the GET request parameter `raw`
+    user: django.contrib.auth.models.User
+        Tiles of private tilesets are only generated for their owner
+
+    Returns
+    -------
+    tiles: dict
+        The tile values by the requested tile ids
+    generated_tiles: [(tile_id, tile_data),...]
+        All tiles that were found or generated, by their formatted ids
+    '''
+    tilesets = {} if tilesets is None else tilesets
+    tileset_to_options = tileset_to_options or {}
+
+    tileids_by_tileset = col.defaultdict(set)
+    generated_tiles = []
+
+    def get_tile_cache_key(tile_id):
+        tileset_uuid = tgt.extract_tileset_uid(tile_id)
+
+        return get_cache_key(
+            tile_id,
+            tileset_to_options.get(tileset_uuid),
+            tilesets[tileset_uuid].generation
+        )
+
+    transform_id_to_original_id = {}
+    uncached_tile_ids = set()
+    hits = col.Counter()
+
+    # sort tile_ids by the dataset they come from
+    for tile_id in tile_ids:
+        tileset_uuid = tgt.extract_tileset_uid(tile_id)
+
+        # get the tileset object first
+        if tileset_uuid in tilesets:
+            tileset = tilesets[tileset_uuid]
+        else:
+            tileset = tm.Tileset.objects.get(uuid=tileset_uuid)
+            tilesets[tileset_uuid] = tileset
+
+        if tileset.filetype == 'cooler':
+            # cooler tiles can have a transform (e.g. 'ice', 'kr') which
+            # needs to be added if it's not there (e.g. 'default')
+            new_tile_id = add_transform_type(tile_id)
+            transform_id_to_original_id[new_tile_id] = tile_id
+            tile_id = new_tile_id
+        else:
+            transform_id_to_original_id[tile_id] = tile_id
+
+        if tileset.filetype in UNCACHED_FILETYPES:
+            uncached_tile_ids.add(tile_id)
+            tileids_by_tileset[tileset_uuid].add(tile_id)
+            continue
+
+        # see if the tile is cached
+        tile_value = get_cached_tile(get_tile_cache_key(tile_id))
+
+        if tile_value is not None:
+            # we found the tile in the cache, no need to fetch it again
+            generated_tiles += [(tile_id, tile_value)]
+            hits[tileset_uuid] += 1
+            continue
+
+        tileids_by_tileset[tileset_uuid].add(tile_id)
+
+    # The locks are taken in order so that overlapping requests cannot
+    # deadlock.
+    with contextlib.ExitStack() as locks:
+        flights = {}
+
+        for tileset_uuid, tile_id in sorted(
+            (tu, tile_id)
+            for tu in tileids_by_tileset
+            for tile_id in tileids_by_tileset[tu]
+            if tile_id not in uncached_tile_ids
+        ):
+            flights[tile_id] = locks.enter_context(
+                SingleFlight(rdb, get_tile_cache_key(tile_id))
+            )
+
+            # the tile might have been generated while waiting
+            tile_value = (
+                flights[tile_id].value or
+                get_cached_tile(get_tile_cache_key(tile_id))
+            )
+
+            if tile_value is not None:
+                generated_tiles += [(tile_id, tile_value)]
+                tileids_by_tileset[tileset_uuid].remove(tile_id)
+                hits[tileset_uuid] += 1
+
+        # fetch the tiles
+        to_generate = [
+            tilesets[tu] for tu in tileids_by_tileset if tileids_by_tileset[tu]
+        ]
+        accessible_tilesets = [
+            (
+                t,
+                tileids_by_tileset[t.uuid],
+                raw,
+                tileset_to_options.get(t.uuid, None)
+            )
+            for t in to_generate
+            if (not t.private) or user == t.owner
+        ]
+
+        new_tiles = list(it.chain(*map(tgt.generate_tiles, accessible_tilesets)))
+
+        # store the tiles in redis before anyone waiting for them wakes up
+        for (tile_id, tile_value) in new_tiles:
+            if tile_id in uncached_tile_ids:
+                continue
+
+            tileset = tilesets[tgt.extract_tileset_uid(tile_id)]
+
+            set_cached_tile(
+                get_tile_cache_key(tile_id),
+                tile_value,
+                get_ttl(tileset.filetype, tile_id)
+            )
+
+            if tile_id in flights:
+                flights[tile_id].value = tile_value
+
+    generated_tiles += new_tiles
+
+    record_stats(hits, col.Counter(
+        t.uuid
+        for t, tile_ids, _, _ in accessible_tilesets
+        if t.filetype not in UNCACHED_FILETYPES
+        for _ in tile_ids
+    ))
+
+    tiles_to_return = {}
+
+    for (tile_id, tile_value) in generated_tiles:
+        if tile_id in transform_id_to_original_id:
+            original_tile_id = transform_id_to_original_id[tile_id]
+        else:
+            # not in our list of reformatted tile ids, so it probably
+            # wasn't requested
+            continue
+
+        if original_tile_id in tile_ids:
+            tiles_to_return[original_tile_id] = tile_value
+
+    return tiles_to_return, generated_tiles
@@ -0,0 +1,94 @@
+import logging
+import pickle
+
+import higlass_server.settings as hss
+import tilesets.models as tm
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from higlass_server.utils import ResponseCache, getRdb
+
+logger = logging.getLogger(__name__)
+
+rdb = getRdb()
+
+# Popular viewconfs are served from memory. Entries expire so that changes
+# made by other processes are picked up without Redis as well.
+hot_cache = ResponseCache(
+    hss.VIEWCONF_CACHE_SIZE, max_age=hss.VIEWCONF_CACHE_TTL
+)
+
+
+def get_cache_key(uuid):
+    return 'viewconf_gz_{}'.format(uuid)
+
+
+def get_viewconf(uuid):
+    '''
+    Get a gzipped viewconf and its ETag from the process cache, Redis or
+    the database, in that order.
+
+    Args:
+
+    uuid (str): The uuid of the viewconf
+
+    Return:
+
+    (bytes, str): The gzipped viewconf and its ETag or `None` if there is
+        no such viewconf
+    '''
+    cached = hot_cache.get(uuid)
+
+    if cached is not None:
+        return cached[0], cached[2]
+
+    try:
+        value = rdb.get(get_cache_key(uuid))
+    except Exception as ex:
+        # there was an error accessing the cache server
+        # log the error and carry forward fetching the viewconf
+        # from the database
+        logger.warn(ex)
+        value = None
+
+    if value is not None:
+        viewconf_gz, etag = pickle.loads(value)
+    else:
+        try:
+            obj = tm.ViewConf.objects.get(uuid=uuid)
+        except tm.ViewConf.DoesNotExist:
+            return None
+
+        if obj.viewconf_gz is None or not obj.etag:
+            # Stored before viewconfs were compressed or loaded from a
+            # fixture, which skips `save()`
+            obj.save(update_fields=['viewconf_gz', 'etag'])
+
+        viewconf_gz = bytes(obj.viewconf_gz)
+        etag = '"{}"'.format(obj.etag)
+
+        try:
+            rdb.set(
+                get_cache_key(uuid),
+                pickle.dumps((viewconf_gz, etag)),
+                int(hss.VIEWCONF_CACHE_TTL)
+            )
+        except Exception as ex:
+            # error caching a viewconf
+            # log the error and carry forward, this isn't critical
+            logger.warn(ex)
+
+    hot_cache.set(uuid, None, viewconf_gz, 'application/json', etag)
+
+    return viewconf_gz, etag
+
+
+@receiver(post_save, sender=tm.ViewConf)
+@receiver(post_delete, sender=tm.ViewConf)
+def invalidate_viewconf(sender, instance, **kwargs):
+    hot_cache.delete(instance.uuid)
+
+    try:
+        rdb.delete(get_cache_key(instance.uuid))
+    except Exception as ex:
+        logger.warn(ex)
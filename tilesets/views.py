@@ -2,16 +2,10 @@
 from __future__ import print_function
 
 import csv
-import h5py
+import gzip
 import json
 import logging
-import math
-import requests
-
-import clodius.db_tiles as cdt
-import clodius.hdf_tiles as hdft
-
-import collections as col
+import re
 
 import django.db.models as dbm
 import django.db.models.functions as dbmf
@@ -21,26 +15,23 @@ import django.http as dh
 import guardian.utils as gu
 
 import higlass_server.settings as hss
-import itertools as it
 
 import tilesets.chromsizes as tcs
 import tilesets.generate_tiles as tgt
 import tilesets.json_schemas as tjs
 
-import clodius.tiles.bam as ctb
-import clodius.tiles.cooler as hgco
 import clodius.tiles.bigwig as hgbi
 import clodius.tiles.bigbed as hgbb
-import clodius.tiles.multivec as hgmu
-import clodius.tiles.zarr as hgza
-import clodius.tiles.time_interval as hgti
-import clodius.tiles.geo as hggo
-import clodius.tiles.imtiles as hgim
 
 import tilesets.chromsizes as tcs
 import tilesets.models as tm
 import tilesets.permissions as tsp
 import tilesets.serializers as tss
+import tilesets.tile_archive as tta
+import tilesets.tile_cache as ttc
+import tilesets.viewconf_cache as tvc
+import tilesets.warmup as twu
+import website.views as wv
 import tilesets.suggestions as tsu
 
 from tilesets.management.commands.ingest_tileset import ingest as ingest_tileset_to_db
@@ -53,19 +44,15 @@ import rest_framework.parsers as rfp
 import rest_framework.status as rfs
 
 import slugid
-import urllib
 import hashlib
 from jsonschema import validate as json_validate
 from jsonschema.exceptions import ValidationError as JsonValidationError
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import JsonResponse, HttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.views.decorators.gzip import gzip_page
 from rest_framework import generics
@@ -74,11 +61,19 @@ from rest_framework.decorators import api_view, authentication_classes
 from rest_framework.authentication import BasicAuthentication
 from fragments.drf_disable_csrf import CsrfExemptSessionAuthentication
 
-from higlass_server.utils import getRdb
+from higlass_server.utils import (
+    ResponseCache,
+    cache_headers,
+    etag_matches,
+    etag_response,
+    version_etag
+)
 
 logger = logging.getLogger(__name__)
 
-rdb = getRdb()
+chromsizes_responses = ResponseCache(hss.CHROMSIZES_CACHE_SIZE)
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
 
 
 class UserList(generics.ListAPIView):
@@ -119,9 +114,26 @@ def available_chrom_sizes(request):
     queryset = tm.Tileset.objects.all()
     queryset = queryset.filter(datatype__in=["chromsizes"])
 
-    serializer = tss.UserFacingTilesetSerializer(queryset, many=True)
+    # Tilesets added or removed by other processes are detected without
+    # Redis as well
+    stats = queryset.aggregate(count=dbm.Count('id'), latest=dbm.Max('created'))
+    version = (tcs.get_list_version(), stats['count'], stats['latest'])
 
-    return JsonResponse({"count": len(queryset), "results": serializer.data})
+    cached = chromsizes_responses.get('available', version)
+
+    if cached is None:
+        serializer = tss.UserFacingTilesetSerializer(queryset, many=True)
+
+        cached = chromsizes_responses.set(
+            'available',
+            version,
+            json.dumps({
+                "count": len(serializer.data), "results": serializer.data
+            }, cls=DjangoJSONEncoder).encode('utf-8'),
+            'application/json'
+        )
+
+    return etag_response(request, *cached)
 
 
 @api_view(['GET'])
@@ -189,21 +201,35 @@ def sizes(request):
 
         return response(err_msg, status=err_status)
 
+    filetype = tgt.get_tileset_filetype(chrom_sizes)
+    cache_key = (uuid, is_json, bool(incl_cum))
+
     # Try to load the chromosome sizes and return them as a list of
     # (name, size) tuples
     try:
-        if tgt.get_tileset_filetype(chrom_sizes) == 'bigwig':
-            data = hgbi.chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'bigbed':
-            data = hgbb.chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'cooler':
-            data = tcs.get_cooler_chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'chromsizes-tsv':
-            data = tcs.get_tsv_chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'multivec':
-            data = tcs.get_multivec_chromsizes(chrom_sizes.datafile.path)
+        filepath = chrom_sizes.datafile.path if chrom_sizes.datafile else ''
+
+        # Rendered responses are reused until the tileset changes
+        version = tgt.tileset_version(chrom_sizes)
+        cached = chromsizes_responses.get(cache_key, version)
+
+        if cached is not None:
+            return etag_response(
+                request, *cached, public=not chrom_sizes.private
+            )
+
+        if filetype == 'bigwig':
+            data = hgbi.chromsizes(filepath)
+        elif filetype == 'bigbed':
+            data = hgbb.chromsizes(filepath)
+        elif filetype == 'cooler':
+            data = tcs.get_cooler_chromsizes(filepath)
+        elif filetype == 'chromsizes-tsv':
+            data = tcs.get_tsv_chromsizes(filepath)
+        elif filetype == 'multivec':
+            data = tcs.get_multivec_chromsizes(filepath)
         else:
-            data = '';
+            data = []
 
     except Exception as ex:
         logger.exception(ex)
@@ -220,36 +246,12 @@ def sizes(request):
         # data should be a list of (name, size) tuples coming
         # coming and converted to a more appropriate data type
         # going out
-        if res_type == 'tsv':
-            lines = []
-            for (name, size) in data:
-                lines += ["{}\t{}\n".format(name, size)]
-                data = lines
-
-        if res_type == 'json' and not incl_cum:
-            json_out = {}
-
-            for row in data:
-                json_out[row[0]] = {
-                    'size': int(row[1])
-                }
-
-            data = json_out
-
-        if res_type == 'json' and incl_cum:
-            json_out = {}
-            cum = 0
-
-            for row in data:
-                size = int(row[1])
-
-                json_out[row[0]] = {
-                    'size': size,
-                    'offset': cum
-                }
-                cum += size
-
-            data = json_out
+        cached = chromsizes_responses.set(
+            cache_key,
+            version,
+            tcs.render_chromsizes(data, res_type, incl_cum),
+            'application/json' if is_json else 'text/plain; charset=utf-8'
+        )
     except Exception as e:
         logger.exception(e)
         err_msg = 'THIS IS AN OUTRAGE!!!1! Something failed. 😡'
@@ -260,7 +262,7 @@ def sizes(request):
 
         return response(err_msg, status=err_status)
 
-    return response(data)
+    return etag_response(request, *cached, public=not chrom_sizes.private)
 
 @api_view(['GET'])
 def suggest(request):
@@ -322,8 +324,7 @@ def viewconfs(request):
         except KeyError:
             higlass_version = ''
 
-        existing_object = tm.ViewConf.objects.filter(uuid=uid)
-        if len(existing_object) > 0:
+        if tm.ViewConf.objects.filter(uuid=uid).exists():
             return JsonResponse({
                 'error': 'Object with uid {} already exists'.format(uid)
             }, status=rfs.HTTP_400_BAD_REQUEST);
@@ -339,6 +340,12 @@ def viewconfs(request):
             uuid=uid, viewconf=viewconf, higlassVersion=higlass_version
         )
 
+        if hss.THUMBNAIL_PRERENDER:
+            wv.prerender_thumbnail(request, uid)
+
+        if hss.VIEWCONF_WARMUP:
+            twu.warmup_in_background(viewconf_wrapper['viewconf'])
+
         return JsonResponse({'uid': uid})
 
     uid = request.GET.get('d')
@@ -348,38 +355,53 @@ def viewconfs(request):
             'error': 'View config ID not specified'
         }, status=404)
 
-    try:
-        obj = tm.ViewConf.objects.get(uuid=uid)
-    except ObjectDoesNotExist:
+    viewconf = tvc.get_viewconf(uid)
+
+    if viewconf is None:
         return JsonResponse({
             'error': 'View config not found'
         }, status=404)
 
-    return JsonResponse(json.loads(obj.viewconf))
+    viewconf_gz, etag = viewconf
+
+    # The viewconf is stored gzipped already
+    if ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response = etag_response(
+            request,
+            viewconf_gz,
+            'application/json',
+            etag='{}-gzip"'.format(etag[:-1])
+        )
 
+        if response.status_code == 200:
+            response['Content-Encoding'] = 'gzip'
+    else:
+        response = etag_response(
+            request, gzip.decompress(viewconf_gz), 'application/json', etag
+        )
 
-def add_transform_type(tile_id):
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    return response
+
+
+def get_tilesets_etag(request, tilesets, *params):
     '''
-    Add a transform type to a cooler tile id if it's not already
-    present.
-
-    Parameters
-    ----------
-    tile_id: str
-        A tile id (e.g. xyz.0.1.0)
-
-    Returns
-    -------
-    new_tile_id: str
-        A formatted tile id, potentially with an added transform_type
+    Get the ETag of a response that is determined by the request
+    parameters, the versions of the tilesets involved, and whether the
+    user may access them.
     '''
-    tile_id_parts = tile_id.split('.')
-    tileset_uuid = tile_id_parts[0]
-    tile_position = tile_id_parts[1:4]
-
-    transform_type = hgco.get_transform_type(tile_id)
-    new_tile_id = ".".join([tileset_uuid] + tile_position + [transform_type])
-    return new_tile_id
+    return version_etag(
+        *params,
+        sorted(
+            (
+                tileset.uuid,
+                tgt.tileset_version(tileset),
+                (not tileset.private) or request.user == tileset.owner
+            )
+            for tileset in tilesets
+        )
+    )
 
 
 @api_view(['GET', 'POST'])
@@ -455,109 +477,51 @@ def tiles(request):
     # works for `imtiles`
     raw = request.GET.get('raw', False)
 
-    tileids_by_tileset = col.defaultdict(set)
-    generated_tiles = []
-
-    tilesets = {}
-    transform_id_to_original_id = {}
-
-    # sort tile_ids by the dataset they come from
-    for tile_id in tileids_to_fetch:
-        tileset_uuid = tgt.extract_tileset_uid(tile_id)
-
-        # get the tileset object first
-        if tileset_uuid in tilesets:
-            tileset = tilesets[tileset_uuid]
-        else:
-            tileset = tm.Tileset.objects.get(uuid=tileset_uuid)
-            tilesets[tileset_uuid] = tileset
-
-        if tileset.filetype == 'cooler':
-            # cooler tiles can have a transform (e.g. 'ice', 'kr') which
-            # needs to be added if it's not there (e.g. 'default')
-            new_tile_id = add_transform_type(tile_id)
-            transform_id_to_original_id[new_tile_id] = tile_id
-            tile_id = new_tile_id
-        else:
-            transform_id_to_original_id[tile_id] = tile_id
-
-        # see if the tile is cached
-        tile_value = None
-        try:
-            if tileset_uuid in tileset_to_options:
-                tileset_options = tileset_to_options[tileset_uuid]
-                tile_value = rdb.get(tile_id + tileset_options["options_hash"])
-            else:
-                tile_value = rdb.get(tile_id)
-        except Exception as ex:
-            # there was an error accessing the cache server
-            # log the error and carry forward fetching the tile
-            # from the original data
-            logger.warn(ex)
-
-        #tile_value = None
-
-        if tile_value is not None:
-            # we found the tile in the cache, no need to fetch it again
-            tile_value = pickle.loads(tile_value)
-            generated_tiles += [(tile_id, tile_value)]
-            continue
-
-        tileids_by_tileset[tileset_uuid].add(tile_id)
-
-    # fetch the tiles
-    tilesets = [tilesets[tu] for tu in tileids_by_tileset]
-    accessible_tilesets = [(t, tileids_by_tileset[t.uuid], raw, tileset_to_options.get(t.uuid, None)) for t in tilesets if ((not t.private) or request.user == t.owner)]
-
-    #pool = mp.Pool(6)
-
-    generated_tiles += list(it.chain(*map(tgt.generate_tiles, accessible_tilesets)))
-
-    '''
-    for tileset_uuid in tileids_by_tileset:
-        # load the tileset object
-        tileset = tilesets[tileset_uuid]
-
-        # check permissions
-        if tileset.private and request.user != tileset.owner:
-            generated_tiles += [(tile_id, {'error': "Forbidden"}) for tile_id in tileids_by_tileset[tileset_uuid]]
-        else:
-            generated_tiles += generate_tiles(tileset, tileids_by_tileset[tileset_uuid])
-    '''
-
-    # store the tiles in redis
-
-    tiles_to_return = {}
+    tilesets = {
+        tileset.uuid: tileset
+        for tileset in tm.Tileset.objects.filter(uuid__in=set(
+            tgt.extract_tileset_uid(tile_id) for tile_id in tileids_to_fetch
+        ))
+    }
+
+    # Tiles are only returned for accessible tilesets, so the response
+    # depends on the user unless all tilesets are public
+    public = all(not t.private for t in tilesets.values())
+    etag = None
+
+    if request.method == 'GET':
+        # The ETag can be checked before any tile is loaded
+        etag = get_tilesets_etag(
+            request, tilesets.values(), sorted(tileids_to_fetch), raw
+        )
 
-    for (tile_id, tile_value) in generated_tiles:
-        tileset_uuid = tgt.extract_tileset_uid(tile_id)
-        try:
-            if tileset_uuid in tileset_to_options:
-                tileset_options = tileset_to_options[tileset_uuid]
-                rdb.set(tile_id + tileset_options["options_hash"], pickle.dumps(tile_value))
-            else:
-                rdb.set(tile_id, pickle.dumps(tile_value))
-        except Exception as ex:
-            # error caching a tile
-            # log the error and carry forward, this isn't critical
-            logger.warn(ex)
-
-        if tile_id in transform_id_to_original_id:
-            original_tile_id = transform_id_to_original_id[tile_id]
-        else:
-            # not in our list of reformatted tile ids, so it probably
-            # wasn't requested
-            continue
+        if etag_matches(request, etag):
+            return cache_headers(dh.HttpResponseNotModified(), etag, public)
 
-        if original_tile_id in tileids_to_fetch:
-            tiles_to_return[original_tile_id] = tile_value
+    tiles_to_return, generated_tiles = ttc.get_tiles(
+        tileids_to_fetch, tilesets, tileset_to_options, raw, request.user
+    )
 
-    if len(generated_tiles) == 1 and raw and 'image' in generated_tiles[0][1]:
-        return HttpResponse(
+    if (
+        len(generated_tiles) == 1 and raw and
+        isinstance(generated_tiles[0][1], dict) and
+        'image' in generated_tiles[0][1]
+    ):
+        response = HttpResponse(
             generated_tiles[0][1]['image'], content_type='image/jpeg'
         )
+    elif any(isinstance(t, tta.EncodedTile) for t in tiles_to_return.values()):
+        # Archived tiles are sent as they are stored
+        response = HttpResponse(
+            tta.dumps_tiles(tiles_to_return), content_type='application/json'
+        )
+    else:
+        response = JsonResponse(tiles_to_return, safe=False)
+
+    if request.method == 'GET':
+        cache_headers(response, etag, public)
 
-    return JsonResponse(tiles_to_return, safe=False)
+    return response
 
 
 @api_view(['GET'])
@@ -598,8 +562,20 @@ def tileset_info(request):
             except Exception as ex:
                 pass
 
+    tilesets = {
+        tileset.uuid: tileset
+        for tileset in queryset.filter(uuid__in=tileset_uuids)
+    }
+
+    # The info of private tilesets depends on the user
+    public = all(not t.private for t in tilesets.values())
+    etag = get_tilesets_etag(request, tilesets.values(), tileset_uuids)
+
+    if etag_matches(request, etag):
+        return cache_headers(dh.HttpResponseNotModified(), etag, public)
+
     for tileset_uuid in tileset_uuids:
-        tileset_object = queryset.filter(uuid=tileset_uuid).first()
+        tileset_object = tilesets.get(tileset_uuid)
 
         if tileset_uuid == 'osm-image':
             tileset_infos[tileset_uuid] = {
@@ -623,113 +599,9 @@ def tileset_info(request):
             tileset_infos[tileset_uuid] = {'error': "Forbidden"}
             continue
 
-        if (
-            tileset_object.filetype == 'hitile' or
-            tileset_object.filetype == 'hibed'
-        ):
-            tileset_info = hdft.get_tileset_info(
-                h5py.File(tileset_object.datafile.path, 'r'))
-            tileset_infos[tileset_uuid] = {
-                "min_pos": [int(tileset_info['min_pos'])],
-                "max_pos": [int(tileset_info['max_pos'])],
-                "max_width": 2 ** math.ceil(
-                    math.log(
-                        tileset_info['max_pos'] - tileset_info['min_pos']
-                    ) / math.log(2)
-                ),
-                "tile_size": int(tileset_info['tile_size']),
-                "max_zoom": int(tileset_info['max_zoom'])
-            }
-        elif tileset_object.filetype == 'bigwig':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tsinfo = hgbi.tileset_info(
-                    tileset_object.datafile.path,
-                    chromsizes
-                )
-            #print('tsinfo:', tsinfo)
-            if 'chromsizes' in tsinfo:
-                tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
-            if tileset_object.indexfile != None and tileset_object.indexfile.path != None:
-                info_url = tileset_object.indexfile.path
-                if info_url.startswith(hss.MEDIA_ROOT) and info_url[len(hss.MEDIA_ROOT)+1:].startswith("http"):
-                    info_url = info_url[len(hss.MEDIA_ROOT)+1:-2]
-                    if info_url.startswith("https"):
-                        info_url = info_url.replace("https/", "https://")
-                    elif info_url.startswith("http"):
-                        info_url = info_url.replace("http/", "http://")
-
-                    r = requests.get(info_url)
-                    if r.ok:
-                        try:
-                            tsinfo['rowinfo'] = json.dumps(r.json())
-                        except:
-                            tsinfo['rowinfo'] = json.dumps(dict())
-            tileset_infos[tileset_uuid] = tsinfo
-        elif tileset_object.filetype == 'bigbed':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tsinfo = hgbi.tileset_info(
-                    tileset_object.datafile.path,
-                    chromsizes
-                )
-            #print('tsinfo:', tsinfo)
-            if 'chromsizes' in tsinfo:
-                tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
-            tileset_infos[tileset_uuid] = tsinfo
-        elif tileset_object.filetype == 'multivec':
-            tileset_infos[tileset_uuid] = hgmu.tileset_info(
-                    tileset_object.datafile.path)
-        elif tileset_object.filetype == 'zarr':
-            tileset_infos[tileset_uuid] = hgza.tileset_info(
-                tileset_object.datafile.path)
-        elif tileset_object.filetype == "elastic_search":
-            response = urllib.urlopen(
-                tileset_object.datafile + "/tileset_info")
-            tileset_infos[tileset_uuid] = json.loads(response.read())
-        elif tileset_object.filetype == 'beddb':
-            tileset_infos[tileset_uuid] = cdt.get_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'bed2ddb':
-            tileset_infos[tileset_uuid] = cdt.get_2d_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'cooler':
-            tileset_infos[tileset_uuid] = hgco.tileset_info(
-                    tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'time-interval-json':
-            tileset_infos[tileset_uuid] = hgti.tileset_info(
-                    tileset_object.datafile.path
-            )
-        elif (
-            tileset_object.filetype == '2dannodb' or
-            tileset_object.filetype == 'imtiles'
-        ):
-            tileset_infos[tileset_uuid] = hgim.get_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'geodb':
-            tileset_infos[tileset_uuid] = hggo.tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'bam':
-            tileset_infos[tileset_uuid] = ctb.tileset_info(
-                tileset_object.datafile.path
-            )
-            tileset_infos[tileset_uuid]['max_tile_width'] = hss.MAX_BAM_TILE_WIDTH
-        else:
-            # Unknown filetype
-            tileset_infos[tileset_uuid] = {
-                'error': 'Unknown filetype ' + tileset_object.filetype
-            }
-
-        tileset_infos[tileset_uuid]['name'] = tileset_object.name
-        tileset_infos[tileset_uuid]['datatype'] = tileset_object.datatype
-        tileset_infos[tileset_uuid]['coordSystem'] = tileset_object.coordSystem
-        tileset_infos[tileset_uuid]['coordSystem2'] =\
-            tileset_object.coordSystem2
+        tileset_infos[tileset_uuid] = tgt.get_tileset_info(tileset_object)
 
-    return JsonResponse(tileset_infos)
+    return cache_headers(JsonResponse(tileset_infos), etag, public)
 
 
 @api_view(['POST'])
@@ -0,0 +1,363 @@
+import json
+import logging
+import math
+
+import django.db as db
+
+import higlass_server.settings as hss
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+import tilesets.tile_cache as ttc
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Constants of the HiGlass client
+GRID_COLUMNS = 12
+ROW_HEIGHT = 30
+VIEW_RESOLUTION = 384
+BINS_PER_TILE = 256
+
+POSITIONS_1D = {
+    'top': 'x',
+    'bottom': 'x',
+    'left': 'y',
+    'right': 'y',
+}
+
+EPSILON = 0.0000001
+
+executor = ThreadPoolExecutor(max_workers=hss.VIEWCONF_WARMUP_THREADS)
+
+
+def iter_tracks(view):
+    '''
+    Iterate over the (position, track) pairs of a view. The contents of
+    combined tracks are flattened.
+    '''
+    for position, tracks in (view.get('tracks') or {}).items():
+        if not isinstance(tracks, list):
+            continue
+
+        stack = list(tracks)
+
+        while stack:
+            track = stack.pop(0)
+
+            if not isinstance(track, dict):
+                continue
+
+            if isinstance(track.get('contents'), list):
+                stack = track['contents'] + stack
+                continue
+
+            yield position, track
+
+
+def get_view_scales(view, view_width=None):
+    '''
+    Get the initial domains and the pixel sizes of the center of a view.
+    Just like in the client, both axes show the same number of units per
+    pixel and the initial domains are fitted into the center.
+
+    Return:
+
+    (dict): The (domain, pixels) of the 'x' and 'y' axes or `None` if
+        the view has no initial domain
+    '''
+    x_domain = view.get('initialXDomain')
+
+    if not x_domain:
+        return None
+
+    y_domain = view.get('initialYDomain') or x_domain
+    layout = view.get('layout') or {}
+
+    view_width = view_width or hss.VIEWCONF_WARMUP_WIDTH
+    width = layout.get('w', GRID_COLUMNS) / GRID_COLUMNS * view_width
+    height = layout.get('h', 12) * ROW_HEIGHT
+
+    # Side tracks take up space from the center
+    for position, track in iter_tracks(view):
+        if position in ('left', 'right'):
+            width -= track.get('width', 0) or 0
+        elif position in ('top', 'bottom'):
+            height -= track.get('height', 0) or 0
+
+    width = max(width, 1)
+    height = max(height, 1)
+
+    units_per_pixel = max(
+        (x_domain[1] - x_domain[0]) / width,
+        (y_domain[1] - y_domain[0]) / height
+    )
+
+    def fit(domain, pixels):
+        center = (domain[0] + domain[1]) / 2
+        return (
+            [
+                center - units_per_pixel * pixels / 2,
+                center + units_per_pixel * pixels / 2
+            ],
+            pixels
+        )
+
+    return {'x': fit(x_domain, width), 'y': fit(y_domain, height)}
+
+
+def get_zoom_level(tileset_info, domain, pixels, dim=0):
+    '''
+    Get the zoom level the client requests for an axis of a tileset.
+    '''
+    if 'resolutions' in tileset_info:
+        resolutions = sorted(
+            (float(r) for r in tileset_info['resolutions']), reverse=True
+        )
+        bins_per_pixel = [
+            (domain[1] - domain[0]) / r / pixels for r in resolutions
+        ]
+        displayable = [i for i, b in enumerate(bins_per_pixel) if b < 1]
+
+        return displayable[-1] if displayable else 0
+
+    min_pos = tileset_info['min_pos'][dim]
+    max_pos = tileset_info['max_pos'][dim]
+
+    zoom_scale = max((max_pos - min_pos) / (domain[1] - domain[0]), 1)
+    added_zoom = max(0, math.ceil(math.log2(pixels / VIEW_RESOLUTION)))
+    zoom_level = round(math.log2(zoom_scale)) + added_zoom
+
+    bins_per_tile = (
+        tileset_info.get('bins_per_dimension') or
+        tileset_info.get('tile_size')
+    )
+
+    if bins_per_tile:
+        zoom_level += math.floor(
+            math.log2(BINS_PER_TILE) - math.log2(bins_per_tile)
+        )
+
+    return max(0, min(zoom_level, int(tileset_info.get('max_zoom', 0))))
+
+
+def get_tile_positions(tileset_info, zoom_level, domain, dim=0):
+    '''
+    Get the positions of the tiles that cover a domain along an axis.
+    '''
+    min_pos = tileset_info['min_pos'][dim]
+
+    if 'resolutions' in tileset_info:
+        resolutions = sorted(
+            (float(r) for r in tileset_info['resolutions']), reverse=True
+        )
+        tile_width = resolutions[zoom_level] * BINS_PER_TILE
+        upper = math.ceil(
+            (min(tileset_info['max_pos'][dim], domain[1]) - min_pos - EPSILON)
+            / tile_width
+        )
+    else:
+        tile_width = tileset_info['max_width'] / 2 ** zoom_level
+        upper = min(
+            2 ** zoom_level,
+            math.ceil((domain[1] - min_pos - EPSILON) / tile_width)
+        )
+
+    lower = max(0, math.floor((domain[0] - min_pos) / tile_width))
+
+    return range(lower, upper)
+
+
+def by_distance(positions, center):
+    '''
+    Sort tile positions by the distance of their centers to a position in
+    tile units.
+    '''
+    return sorted(
+        positions,
+        key=lambda pos: sum(
+            (p + 0.5 - c) ** 2 for p, c in zip(pos, center)
+        )
+    )
+
+
+def get_track_tiles(tileset_uuid, tileset_info, position, scales):
+    '''
+    Get the ids of the tiles that a track initially shows, closest to the
+    center of the view first.
+    '''
+    if 'error' in tileset_info or 'min_pos' not in tileset_info:
+        return []
+
+    if position in POSITIONS_1D:
+        axis = POSITIONS_1D[position]
+        domain, pixels = scales[axis]
+        zoom_level = get_zoom_level(tileset_info, domain, pixels)
+        positions = get_tile_positions(tileset_info, zoom_level, domain)
+        center = (positions.start + positions.stop) / 2
+
+        if len(tileset_info['min_pos']) > 1:
+            # 2D data along one axis (e.g., horizontal heatmaps) shows the
+            # tiles around the diagonal
+            return [
+                '{}.{}.{}.{}'.format(tileset_uuid, zoom_level, i, j)
+                for i, j in by_distance(
+                    [(i, j) for i in positions for j in positions],
+                    (center, center)
+                )
+            ]
+
+        return [
+            '{}.{}.{}'.format(tileset_uuid, zoom_level, i)
+            for i, in by_distance([(i,) for i in positions], (center,))
+        ]
+
+    if position != 'center' or len(tileset_info['min_pos']) < 2:
+        return []
+
+    x_domain, x_pixels = scales['x']
+    y_domain, y_pixels = scales['y']
+
+    zoom_level = max(
+        get_zoom_level(tileset_info, x_domain, x_pixels, 0),
+        get_zoom_level(tileset_info, y_domain, y_pixels, 1)
+    )
+
+    x_positions = get_tile_positions(tileset_info, zoom_level, x_domain, 0)
+    y_positions = get_tile_positions(tileset_info, zoom_level, y_domain, 1)
+
+    return [
+        '{}.{}.{}.{}'.format(tileset_uuid, zoom_level, i, j)
+        for i, j in by_distance(
+            [(i, j) for i in x_positions for j in y_positions],
+            (
+                (x_positions.start + x_positions.stop) / 2,
+                (y_positions.start + y_positions.stop) / 2
+            )
+        )
+    ]
+
+
+def get_tileset_uids(viewconf):
+    '''
+    Get the uids of the tilesets shown in a viewconf.
+    '''
+    return set(
+        track['tilesetUid']
+        for view in viewconf.get('views', [])
+        for _, track in iter_tracks(view)
+        if isinstance(track.get('tilesetUid'), str)
+    )
+
+
+def get_visible_tiles(viewconf, tileset_infos, view_width=None):
+    '''
+    Get the ids of the tiles visible in the initial view of a viewconf.
+    The tiles are ordered by their distance to the center of their track,
+    so the central tiles of all tracks come before the outer ones. Tracks
+    further up in the viewconf come first among tiles of the same rank.
+
+    Args:
+
+    viewconf (dict): The viewconf
+    tileset_infos (dict): The tileset infos by tileset uuid. Tracks of
+        other tilesets are skipped.
+    view_width (int): Width of a view spanning the whole page in pixels
+
+    Return:
+
+    (list): The unique tile ids
+    '''
+    ranked = []
+    num_tracks = 0
+
+    for view in viewconf.get('views', []):
+        scales = get_view_scales(view, view_width)
+
+        if scales is None:
+            continue
+
+        for position, track in iter_tracks(view):
+            tileset_info = tileset_infos.get(track.get('tilesetUid'))
+
+            if tileset_info is not None:
+                track_tiles = get_track_tiles(
+                    track['tilesetUid'], tileset_info, position, scales
+                )
+                ranked.extend(
+                    (rank, num_tracks, tile_id)
+                    for rank, tile_id in enumerate(track_tiles)
+                )
+                num_tracks += 1
+
+    tile_ids = []
+    seen = set()
+
+    for _, _, tile_id in sorted(ranked):
+        if tile_id not in seen:
+            seen.add(tile_id)
+            tile_ids.append(tile_id)
+
+    return tile_ids
+
+
+def warmup_viewconf(viewconf, max_tiles=None):
+    '''
+    Generate the tiles visible in the initial view of a viewconf into the
+    tile cache. Only public tilesets are warmed up.
+
+    Args:
+
+    viewconf (str or dict): The viewconf
+    max_tiles (int): Max number of tiles to generate
+
+    Return:
+
+    (int): The number of tiles that were warmed up
+    '''
+    if isinstance(viewconf, str):
+        viewconf = json.loads(viewconf)
+
+    max_tiles = max_tiles or hss.VIEWCONF_WARMUP_MAX_TILES
+
+    tilesets = {
+        tileset.uuid: tileset
+        for tileset in tm.Tileset.objects.filter(
+            uuid__in=get_tileset_uids(viewconf), private=False
+        )
+    }
+    tileset_infos = {}
+
+    for uuid, tileset in tilesets.items():
+        try:
+            tileset_infos[uuid] = tgt.get_tileset_info(tileset)
+        except Exception as ex:
+            logger.warning('Could not get tileset info of %s: %r', uuid, ex)
+
+    tile_ids = get_visible_tiles(viewconf, tileset_infos)[:max_tiles]
+
+    if tile_ids:
+        ttc.get_tiles(set(tile_ids), tilesets)
+
+    return len(tile_ids)
+
+
+def _warmup(viewconf):
+    try:
+        return warmup_viewconf(viewconf)
+    except Exception as ex:
+        logger.error('Could not warm up viewconf: %r', ex)
+    finally:
+        # Threads of the pool hold on to their own connection otherwise
+        db.connection.close()
+
+
+def warmup_in_background(viewconf):
+    '''
+    Queue the warmup of a viewconf.
+
+    Return:
+
+    (concurrent.futures.Future): Resolves to the number of tiles
+    '''
+    return executor.submit(_warmup, viewconf)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import slugid
+import threading
+
+from pyppeteer import launch
+
+logger = logging.getLogger(__name__)
+
+
+class Renderer:
+    '''
+    Long-lived thumbnail render service. Renders run on an event loop in a
+    background thread and share one headless browser whose pages are kept
+    open between renders. At most `pool_size` renders run at a time and
+    the others wait in line. Renders of the same file are only done once.
+
+    Args:
+
+    pool_size (int): Number of browser pages rendering at the same time
+    timeout (float): Max number of seconds a render may take
+    '''
+    def __init__(self, pool_size=2, timeout=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._loop = None
+        self._lock = threading.Lock()
+        self._renders = {}
+
+        # Only used on the event loop
+        self._browser = None
+        self._browser_lock = None
+        self._pages = None
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever,
+                    name='thumbnail-renderer',
+                    daemon=True
+                ).start()
+
+    def render(self, screenshot, base_url, uuid, output_file):
+        '''
+        Queue the render of a thumbnail unless it is in flight already.
+
+        Args:
+
+        screenshot (coroutine function): Renders the viewconf into a page,
+            called as `screenshot(base_url, uuid, path, page=page)`
+        base_url (str): The url to use for rendering the viewconf
+        uuid (str): The uuid of the viewconf to render
+        output_file (str): Where to store the thumbnail
+
+        Return:
+
+        (concurrent.futures.Future): Resolves once the thumbnail is stored
+        '''
+        self._start()
+
+        with self._lock:
+            future = self._renders.get(output_file)
+
+            if future is not None:
+                return future
+
+            future = asyncio.run_coroutine_threadsafe(
+                self._render(screenshot, base_url, uuid, output_file),
+                self._loop
+            )
+            self._renders[output_file] = future
+
+        # Outside of the lock since the callback runs right away if the
+        # render is done already
+        future.add_done_callback(lambda _: self._forget(output_file))
+
+        return future
+
+    def is_rendering(self, output_file):
+        with self._lock:
+            return output_file in self._renders
+
+    def _forget(self, output_file):
+        with self._lock:
+            self._renders.pop(output_file, None)
+
+    async def _get_browser(self, relaunch=False):
+        if self._browser_lock is None:
+            self._browser_lock = asyncio.Lock()
+
+        async with self._browser_lock:
+            if relaunch and self._browser is not None:
+                try:
+                    await self._browser.close()
+                except Exception as ex:
+                    logger.warning('Could not close browser: %s', ex)
+                self._browser = None
+
+            if self._browser is None:
+                self._browser = await launch(
+                    headless=True,
+                    args=['--no-sandbox'],
+                    handleSIGINT=False,
+                    handleSIGTERM=False,
+                    handleSIGHUP=False
+                )
+
+            return self._browser
+
+    async def _acquire_page(self):
+        if self._pages is None:
+            # Empty slots are filled with pages on demand
+            self._pages = asyncio.Queue()
+            for _ in range(self.pool_size):
+                self._pages.put_nowait(None)
+
+        page = await self._pages.get()
+
+        if page is not None:
+            return page
+
+        try:
+            try:
+                return await (await self._get_browser()).newPage()
+            except Exception:
+                # The browser probably died
+                browser = await self._get_browser(relaunch=True)
+                return await browser.newPage()
+        except Exception:
+            self._pages.put_nowait(None)
+            raise
+
+    async def _release_page(self, page, broken=False):
+        if broken:
+            try:
+                await page.close()
+            except Exception:
+                pass
+            page = None
+
+        self._pages.put_nowait(page)
+
+    async def _render(self, screenshot, base_url, uuid, output_file):
+        page = await self._acquire_page()
+        broken = False
+
+        # Render next to the thumbnail so that it appears atomically
+        tmp_file = '{}.{}.png'.format(output_file, slugid.nice())
+
+        try:
+            await asyncio.wait_for(
+                screenshot(base_url, uuid, tmp_file, page=page), self.timeout
+            )
+            os.replace(tmp_file, output_file)
+        except Exception as ex:
+            broken = True
+            logger.error('Could not render thumbnail %s: %r', uuid, ex)
+            raise
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+            await self._release_page(page, broken)
@@ -1,9 +1,13 @@
+import asyncio
 import json
 import os
 import os.path as op
+import time
 from asynctest import CoroutineMock
 
+from io import BytesIO
 from pathlib import Path
+from PIL import Image
 from unittest import TestCase, mock
 
 import django.contrib.auth.models as dcam
@@ -53,3 +57,104 @@ class SiteTests(dt.TestCase):
         )
 
         self.assertEqual(ret.status_code, 400)
+
+    @mock.patch.object(hss, 'THUMBNAIL_RENDER_WAIT', 0)
+    @mock.patch.object(wv.renderer, '_acquire_page', new=CoroutineMock())
+    @mock.patch.object(wv.renderer, '_release_page', new=CoroutineMock())
+    def test_thumbnail_render(self):
+        uuid = 'rendered_uid'
+        output_file = Path(hss.THUMBNAILS_ROOT) / (uuid + ".png")
+
+        if output_file.exists():
+            output_file.unlink()
+        wv.thumbnail_store.invalidate(uuid)
+
+        async def screenshot(base_url, uuid, path, page=None):
+            await asyncio.sleep(0.2)
+            Path(path).write_bytes(b'thumbnail')
+
+        with mock.patch('website.views.screenshot', new=screenshot):
+            ret = self.client.get(f'/thumbnail/?d={uuid}')
+
+            # Rendering has only just started
+            self.assertEqual(ret.status_code, 202)
+            self.assertEqual(ret['Content-Type'], 'image/png')
+
+            for _ in range(50):
+                if output_file.exists():
+                    break
+                time.sleep(0.1)
+
+        ret = self.client.get(f'/thumbnail/?d={uuid}')
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret.content, b'thumbnail')
+
+    def test_thumbnail_variants(self):
+        image = Image.new('RGB', (800, 600), (10, 20, 30))
+        b = BytesIO()
+        image.save(b, format='png')
+
+        # Two viewconfs rendering identically
+        for uuid in ['md', 'md2']:
+            wv.thumbnail_store.invalidate(uuid)
+            output_file = Path(hss.THUMBNAILS_ROOT) / (uuid + ".png")
+            output_file.write_bytes(b.getvalue())
+
+        ret = self.client.get('/thumbnail/?d=md')
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret['Content-Type'], 'image/png')
+        self.assertEqual(ret.content, b.getvalue())
+
+        ret = self.client.get('/thumbnail/?d=md&size=small&format=webp')
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret['Content-Type'], 'image/webp')
+        self.assertEqual(Image.open(BytesIO(ret.content)).size, (320, 240))
+
+        ret = self.client.get('/thumbnail/?d=md&size=card')
+
+        self.assertEqual(ret['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(ret.content)).size, (1200, 630))
+
+        etag = ret['ETag']
+        ret = self.client.get('/thumbnail/?d=md2&size=card')
+
+        # Shared with the identical render
+        self.assertEqual(ret['ETag'], etag)
+
+        ret = self.client.get(
+            '/thumbnail/?d=md&size=card', HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(ret.status_code, 304)
+
+        ret = self.client.get('/thumbnail/?d=md&size=huge')
+        self.assertEqual(ret.status_code, 400)
+
+    @mock.patch.object(hss, 'THUMBNAIL_RENDER_WAIT', 0)
+    @mock.patch.object(wv.renderer, '_acquire_page', new=CoroutineMock())
+    @mock.patch.object(wv.renderer, '_release_page', new=CoroutineMock())
+    def test_thumbnail_invalidation(self):
+        image = Image.new('RGB', (800, 600), (10, 20, 30))
+        b = BytesIO()
+        image.save(b, format='png')
+
+        wv.thumbnail_store.invalidate('md')
+        output_file = Path(hss.THUMBNAILS_ROOT) / "md.png"
+        output_file.write_bytes(b.getvalue())
+
+        ret = self.client.get('/thumbnail/?d=md')
+        self.assertEqual(ret.status_code, 200)
+
+        # A changed viewconf has to be rendered again
+        self.viewconf.viewconf = json.dumps({'hi': 'you'})
+        self.viewconf.save()
+
+        async def screenshot(base_url, uuid, path, page=None):
+            await asyncio.sleep(0.2)
+
+        with mock.patch('website.views.screenshot', new=screenshot):
+            ret = self.client.get('/thumbnail/?d=md')
+
+        self.assertEqual(ret.status_code, 202)
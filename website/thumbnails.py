@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import threading
+
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+
+from io import BytesIO
+from PIL import Image, ImageOps
+
+from fragments.osm import TileStore
+
+logger = logging.getLogger(__name__)
+
+# Resized variants as (width, height). Renders are cropped to their
+# aspect ratio around the center.
+VARIANTS = {
+    'card': (1200, 630),
+    'small': (320, 240),
+}
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+def find_tileset_uids(viewconf):
+    '''
+    Get the uids of all tilesets referenced in a viewconf.
+    '''
+    uids = set()
+
+    if isinstance(viewconf, dict):
+        for key, value in viewconf.items():
+            if key == 'tilesetUid' and isinstance(value, str):
+                uids.add(value)
+            else:
+                uids |= find_tileset_uids(value)
+    elif isinstance(viewconf, list):
+        for value in viewconf:
+            uids |= find_tileset_uids(value)
+
+    return uids
+
+
+def get_viewconf_version(uuid):
+    '''
+    Get a version of a viewconf that changes whenever the viewconf or any
+    of its tilesets change and its thumbnail has to be rendered again.
+    '''
+    try:
+        viewconf = tm.ViewConf.objects.get(uuid=uuid).viewconf
+    except tm.ViewConf.DoesNotExist:
+        return None
+
+    try:
+        uids = find_tileset_uids(json.loads(viewconf))
+    except ValueError:
+        uids = set()
+
+    tileset_versions = sorted(
+        (tileset.uuid, tgt.tileset_version(tileset))
+        for tileset in tm.Tileset.objects.filter(uuid__in=uids)
+    )
+
+    return hashlib.md5(
+        json.dumps([viewconf, tileset_versions]).encode('utf-8')
+    ).hexdigest()
+
+
+class ThumbnailStore:
+    '''
+    Content-addressed thumbnail store.
+
+    Every render is stored once under the hash of its PNG bytes, so
+    viewconfs that render identically share their thumbnails. Resized and
+    re-encoded variants are generated from the render on first request.
+    Renders and variants are evicted in LRU order once they take up more
+    than `max_bytes`. A small index maps viewconfs to their render and the
+    version it was rendered from.
+
+    Args:
+
+    root (str): The thumbnail directory
+    max_bytes (int): Disk budget of the renders and variants
+    quality (int): Quality of JPEG and WebP variants
+    '''
+    def __init__(self, root, max_bytes, quality=85):
+        self.root = root
+        self.index_dir = op.join(root, 'index')
+        self.store = TileStore(op.join(root, 'store'), max_bytes)
+        self.quality = quality
+
+    def _index_path(self, uuid):
+        return op.join(self.index_dir, uuid + '.json')
+
+    def _key(self, content_hash, variant='full', image_format='png'):
+        return (
+            content_hash[:2],
+            content_hash,
+            '{}.{}'.format(variant, image_format)
+        )
+
+    def get_hash(self, uuid, version):
+        '''
+        Get the content hash of the render of a viewconf or `None` if it
+        has not been rendered from `version`.
+        '''
+        try:
+            with open(self._index_path(uuid), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('version') != version:
+            return None
+
+        return entry.get('hash')
+
+    def add(self, uuid, version, render_file):
+        '''
+        Move a render into the store.
+
+        Return:
+
+        (str): The content hash of the render or `None` if the render
+            has been taken care of by someone else already
+        '''
+        try:
+            with open(render_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return self.get_hash(uuid, version)
+
+        content_hash = hashlib.sha1(data).hexdigest()
+
+        if self.store.get(*self._key(content_hash)) is None:
+            self.store.set(*self._key(content_hash), data)
+
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        index_path = self._index_path(uuid)
+        tmp = '{}.{}.tmp'.format(index_path, threading.get_ident())
+
+        with open(tmp, 'w') as f:
+            json.dump({'version': version, 'hash': content_hash}, f)
+        os.replace(tmp, index_path)
+
+        try:
+            os.remove(render_file)
+        except FileNotFoundError:
+            pass
+
+        return content_hash
+
+    def invalidate(self, uuid):
+        '''
+        Forget the render of a viewconf. Its files are left to eviction
+        since other viewconfs might share them.
+        '''
+        try:
+            os.remove(self._index_path(uuid))
+        except FileNotFoundError:
+            pass
+
+    def get(self, content_hash, variant='full', image_format='png'):
+        '''
+        Get a variant of a render, creating it if needed.
+
+        Return:
+
+        (bytes): The encoded image or `None` if the render was evicted
+        '''
+        data = self.store.get(*self._key(content_hash, variant, image_format))
+
+        if data is not None:
+            return data
+
+        render = self.store.get(*self._key(content_hash))
+
+        if render is None:
+            return None
+
+        image = Image.open(BytesIO(render))
+
+        if variant in VARIANTS:
+            image = ImageOps.fit(image, VARIANTS[variant], Image.LANCZOS)
+
+        if image_format == 'jpeg':
+            image = image.convert('RGB')
+
+        b = BytesIO()
+        image.save(b, format=image_format, quality=self.quality)
+        data = b.getvalue()
+
+        self.store.set(*self._key(content_hash, variant, image_format), data)
+
+        return data
@@ -1,6 +1,5 @@
 import subprocess
 import pyppeteer
-import asyncio
 import logging
 import os
 import os.path as op
@@ -8,15 +7,34 @@ from pyppeteer import launch
 import tempfile
 
 import tilesets.models as tm
+import website.thumbnails as tth
 
 import higlass_server.settings as hss
 
+from io import BytesIO
+from PIL import Image
+from higlass_server.utils import etag_response
+from website.renderer import Renderer
+
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import HttpRequest, HttpResponse, \
     HttpResponseNotFound, HttpResponseBadRequest
 
 logger = logging.getLogger(__name__)
 
+renderer = Renderer(
+    pool_size=hss.THUMBNAIL_RENDER_POOL_SIZE,
+    timeout=hss.THUMBNAIL_RENDER_TIMEOUT
+)
+
+thumbnail_store = tth.ThumbnailStore(
+    hss.THUMBNAILS_ROOT,
+    hss.THUMBNAILS_STORE_SIZE,
+    quality=hss.THUMBNAIL_QUALITY
+)
+
+placeholder = None
+
 def link(request):
     '''Generate a small page containing the metadata necessary for
     link unfurling by Slack or Twitter. The generated page will
@@ -79,21 +97,84 @@ def link(request):
 
     return HttpResponse(html)
 
+def get_thumbnail_path(uuid: str):
+    '''Get the path of the thumbnail of a viewconf.
+
+    Args:
+        uuid: The uuid of the viewconf
+    Returns:
+        The absolute path of the thumbnail or None if the uuid would
+        point outside of the thumbnails directory.
+    '''
+    if not op.exists(hss.THUMBNAILS_ROOT):
+        os.makedirs(hss.THUMBNAILS_ROOT, exist_ok=True)
+
+    output_file = op.abspath(op.join(hss.THUMBNAILS_ROOT, uuid + ".png"))
+    thumbnails_base = op.abspath(hss.THUMBNAILS_ROOT)
+
+    if output_file.find(thumbnails_base) != 0:
+        logger.warning('Thumbnail file is not in thumbnail_base: %s uuid: %s',
+                     output_file, uuid)
+        return None
+
+    return output_file
+
+
+def render_thumbnail(request: HttpRequest, uuid: str, output_file: str):
+    '''Queue the render of a thumbnail in the background.
+
+    Args:
+        request: The incoming request.
+        uuid: The uuid of the viewconf to render
+        output_file: The location of the thumbnail
+    Returns:
+        A future that resolves once the thumbnail is stored.
+    '''
+    base_url = f'{request.scheme}://localhost/app/'
+
+    return renderer.render(screenshot, base_url, uuid, output_file)
+
+
+def prerender_thumbnail(request: HttpRequest, uuid: str):
+    '''Render the thumbnail of a newly saved viewconf so that it is ready
+    when it is first requested.
+    '''
+    output_file = get_thumbnail_path(uuid)
+
+    if output_file is not None and not op.exists(output_file):
+        render_thumbnail(request, uuid, output_file)
+
+
+def get_placeholder():
+    '''Get a blank PNG that is served while a thumbnail is rendered.'''
+    global placeholder
+
+    if placeholder is None:
+        b = BytesIO()
+        Image.new('RGB', (800, 600), (255, 255, 255)).save(b, format='png')
+        placeholder = b.getvalue()
+
+    return placeholder
+
+
 def thumbnail(request: HttpRequest):
     '''Retrieve a thumbnail for the viewconf specified by the d=
     parameter.
 
+    The size= parameter selects the full render (default) or one of the
+    resized variants (card, small) and the format= parameter the encoding
+    (png, jpeg, webp). Full renders default to png and variants to jpeg.
+
     Args:
         request: The incoming request.
     Returns:
         A response of either 404 if there's no uuid provided or an
         image containing a screenshot of the rendered viewconf with
-        that uuid.
+        that uuid. If the thumbnail is still being rendered, a blank
+        placeholder is returned with status 202.
     '''
     uuid = request.GET.get('d')
 
-    base_url = f'{request.scheme}://localhost/app/'
-
     if not uuid:
         return HttpResponseNotFound('<h1>No uuid specified</h1>')
 
@@ -102,36 +183,73 @@ def thumbnail(request: HttpRequest):
         logger.warning('uuid contains . or /: %s', uuid)
         return HttpResponseBadRequest("uuid can't contain . or /")
 
-    if not op.exists(hss.THUMBNAILS_ROOT):
-        os.makedirs(hss.THUMBNAILS_ROOT)
+    variant = request.GET.get('size', 'full')
+    image_format = request.GET.get(
+        'format', 'png' if variant == 'full' else 'jpeg'
+    )
 
-    output_file = op.abspath(op.join(hss.THUMBNAILS_ROOT, uuid + ".png"))
-    thumbnails_base = op.abspath(hss.THUMBNAILS_ROOT)
+    if variant != 'full' and variant not in tth.VARIANTS:
+        return HttpResponseBadRequest(
+            'size must be one of: full, {}'.format(', '.join(tth.VARIANTS))
+        )
 
-    if output_file.find(thumbnails_base) != 0:
-        logger.warning('Thumbnail file is not in thumbnail_base: %s uuid: %s',
-                     output_file, uuid)
+    if image_format not in tth.CONTENT_TYPES:
+        return HttpResponseBadRequest(
+            'format must be one of: {}'.format(', '.join(tth.CONTENT_TYPES))
+        )
+
+    # New renders appear at the legacy location first
+    output_file = get_thumbnail_path(uuid)
+
+    if output_file is None:
         return HttpResponseBadRequest('Strange path')
 
-    if not op.exists(output_file):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(
-            screenshot(
-                base_url,
-                uuid,
-                output_file))
-        loop.close()
-
-    with open(output_file, 'rb') as file:
-        return HttpResponse(
-            file.read(),
-            content_type="image/jpeg")
+    version = tth.get_viewconf_version(uuid)
+    content_hash = thumbnail_store.get_hash(uuid, version)
+    data = None
+
+    if content_hash is not None:
+        # None if the render was evicted
+        data = thumbnail_store.get(content_hash, variant, image_format)
+
+    if data is None:
+        if not op.exists(output_file):
+            future = render_thumbnail(request, uuid, output_file)
+
+            try:
+                # Quick renders are still served right away
+                future.result(timeout=hss.THUMBNAIL_RENDER_WAIT)
+            except Exception:
+                # Timed out or failed (which is logged by the renderer)
+                pass
+
+        if op.exists(output_file):
+            content_hash = thumbnail_store.add(uuid, version, output_file)
+
+        if content_hash is not None:
+            data = thumbnail_store.get(content_hash, variant, image_format)
+
+    if data is None:
+        response = HttpResponse(
+            get_placeholder(), content_type='image/png', status=202
+        )
+        response['Retry-After'] = '2'
+        response['Cache-Control'] = 'no-store'
+
+        return response
+
+    return etag_response(
+        request,
+        data,
+        tth.CONTENT_TYPES[image_format],
+        etag='"{}-{}-{}"'.format(content_hash, variant, image_format)
+    )
 
 async def screenshot(
     base_url: str,
     uuid: str,
-    output_file: str
+    output_file: str,
+    page=None
 ):
     '''Take a screenshot of a rendered viewconf.
 
@@ -140,20 +258,28 @@ async def screenshot(
         uuid: The uuid of the viewconf to render
         output_file: The location on the local filesystem to cache
             the thumbnail.
+        page: The browser page to render the viewconf in. If not given,
+            a new browser is launched for this screenshot.
     Returns:
         Nothing, just stores the screenshot at the given location.
     '''
-    browser = await launch(
-        headless=True,
-        args=['--no-sandbox'],
-        handleSIGINT=False,
-        handleSIGTERM=False,
-        handleSIGHUP=False
-    )
+    browser = None
+
+    if page is None:
+        browser = await launch(
+            headless=True,
+            args=['--no-sandbox'],
+            handleSIGINT=False,
+            handleSIGTERM=False,
+            handleSIGHUP=False
+        )
+        page = await browser.newPage()
+
     url = f'{base_url}?config={uuid}'
-    page = await browser.newPage()
     await page.goto(url, {
         'waitUntil': 'networkidle0',
     })
     await page.screenshot({'path': output_file})
-    await browser.close()
+
+    if browser is not None:
+        await browser.close()